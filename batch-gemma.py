@@ -0,0 +1,75 @@
+import argparse
+import random
+
+import torch
+import numpy as np
+from source.config import *
+from source.gemma_torch import *
+from source.batch_runner import BatchRunner
+
+
+def main(args):
+    # 모델 confiugration 설정
+    model_config = get_model_config(args.variant)
+    model_config.dtype = args.dtype
+    model_config.quant = args.quant
+    model_config.quant_bits = args.quant_bits
+    model_config.quant_group_size = args.quant_group_size
+    # quantize-gemma.py로 만든 파일이면 metadata의 quant_bits / quant_group_size를 사용
+    apply_quant_metadata(model_config, args.safetensors)
+    model_config.vocab_chunk_size = args.vocab_chunk_size
+
+    # 랜덤 시드
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    device = torch.device(args.device)
+    with set_tensor_type(model_config.get_dtype()):
+        model = GemmaForCausalLM(model_config)
+        model.load_weights(args.safetensors)
+        model = model.to(device).eval()
+    print("Model loading done")
+
+    # 입력 JSONL: {"id": ..., "prompt": str} 또는 {"id": ..., "messages": [...]} (id가 없으면 행 번호)
+    runner = BatchRunner(
+        model, device,
+        batch_size=args.batch_size,
+        bucket_size=args.bucket_size,
+        output_len=args.output_len,
+        temperature=args.temperature,
+        top_p=args.top_p,
+        top_k=args.top_k,
+        seed=args.seed if args.temperature else None,
+        truncate_prompts=args.truncate_prompts,
+        )
+    stats = runner.run(args.input, args.output, verbose=args.verbose)
+    print(stats.report())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=str, required=True)
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--safetensors", type=str, default= "model/gemma-1.1-2b-it/model-{}-of-{}.safetensors")
+    parser.add_argument("--variant", type=str, default="2b", help="2b, 7b or a model directory with config.json")
+    parser.add_argument("--device", type=str, default="cpu", choices=["cpu", "cuda"])
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "bfloat16"])
+    parser.add_argument("--seed", type=int, default=12345)
+    parser.add_argument("--quant", action='store_true')
+    parser.add_argument("--quant_bits", type=int, default=8, choices=[4, 8])
+    parser.add_argument("--quant_group_size", type=int, default=0,
+                        help="ignored if the quantized file records it in its metadata")
+    parser.add_argument("--vocab_chunk_size", type=int, default=None)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--bucket_size", type=int, default=256)
+    parser.add_argument("--output_len", type=int, default=100)
+    parser.add_argument("--temperature", type=float, default=None)
+    parser.add_argument("--top_p", type=float, default=1.0)
+    parser.add_argument("--top_k", type=int, default=100)
+    parser.add_argument("--truncate_prompts", action='store_true',
+                        help="cut the front of prompts longer than max_position_embeddings - output_len "
+                             "instead of writing an error row")
+    parser.add_argument("--verbose", action='store_true')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,69 @@
+# Offline batch inference: naive fixed batches in input order vs. BatchRunner (length buckets, early stop).
+# python -m benchmarks.bench_batch --num_rows 256 --batch_size 8 --output_len 32
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+
+import torch
+from source.config import *
+from source.gemma_torch import *
+from benchmarks.common import add_model_args, load_model
+from source.batch_runner import BatchRunner
+
+
+def make_rows(args):
+    # 길이가 크게 다른 프롬프트들이 섞인 입력 (단어 수 min_words ~ max_words)
+    rng   = random.Random(0)
+    words = ["the", "meaning", "of", "life", "is", "a", "question", "about", "time", "and", "space"]
+    return [{"id": i, "prompt": " ".join(rng.choice(words) for _ in range(rng.randint(args.min_words, args.max_words)))}
+            for i in range(args.num_rows)]
+
+
+def run_naive(model, rows, args) -> float:
+    # 입력 순서대로 batch_size개씩 generate() (배치의 가장 긴 프롬프트에 맞춰 패딩, 항상 output_len까지 디코딩)
+    start, num_tokens = time.perf_counter(), 0
+    for i in range(0, len(rows), args.batch_size):
+        prompts = [row["prompt"] for row in rows[i:i + args.batch_size]]
+        outputs = model.generate(prompts, None, output_len=args.output_len, temperature=None)
+        num_tokens += sum(len(model.tokenizer.encode(text, bos=False)) for text in outputs)
+    return num_tokens / (time.perf_counter() - start)
+
+
+def run_bucketed(model, input_path, args) -> float:
+    runner = BatchRunner(model, None, batch_size=args.batch_size, bucket_size=args.bucket_size,
+                         output_len=args.output_len, temperature=None)
+    with tempfile.TemporaryDirectory() as tmp:
+        stats = runner.run(input_path, os.path.join(tmp, "output.jsonl"))
+    print(f"  {stats.report()}")
+    return stats.tokens_per_sec
+
+
+def main(args):
+    model = load_model(args, dtype="float32")
+    rows  = make_rows(args)
+    with tempfile.TemporaryDirectory() as tmp:
+        input_path = os.path.join(tmp, "input.jsonl")
+        with open(input_path, "w") as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+        print(f"rows={args.num_rows} batch_size={args.batch_size} output_len={args.output_len}")
+        naive    = run_naive(model, rows, args)
+        bucketed = run_bucketed(model, input_path, args)
+    print(f"{'naive':>9} {naive:>8.1f} tokens/sec")
+    print(f"{'bucketed':>9} {bucketed:>8.1f} tokens/sec ({bucketed / naive:.2f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_model_args(parser)
+    parser.add_argument("--num_rows", type=int, default=256)
+    parser.add_argument("--min_words", type=int, default=4)
+    parser.add_argument("--max_words", type=int, default=200)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--bucket_size", type=int, default=256)
+    parser.add_argument("--output_len", type=int, default=32)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,100 @@
+# bfloat16 vs float32 on CPU: logit parity (KL, top-1 agreement), parameter memory and tokens/sec.
+# python -m benchmarks.bench_dtype --safetensors model/gemma-1.1-2b-it/model-{}-of-{}.safetensors
+import gc
+import time
+import argparse
+
+import torch
+import torch.nn.functional as F
+from source.config import *
+from source.gemma_torch import *
+from benchmarks.common import add_model_args, load_model
+
+
+DEFAULT_PROMPTS = [
+    "The meaning of life is",
+    "Write me a poem about Machine Learning.",
+    "The capital of France is",
+    "def fibonacci(n):",
+    ]
+
+
+@torch.no_grad()
+def prompt_logits(model, token_ids):
+    # 프롬프트의 모든 위치에 대한 float32 로짓 [input_len, vocab_size]
+    config    = model.config
+    dtype     = config.get_dtype()
+    input_len = len(token_ids)
+    positions = torch.arange(0, input_len, dtype=torch.int64)
+    kv_caches = []
+    for _ in range(config.num_hidden_layers):
+        size = (1, input_len, config.num_key_value_heads, config.head_dim)
+        kv_caches.append((torch.zeros(size, dtype=dtype), torch.zeros(size, dtype=dtype)))
+    mask = torch.triu(torch.full((1, 1, input_len, input_len), -2.3819763e38), diagonal=1)
+
+    hidden_states = model.model.embed_tokens(torch.tensor([token_ids]))
+    hidden_states = hidden_states * torch.tensor(config.hidden_size**0.5, dtype=hidden_states.dtype)
+    hidden_states = model.model(
+        hidden_states=hidden_states,
+        freqs_cis=model.rotary_embedding(positions),
+        kv_write_indices=positions,
+        kv_caches=kv_caches,
+        mask=mask,
+        )
+    return torch.matmul(hidden_states[0], model.model.embed_tokens.dequantize().t()).float()
+
+
+def measure(model, prompts, output_len):
+    # 1. 파라미터 메모리 2. 프롬프트 로짓 3. greedy generate의 tokens/sec
+    param_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+    logits = [prompt_logits(model, model.tokenizer.encode(prompt)) for prompt in prompts]
+    model.generate(prompts[:1], torch.device("cpu"), output_len=2, temperature=None) # warm-up
+    start = time.perf_counter()
+    model.generate(prompts, torch.device("cpu"), output_len=output_len, temperature=None)
+    tokens_per_sec = len(prompts) * output_len / (time.perf_counter() - start)
+    return param_bytes, logits, tokens_per_sec
+
+
+def main(args):
+    prompts = DEFAULT_PROMPTS
+    if args.prompts is not None:
+        with open(args.prompts) as f:
+            prompts = [line.rstrip("\n") for line in f if line.strip()]
+
+    # 두 모델을 차례로 로드하여 메모리를 동시에 쓰지 않는다.
+    results = {}
+    for dtype in ["float32", "bfloat16"]:
+        model = load_model(args, dtype=dtype)
+        results[dtype] = measure(model, prompts, args.output_len)
+        del model
+        gc.collect()
+    fp32_bytes, fp32_logits, fp32_tps = results["float32"]
+    bf16_bytes, bf16_logits, bf16_tps = results["bfloat16"]
+
+    # KL(p_fp32 || p_bf16)를 프롬프트의 모든 위치에 대해 평균
+    kls, top1 = [], []
+    for ref, out in zip(fp32_logits, bf16_logits):
+        ref_logp = F.log_softmax(ref, dim=-1)
+        out_logp = F.log_softmax(out, dim=-1)
+        kls.append(F.kl_div(out_logp, ref_logp, log_target=True, reduction="none").sum(dim=-1))
+        top1.append((ref.argmax(dim=-1) == out.argmax(dim=-1)).float())
+    kls, top1 = torch.cat(kls), torch.cat(top1)
+
+    print('======================================')
+    print(f'PROMPTS    : {len(prompts)} ({kls.numel()} positions)')
+    print(f'KL mean    : {kls.mean().item():.6f}')
+    print(f'KL max     : {kls.max().item():.6f}')
+    print(f'TOP-1 agree: {top1.mean().item() * 100:.2f}%')
+    print(f'MEMORY     : fp32 {fp32_bytes / 2**30:.2f} GiB -> bf16 {bf16_bytes / 2**30:.2f} GiB')
+    print(f'TOKENS/SEC : fp32 {fp32_tps:.2f} -> bf16 {bf16_tps:.2f}')
+    print('======================================')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_model_args(parser)
+    parser.set_defaults(safetensors="model/gemma-1.1-2b-it/model-{}-of-{}.safetensors")
+    parser.add_argument("--prompts", type=str, default=None)
+    parser.add_argument("--output_len", type=int, default=32)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,71 @@
+# Tied-embedding LM head: full logits vs vocabulary-chunked logits.
+# python -m benchmarks.bench_lm_head --batch_sizes 1 8 --chunk_sizes 8192 32768
+import time
+import argparse
+
+import torch
+from source.gemma_torch import Sampler
+
+
+def timeit(fn, iters: int) -> float:
+    fn()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    return (time.perf_counter() - start) / iters * 1000
+
+
+@torch.no_grad()
+def check_exactness(embedding, hidden_states, chunk_size, top_k, temperature):
+    # 1. greedy: 전체 로짓의 argmax와 동일한 토큰
+    # 2. top-k: 전체 로짓의 topk / logsumexp와 동일한 후보와 정규화 상수
+    full    = Sampler(embedding.shape[0])
+    chunked = Sampler(embedding.shape[0], chunk_size)
+    positions = torch.tensor([0])
+    greedy_full    = full(embedding, hidden_states[:, None], positions, None, None, None)
+    greedy_chunked = chunked(embedding, hidden_states[:, None], positions, None, None, None)
+    assert torch.equal(greedy_full.view(-1), greedy_chunked.view(-1)), "greedy mismatch"
+
+    temperatures = torch.full((hidden_states.shape[0],), temperature)
+    logits = torch.matmul(hidden_states, embedding.t()).float() / temperature
+    ref_values, ref_ids = torch.topk(logits, top_k, dim=-1)
+    values, ids, lse = chunked.chunked_top_k(embedding, hidden_states, top_k, temperatures)
+    assert torch.equal(ref_ids, ids), "top-k ids mismatch"
+    assert torch.allclose(ref_values, values), "top-k logits mismatch"
+    assert torch.allclose(torch.logsumexp(logits, dim=-1), lse, atol=1e-4), "logsumexp mismatch"
+
+
+def main(args):
+    torch.manual_seed(0)
+    embedding = torch.randn(args.vocab_size, args.hidden_size) * 0.02
+    print(f"vocab_size={args.vocab_size} hidden_size={args.hidden_size} top_k={args.top_k}")
+    print(f"{'batch':>5} {'chunk':>8} {'greedy ms':>10} {'top-k ms':>10}")
+    for batch_size in args.batch_sizes:
+        hidden_states = torch.randn(batch_size, 1, args.hidden_size)
+        positions     = torch.tensor([0])
+        temperatures  = torch.full((batch_size,), args.temperature)
+        top_ps        = torch.full((batch_size,), args.top_p)
+        top_ks        = torch.full((batch_size,), args.top_k, dtype=torch.int64)
+        for chunk_size in [None] + args.chunk_sizes:
+            if chunk_size is not None:
+                check_exactness(embedding, hidden_states[:, 0], chunk_size, args.top_k, args.temperature)
+            sampler = Sampler(args.vocab_size, chunk_size)
+            greedy  = timeit(lambda: sampler(
+                embedding, hidden_states, positions, None, top_ps, top_ks), args.iters)
+            top_k   = timeit(lambda: sampler(
+                embedding, hidden_states, positions, temperatures, top_ps, top_ks), args.iters)
+            print(f"{batch_size:>5} {str(chunk_size or 'full'):>8} {greedy:>10.2f} {top_k:>10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocab_size", type=int, default=256000)
+    parser.add_argument("--hidden_size", type=int, default=2048)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--chunk_sizes", type=int, nargs="+", default=[8192, 32768])
+    parser.add_argument("--top_k", type=int, default=100)
+    parser.add_argument("--top_p", type=float, default=1.0)
+    parser.add_argument("--temperature", type=float, default=0.95)
+    parser.add_argument("--iters", type=int, default=10)
+    args = parser.parse_args()
+    main(args)
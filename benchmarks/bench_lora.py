@@ -0,0 +1,114 @@
+# Multi-LoRA serving: one base model + stacked adapters (rows of a batch use different adapters)
+# vs. one merged-weights model copy per adapter (rows grouped by adapter, one batch per copy).
+# python -m benchmarks.bench_lora --num_hidden_layers 2 --num_adapters 4 --rank 16 --batch_size 8
+import os
+import copy
+import json
+import time
+import argparse
+import tempfile
+import statistics
+
+import torch
+from safetensors.torch import save_file
+from source.config import *
+from source.gemma_torch import *
+from benchmarks.common import add_model_args, load_model
+
+
+LORA_TARGETS = ("q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj")
+
+
+def write_random_adapter(model, path: str, rank: int, seed: int):
+    # PEFT 형식 (adapter_model.safetensors + adapter_config.json), 모든 attention / MLP Linear 대상
+    generator = torch.Generator().manual_seed(seed)
+    tensors = {}
+    for name, module in model.named_modules():
+        if name.split(".")[-1] in LORA_TARGETS:
+            out_features, in_features = module.weight.shape
+            tensors[f"base_model.model.{name}.lora_A.weight"] = torch.randn(rank, in_features, generator=generator) * 0.02
+            tensors[f"base_model.model.{name}.lora_B.weight"] = torch.randn(out_features, rank, generator=generator) * 0.02
+    os.makedirs(path, exist_ok=True)
+    save_file(tensors, os.path.join(path, "adapter_model.safetensors"))
+    with open(os.path.join(path, "adapter_config.json"), "w") as f:
+        json.dump({"r": rank, "lora_alpha": 2 * rank, "target_modules": list(LORA_TARGETS)}, f)
+
+
+def merged_copy(model, name: str):
+    # base weight에 B @ A를 더한 독립된 모델 (adapter마다 전체 weight 사본)
+    merged = copy.deepcopy(model)
+    slot   = model.lora.ids[name]
+    for module in merged.modules():
+        if isinstance(module, Linear) and module.lora is not None:
+            module.weight.data.add_(module.lora.delta(slot))
+        if isinstance(module, Linear):
+            module.lora = None
+    merged.lora = None
+    return merged
+
+
+def param_bytes(model) -> int:
+    return sum(p.numel() * p.element_size() for p in model.parameters())
+
+
+def measure(jobs, args) -> float:
+    # jobs: (model, prompts, adapter). 요청마다 prefill + output_len 스텝을 차례로 실행한 wall time의 중앙값 (초)
+    elapsed = []
+    for i in range(args.warmup + args.repeats):
+        start = time.perf_counter()
+        for model, prompts, adapter in jobs:
+            stream = model.generate_stream(prompts, None, output_len=args.output_len, temperature=None, adapter=adapter)
+            for _ in stream:
+                pass
+        if i >= args.warmup:
+            elapsed.append(time.perf_counter() - start)
+    return statistics.median(elapsed)
+
+
+def main(args):
+    torch.set_num_threads(args.num_threads or torch.get_num_threads())
+    model   = load_model(args, dtype=args.dtype)
+    names   = [f"adapter{i}" for i in range(args.num_adapters)]
+    prompts = [[2] + list(range(3 + row, 2 + row + args.prompt_len)) for row in range(args.batch_size)]
+    rows    = [names[row % len(names)] for row in range(args.batch_size)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start = time.perf_counter()
+        for i, name in enumerate(names):
+            write_random_adapter(model, os.path.join(tmp_dir, name), args.rank, seed=i)
+            model.load_adapter(name, os.path.join(tmp_dir, name))
+        load_seconds = (time.perf_counter() - start) / len(names)
+    base_bytes = param_bytes(model)
+
+    results = []
+    results.append(("base", measure([(model, prompts, None)], args), base_bytes))
+    results.append(("multi-lora mixed", measure([(model, prompts, rows)], args), base_bytes + model.lora.nbytes()))
+    results.append(("multi-lora single", measure([(model, prompts, names[0])], args), base_bytes + model.lora.nbytes()))
+    # merged: adapter마다 모델 사본 하나, 같은 adapter의 행끼리 한 배치
+    copies = {name: merged_copy(model, name) for name in names}
+    jobs   = [(copies[name], [p for p, row in zip(prompts, rows) if row == name], None) for name in names]
+    results.append(("merged copies", measure([job for job in jobs if job[1]], args), len(names) * base_bytes))
+
+    print(f"variant={args.variant} layers={model.config.num_hidden_layers} adapters={args.num_adapters} rank={args.rank} "
+          f"batch_size={args.batch_size} prompt_len={args.prompt_len} output_len={args.output_len} dtype={args.dtype}")
+    print(f"adapter load {load_seconds * 1000:.1f} ms / adapter, {model.lora.nbytes() / 2**20:.1f} MiB for all adapters")
+    print(f"{'mode':>18} {'seconds':>9} {'tokens/s':>9} {'params MiB':>11}")
+    for mode, seconds, nbytes in results:
+        tokens_per_second = args.batch_size * args.output_len / seconds
+        print(f"{mode:>18} {seconds:>9.3f} {tokens_per_second:>9.1f} {nbytes / 2**20:>11.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_model_args(parser)
+    parser.set_defaults(num_hidden_layers=2)
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "bfloat16"])
+    parser.add_argument("--num_adapters", type=int, default=4)
+    parser.add_argument("--rank", type=int, default=16)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--prompt_len", type=int, default=32)
+    parser.add_argument("--output_len", type=int, default=16)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--num_threads", type=int, default=None)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,75 @@
+# Activation memory: peak RSS growth per generation step, default layer stack vs. config.low_memory.
+# python -m benchmarks.bench_memory --batch_size 8 --prompt_len 2048 --decode_steps 4
+import os
+import time
+import argparse
+
+import torch
+import torch.multiprocessing as mp
+from source.config import *
+from source.gemma_torch import *
+from benchmarks.common import add_model_args, load_model
+from benchmarks.bench_prefill import PeakRSS, current_rss
+
+
+def run(low_memory: bool, args, results):
+    # 모드마다 새 프로세스에서 측정하여 allocator에 남은 메모리의 영향을 받지 않는다.
+    model   = load_model(args, args.prompt_len + args.decode_steps, dtype=args.dtype, low_memory=low_memory)
+    prompts = [[2] + list(range(3 + row, 2 + row + args.prompt_len)) for row in range(args.batch_size)]
+    stream  = model.generate_stream(prompts, None, output_len=args.decode_steps + 1, temperature=None,
+                                    prefill_chunk_size=args.prefill_chunk_size)
+    before  = current_rss()
+    steps   = []
+    while True:
+        # 스텝마다 (KV 캐시 할당 포함) 로드 직후 대비 최대 RSS 증가량과 시간
+        with PeakRSS() as peak:
+            start = time.perf_counter()
+            step_tokens = next(stream, None)
+            elapsed = time.perf_counter() - start
+        if step_tokens is None:
+            break
+        steps.append((peak.peak - before, elapsed))
+    results.put(steps)
+
+
+def main(args):
+    # glibc가 해제된 큰 텐서를 heap에 남겨두면 RSS가 할당자의 최대값만 보여주므로,
+    # 측정 프로세스에서는 64KiB 이상의 할당을 mmap으로 하여 해제 즉시 RSS에서 빠지게 한다.
+    os.environ.setdefault("MALLOC_MMAP_THRESHOLD_", str(64 * 1024))
+    context = mp.get_context("spawn")
+    results = context.Manager().Queue()
+    print(f"variant={args.variant} layers={args.num_hidden_layers or 'all'} batch_size={args.batch_size} "
+          f"prompt_len={args.prompt_len} dtype={args.dtype}")
+    measured = {}
+    for mode in args.modes:
+        process = context.Process(target=run, args=(mode == "low_memory", args, results))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(f"{mode} run failed (exit code {process.exitcode})")
+        measured[mode] = results.get()
+
+    print(f"{'step':>8} " + " ".join(f"{mode + ' +MiB':>16} {'s':>7}" for mode in args.modes))
+    for i in range(max(len(steps) for steps in measured.values())):
+        name = "prefill" if i == 0 else f"decode{i}"
+        cells = []
+        for mode in args.modes:
+            peak_bytes, elapsed = measured[mode][i]
+            cells.append(f"{peak_bytes / 2**20:>16.1f} {elapsed:>7.2f}")
+        print(f"{name:>8} " + " ".join(cells))
+    if len(args.modes) == 2:
+        base, other = (max(peak for peak, _ in measured[mode]) for mode in args.modes)
+        print(f"peak {args.modes[1]} / {args.modes[0]}: {other / base:.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_model_args(parser)
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "bfloat16"])
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--prompt_len", type=int, default=2048)
+    parser.add_argument("--decode_steps", type=int, default=4)
+    parser.add_argument("--prefill_chunk_size", type=int, default=None)
+    parser.add_argument("--modes", type=str, nargs="+", default=["default", "low_memory"], choices=["default", "low_memory"])
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,175 @@
+# torch vs. MLX numerical parity per layer: max-abs / relative error of every submodule output per dtype.
+# 같은 랜덤 weight와 입력으로 prefill과 디코딩 한 스텝을 실행하고, 허용 오차를 넘는 레이어가 있으면 exit code 1
+# python -m benchmarks.bench_parity --variant 2b --num_hidden_layers 2 --dtypes float32 bfloat16
+import sys
+import argparse
+from typing import (
+    Callable,
+    Dict,
+    List,
+    Tuple
+    )
+
+import numpy as np
+import torch
+import mlx.core as mxc
+import mlx.nn as mx
+from source.config import *
+from source.gemma_torch import *
+from source.gemma_mlx import MLXGemmaForCausalLM
+from benchmarks.common import add_model_args, build_config, init_random
+
+
+# dtype별 허용 상대 오차 (max-abs / max(|torch|))
+DEFAULT_RTOL = {"float32": 1e-4, "bfloat16": 3e-2}
+
+
+class MLXRecorder(mx.Module):
+    # MLX에는 forward hook이 없으므로 submodule을 감싸서 출력을 기록한다.
+    def __init__(self, module: mx.Module, record: Callable):
+        super().__init__()
+        self.module  = module
+        self._record = record
+
+    def __call__(self, *args, **kwargs):
+        output = self.module(*args, **kwargs)
+        self._record(output)
+        return output
+
+
+def hook_torch(model: GemmaForCausalLM, outputs: Dict[str, np.ndarray]) -> list:
+    """
+    Registers forward hooks that copy each submodule output to float32 numpy.
+    fused RMSNorm은 (output, residual), 디코더 레이어는 (hidden_states, residual)을 반환하므로
+    RMSNorm은 output을, 레이어는 MLX 레이어의 출력과 같은 hidden_states + residual을 비교한다.
+    """
+    def hook(name: str, reduce: Callable):
+        def record(module, inputs, output):
+            outputs[name] = reduce(output).float().numpy().copy()
+        return record
+
+    first  = lambda output: output[0] if isinstance(output, tuple) else output
+    summed = lambda output: output[0] + output[1]
+    handles = [model.model.embed_tokens.register_forward_hook(hook("embedding", first))]
+    for i, layer in enumerate(model.model.layers):
+        for child in ("input_layernorm", "self_attn", "post_attention_layernorm", "mlp"):
+            handles.append(getattr(layer, child).register_forward_hook(hook(f"layers.{i}.{child}", first)))
+        handles.append(layer.register_forward_hook(hook(f"layers.{i}", summed)))
+    handles.append(model.model.norm.register_forward_hook(hook("norm", first)))
+    return handles
+
+
+def hook_mlx(model: MLXGemmaForCausalLM, outputs: Dict[str, np.ndarray]):
+    def recorder(module: mx.Module, name: str) -> MLXRecorder:
+        def record(output):
+            outputs[name] = np.array(output.astype(mxc.float32))
+        return MLXRecorder(module, record)
+
+    model.embedder = recorder(model.embedder, "embedding")
+    for i, layer in enumerate(model.model.layers):
+        for child in ("input_layernorm", "self_attn", "post_attention_layernorm", "mlp"):
+            setattr(layer, child, recorder(getattr(layer, child), f"layers.{i}.{child}"))
+        model.model.layers[i] = recorder(layer, f"layers.{i}")
+    model.model.norm = recorder(model.model.norm, "norm")
+
+
+def build_models(args, dtype: str) -> Tuple[GemmaForCausalLM, MLXGemmaForCausalLM]:
+    config = build_config(args, dtype=dtype, tokenizer=None, max_position_embeddings=args.prompt_len + args.decode_steps)
+    torch.manual_seed(args.seed)
+    with set_tensor_type(config.get_dtype()):
+        torch_model = GemmaForCausalLM(config)
+        if args.safetensors is not None:
+            torch_model.load_weights(args.safetensors)
+        else:
+            # RMSNorm weight도 0이 아닌 값이어야 scale 차이가 드러난다.
+            init_random(torch_model, args.init_std)
+    mlx_model = MLXGemmaForCausalLM(config).load_state_dict(torch_model.state_dict())
+    return torch_model.eval(), mlx_model
+
+
+@torch.no_grad()
+def run_steps(args, dtype: str) -> List[Tuple[str, Dict[str, np.ndarray], Dict[str, np.ndarray]]]:
+    """Runs the prefill and decode_steps single-token steps on both models; returns (step, torch outputs, mlx outputs)."""
+    torch_model, mlx_model = build_models(args, dtype)
+    config = torch_model.config
+    torch_outputs, mlx_outputs = {}, {}
+    hook_torch(torch_model, torch_outputs)
+    hook_mlx(mlx_model, mlx_outputs)
+
+    max_seq_len = args.prompt_len + args.decode_steps
+    size        = (args.batch_size, max_seq_len, config.num_key_value_heads, config.head_dim)
+    torch_caches = [(torch.zeros(size, dtype=config.get_dtype()), torch.zeros(size, dtype=config.get_dtype()))
+                    for _ in range(config.num_hidden_layers)]
+    mlx_dtype    = mxc.bfloat16 if dtype == "bfloat16" else mxc.float32
+    mlx_caches   = [(mxc.zeros(size, dtype=mlx_dtype), mxc.zeros(size, dtype=mlx_dtype))
+                    for _ in range(config.num_hidden_layers)]
+
+    generator = torch.Generator().manual_seed(args.seed)
+    token_ids = torch.randint(3, config.vocab_size, (args.batch_size, args.prompt_len), generator=generator)
+    positions = torch.arange(0, args.prompt_len, dtype=torch.int64)
+    steps = []
+    for step in range(args.decode_steps + 1):
+        mask = causal_mask(positions, max_seq_len)
+        torch_hidden = torch_model._hidden_states(token_ids, positions, torch_caches, mask)
+        mlx_hidden   = mlx_model._hidden_states(token_ids, positions, mlx_caches, mask)
+        # sampler가 계산하는 로짓: 마지막 위치의 hidden state와 tied embedding의 곱 (float32)
+        torch_logits = torch.cat([tile for _, tile in torch_model.sampler._logits_tiles(
+            torch_model.model.embed_tokens, torch_hidden[:, -1], None)], dim=-1)
+        torch_outputs["logits"] = torch_logits.float().numpy()
+        mlx_logits = mxc.matmul(mlx_hidden[:, -1], mlx_model.embedder.module.embedding.weight.T)
+        mlx_outputs["logits"] = np.array(mlx_logits.astype(mxc.float32))
+        steps.append(("prefill" if step == 0 else f"decode{step}", dict(torch_outputs), dict(mlx_outputs)))
+
+        # 두 구현이 같은 토큰을 이어 받도록 torch의 greedy 토큰을 다음 입력으로 사용
+        token_ids = torch_logits.argmax(dim=-1, keepdim=True)
+        positions = torch.tensor([args.prompt_len + step], dtype=torch.int64)
+    return steps
+
+
+def compare(torch_output: np.ndarray, mlx_output: np.ndarray) -> Tuple[float, float]:
+    max_abs = float(np.abs(torch_output - mlx_output).max())
+    scale   = float(np.abs(torch_output).max())
+    return max_abs, max_abs / scale if scale > 0 else max_abs
+
+
+def main(args):
+    failed = []
+    print(f"{'dtype':<9} {'step':<8} {'module':<34} {'shape':<18} {'max abs':>10} {'rel':>10}")
+    for dtype in args.dtypes:
+        rtol = args.rtol if args.rtol is not None else DEFAULT_RTOL[dtype]
+        for step, torch_outputs, mlx_outputs in run_steps(args, dtype):
+            # 기록된 순서 = forward 순서
+            for name in torch_outputs:
+                if name not in mlx_outputs:
+                    continue
+                if torch_outputs[name].shape != mlx_outputs[name].shape:
+                    failed.append((dtype, step, name))
+                    print(f"{dtype:<9} {step:<8} {name:<34} shape {torch_outputs[name].shape} != {mlx_outputs[name].shape}")
+                    continue
+                max_abs, rel = compare(torch_outputs[name], mlx_outputs[name])
+                flag = "" if rel <= rtol else "  <-- drift"
+                if flag:
+                    failed.append((dtype, step, name))
+                shape = "x".join(map(str, torch_outputs[name].shape))
+                print(f"{dtype:<9} {step:<8} {name:<34} {shape:<18} {max_abs:>10.3e} {rel:>10.3e}{flag}")
+    if failed:
+        dtype, step, name = failed[0]
+        print(f"{len(failed)} outputs exceed the tolerance; first drift: {dtype} {step} {name}")
+        sys.exit(1)
+    print("all outputs within tolerance")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_model_args(parser)
+    # 메모리를 줄이려면 레이어 수와 vocab 크기를 줄인다 (dims는 variant 그대로).
+    parser.set_defaults(num_hidden_layers=2)
+    parser.add_argument("--dtypes", type=str, nargs="+", default=["float32", "bfloat16"], choices=["float32", "bfloat16"])
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--prompt_len", type=int, default=16)
+    parser.add_argument("--decode_steps", type=int, default=1)
+    parser.add_argument("--init_std", type=float, default=0.02)
+    parser.add_argument("--rtol", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,61 @@
+# Pipeline-parallel throughput: tokens/sec for 2-4 local stages and micro-batch counts.
+# python -m benchmarks.bench_pipeline --variant 2b --stages 1 2 4 --micro_batches 1 4 --batch_size 8
+import time
+import argparse
+
+import torch
+import torch.multiprocessing as mp
+from source.config import *
+from source.pipeline_parallel import PipelineGenerator, build_stage_model
+from source.tensor_parallel import launch
+from benchmarks.common import add_model_args, build_config
+
+
+def bench_stage(stage: int, num_stages: int, args, num_micro_batches: int, results):
+    model_config = build_config(args, dtype="float32")
+    model = build_stage_model(model_config, stage, num_stages, args.safetensors)
+    if args.safetensors is None:
+        # 체크포인트 없이 처리량만 측정: 중간 stage의 임베딩은 사용하지 않으므로 초기화하지 않는다.
+        torch.manual_seed(0)
+        for name, param in model.named_parameters():
+            if name.startswith("model.embed_tokens.") and stage not in (0, num_stages - 1):
+                continue
+            torch.nn.init.normal_(param, std=0.02)
+
+    generator = PipelineGenerator(model, stage, num_stages)
+    prompts   = [list(range(3, 3 + args.prompt_len))] * args.batch_size
+    generate  = lambda: generator.generate(
+        prompts if stage == 0 else None, output_len=args.output_len, num_micro_batches=num_micro_batches)
+    generate() # warm-up
+    start = time.perf_counter()
+    generate()
+    elapsed = time.perf_counter() - start
+    if stage == 0:
+        results.put(args.batch_size * args.output_len / elapsed)
+
+
+def main(args):
+    results = mp.get_context("spawn").Manager().Queue()
+    print(f"variant={args.variant} batch_size={args.batch_size} output_len={args.output_len}")
+    print(f"{'stages':>6} {'micro':>5} {'tokens/sec':>11}")
+    port = args.port
+    for num_stages in args.stages:
+        for num_micro_batches in args.micro_batches:
+            port += 1
+            num_threads = args.num_threads or None
+            launch(bench_stage, num_stages, (args, num_micro_batches, results), port=port, num_threads=num_threads)
+            print(f"{num_stages:>6} {num_micro_batches:>5} {results.get():>11.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_model_args(parser)
+    parser.add_argument("--stages", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--micro_batches", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--num_threads", type=int, default=0)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--prompt_len", type=int, default=16)
+    parser.add_argument("--output_len", type=int, default=16)
+    parser.add_argument("--port", type=int, default=29600)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,80 @@
+# Chunked prefill: peak RSS growth and prefill time vs. prefill_chunk_size for a long prompt.
+# python -m benchmarks.bench_prefill --prompt_len 8192 --chunk_sizes 0 2048 512 128
+import os
+import time
+import argparse
+import threading
+
+import torch
+import torch.multiprocessing as mp
+from source.config import *
+from source.gemma_torch import *
+from benchmarks.common import add_model_args, load_model
+
+
+def current_rss() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+class PeakRSS:
+    # 별도 스레드에서 RSS를 주기적으로 읽어 with 블록 동안의 최대값을 기록
+    def __init__(self, interval: float = 0.001):
+        self.interval = interval
+        self.peak     = 0
+        self._stop    = threading.Event()
+
+    def _poll(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, current_rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.peak    = current_rss()
+        self._thread = threading.Thread(target=self._poll, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def run(chunk_size: int, args, results):
+    # chunk 크기마다 새 프로세스에서 측정하여 allocator에 남은 메모리의 영향을 받지 않는다.
+    model  = load_model(args, args.prompt_len + 1, dtype=args.dtype)
+    prompt = [[2] + list(range(3, 2 + args.prompt_len))]
+    before = current_rss()
+    with PeakRSS() as peak:
+        start = time.perf_counter()
+        for _ in model.generate_stream(prompt, None, output_len=1, temperature=None,
+                                       prefill_chunk_size=chunk_size or None):
+            pass
+        elapsed = time.perf_counter() - start
+    results.put((peak.peak - before, elapsed))
+
+
+def main(args):
+    context = mp.get_context("spawn")
+    results = context.Manager().Queue()
+    print(f"variant={args.variant} prompt_len={args.prompt_len} dtype={args.dtype}")
+    print(f"{'chunk':>6} {'peak RSS +MiB':>14} {'prefill s':>10}")
+    for chunk_size in args.chunk_sizes:
+        process = context.Process(target=run, args=(chunk_size, args, results))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(f"prefill with chunk size {chunk_size} failed (exit code {process.exitcode})")
+        peak_bytes, elapsed = results.get()
+        print(f"{str(chunk_size or 'full'):>6} {peak_bytes / 2**20:>14.1f} {elapsed:>10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_model_args(parser)
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "bfloat16"])
+    parser.add_argument("--prompt_len", type=int, default=8192)
+    parser.add_argument("--chunk_sizes", type=int, nargs="+", default=[0, 2048, 512, 128])
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,60 @@
+# Batched per-request sampling: latency per row as the batch grows.
+# python -m benchmarks.bench_sampler --batch_sizes 1 4 16 64
+import time
+import argparse
+
+import torch
+from source.gemma_torch import Sampler, SamplingPenalties
+
+
+def timeit(fn, iters: int) -> float:
+    fn()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def mixed_batch(batch_size: int, vocab_size: int):
+    # 행마다 다른 temperature (0이면 greedy), top-p, top-k와 패널티
+    temperatures = torch.tensor([[0.0, 0.7, 1.0, 1.3][i % 4] for i in range(batch_size)])
+    top_ps       = torch.tensor([[1.0, 0.9, 0.95, 0.8][i % 4] for i in range(batch_size)])
+    top_ks       = torch.tensor([[1, 50, 100, 20][i % 4] for i in range(batch_size)], dtype=torch.int64)
+    penalties = SamplingPenalties(
+        repetition_penalties=torch.full((batch_size,), 1.1),
+        frequency_penalties=torch.full((batch_size,), 0.2),
+        presence_penalties=torch.full((batch_size,), 0.1),
+        output_token_counts=torch.randint(0, 3, (batch_size, vocab_size), dtype=torch.int32),
+        prompt_token_mask=torch.rand(batch_size, vocab_size) < 0.001,
+        )
+    embedding_bias = torch.zeros(batch_size, vocab_size)
+    embedding_bias[:, :10] = -100.0
+    return temperatures, top_ps, top_ks, penalties, embedding_bias
+
+
+def main(args):
+    torch.manual_seed(0)
+    embedding = torch.randn(args.vocab_size, args.hidden_size) * 0.02
+    positions = torch.tensor([0])
+    print(f"vocab_size={args.vocab_size} hidden_size={args.hidden_size}")
+    print(f"{'batch':>5} {'chunk':>8} {'step ms':>9} {'per row ms':>11}")
+    for batch_size in args.batch_sizes:
+        hidden_states = torch.randn(batch_size, 1, args.hidden_size)
+        temperatures, top_ps, top_ks, penalties, embedding_bias = mixed_batch(batch_size, args.vocab_size)
+        for chunk_size in [None] + args.chunk_sizes:
+            sampler = Sampler(args.vocab_size, chunk_size)
+            step_ms = timeit(lambda: sampler(
+                embedding, hidden_states, positions, temperatures, top_ps, top_ks,
+                embedding_bias=embedding_bias, penalties=penalties), args.iters)
+            print(f"{batch_size:>5} {str(chunk_size or 'full'):>8} {step_ms:>9.2f} {step_ms / batch_size:>11.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocab_size", type=int, default=256000)
+    parser.add_argument("--hidden_size", type=int, default=2048)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--chunk_sizes", type=int, nargs="+", default=[32768])
+    parser.add_argument("--iters", type=int, default=10)
+    args = parser.parse_args()
+    main(args)
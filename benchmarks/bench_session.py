@@ -0,0 +1,58 @@
+# Short-request latency: generate_stream with freshly allocated buffers vs. a reused GenerationSession.
+# 서버처럼 max_tokens만큼 KV 캐시를 잡고 output_len개의 토큰 (EOS 등)에서 멈추는 요청을 반복한다.
+# python -m benchmarks.bench_session --prompt_len 8 --output_len 8 --max_tokens 512 --batch_sizes 1 8 --requests 50
+import time
+import argparse
+import statistics
+
+import torch
+from source.config import *
+from source.gemma_torch import *
+from benchmarks.common import add_model_args, load_model
+
+
+def measure(model, prompts, args, session) -> list:
+    # 요청마다 prefill + output_len 스텝의 wall time (ms)
+    latencies = []
+    for i in range(args.warmup + args.requests):
+        start  = time.perf_counter()
+        stream = model.generate_stream(prompts, None, output_len=args.max_tokens, temperature=None, session=session)
+        for _, step_tokens in zip(range(args.output_len), stream):
+            pass
+        stream.close()
+        if i >= args.warmup:
+            latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def main(args):
+    torch.set_num_threads(args.num_threads or torch.get_num_threads())
+    model = load_model(args, dtype=args.dtype)
+    print(f"variant={args.variant} layers={model.config.num_hidden_layers} prompt_len={args.prompt_len} "
+          f"output_len={args.output_len} max_tokens={args.max_tokens} requests={args.requests} dtype={args.dtype}")
+    print(f"{'batch':>5} {'mode':>8} {'p50 ms':>9} {'p90 ms':>9} {'mean ms':>9}")
+    for batch_size in args.batch_sizes:
+        prompts = [[2] + list(range(3 + row, 2 + row + args.prompt_len)) for row in range(batch_size)]
+        medians = {}
+        for mode in ("fresh", "session"):
+            session   = GenerationSession(model.config) if mode == "session" else None
+            latencies = sorted(measure(model, prompts, args, session))
+            medians[mode] = statistics.median(latencies)
+            p90 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.9))]
+            print(f"{batch_size:>5} {mode:>8} {medians[mode]:>9.2f} {p90:>9.2f} {statistics.mean(latencies):>9.2f}")
+        print(f"{batch_size:>5} {'speedup':>8} {medians['fresh'] / medians['session']:>9.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_model_args(parser)
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "bfloat16"])
+    parser.add_argument("--prompt_len", type=int, default=8)
+    parser.add_argument("--output_len", type=int, default=8)
+    parser.add_argument("--max_tokens", type=int, default=512)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--num_threads", type=int, default=None)
+    args = parser.parse_args()
+    main(args)
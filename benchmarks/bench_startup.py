@@ -0,0 +1,98 @@
+# Cold start: run-gemma.py in a fresh process, import / tokenizer / model init / weight load / first token,
+# shard 체크포인트를 변환하는 cold 시작, --warm_start 파일을 읽는 warm 시작, pack-gemma.py snapshot을 mmap하는 packed 시작을 비교한다.
+# 체크포인트가 없으면 랜덤 bfloat16 weight로 config.json + 2개 shard 디렉토리를 만든다.
+# python -m benchmarks.bench_startup --tokenizer model/gemma-1.1-2b-it/tokenizer.model --num_hidden_layers 2 --repeats 3
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+import torch
+from safetensors.torch import save_file
+from source.config import *
+from source.gemma_torch import *
+from benchmarks.common import add_model_args, build_config, init_random
+
+
+def write_random_checkpoint(args, model_dir: str):
+    # HF 디렉토리 형식: config.json, tokenizer.model, bfloat16 shard 2개 (index 없이 *.safetensors)
+    model_config = build_config(args, dtype="bfloat16", tokenizer=None)
+    with set_tensor_type(torch.bfloat16):
+        model = GemmaForCausalLM(model_config)
+        init_random(model)
+    tensors = {key: value.contiguous() for key, value in model.state_dict().items()}
+    keys    = list(tensors)
+    for i, shard in enumerate((keys[:len(keys) // 2], keys[len(keys) // 2:])):
+        save_file({key: tensors[key] for key in shard}, os.path.join(model_dir, f"model-{i + 1:05d}-of-00002.safetensors"))
+    values = {field: getattr(model_config, field) for field in CONFIG_JSON_KEYS if field not in ("dtype", "quant")}
+    values.update(model_type="gemma", torch_dtype="bfloat16")
+    with open(os.path.join(model_dir, "config.json"), "w") as f:
+        json.dump(values, f, indent=2)
+    os.symlink(os.path.abspath(args.tokenizer), os.path.join(model_dir, "tokenizer.model"))
+
+
+def run(args, variant: str, safetensors: str, warm_start, timings_path: str) -> dict:
+    # 새 프로세스의 인터프리터 시작부터 종료까지 (process)와 run-gemma.py가 기록한 단계별 시간
+    command = [sys.executable, "run-gemma.py", "--backend", args.backend, "--variant", variant,
+               "--safetensors", safetensors, "--dtype", args.dtype, "--output_len", str(args.output_len),
+               "--timings", timings_path]
+    if warm_start is not None:
+        command += ["--warm_start", warm_start]
+    start = time.perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    elapsed = time.perf_counter() - start
+    with open(timings_path) as f:
+        phases = json.load(f)
+    phases["process"] = elapsed
+    return phases
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.safetensors is None:
+            write_random_checkpoint(args, tmp_dir)
+            variant, safetensors = tmp_dir, tmp_dir
+        else:
+            variant, safetensors = args.variant, args.safetensors
+        warm_start   = os.path.join(tmp_dir, "warm_start.safetensors")
+        packed       = os.path.join(tmp_dir, "model.pack")
+        timings_path = os.path.join(tmp_dir, "timings.json")
+
+        # warm 시작 파일과 snapshot은 측정 전에 한 번 만든다. 모든 모드가 같은 page cache 상태에서 읽도록 cold도 한 번 먼저 실행한다.
+        run(args, variant, safetensors, warm_start, timings_path)
+        subprocess.run([sys.executable, "pack-gemma.py", "--variant", variant, "--safetensors", safetensors,
+                        "--dtype", args.dtype, "--output", packed], check=True, stdout=subprocess.DEVNULL)
+        measured = {"cold": [], "warm": [], "packed": []}
+        for _ in range(args.repeats):
+            measured["cold"].append(run(args, variant, safetensors, None, timings_path))
+            measured["warm"].append(run(args, variant, safetensors, warm_start, timings_path))
+            measured["packed"].append(run(args, variant, packed, None, timings_path))
+
+    print(f"backend={args.backend} variant={args.variant} layers={args.num_hidden_layers or 'all'} "
+          f"dtype={args.dtype} repeats={args.repeats} (median seconds)")
+    print(f"{'phase':>16} " + " ".join(f"{mode:>9}" for mode in measured))
+    phases = []
+    for runs in measured.values():
+        phases += [phase for phase in runs[0] if phase not in phases]
+    for phase in phases:
+        cells = []
+        for runs in measured.values():
+            values = [timings[phase] for timings in runs if phase in timings]
+            cells.append(f"{statistics.median(values):>9.3f}" if values else f"{'-':>9}")
+        print(f"{phase:>16} " + " ".join(cells))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", type=str, default="torch", choices=["torch", "mlx"])
+    add_model_args(parser)
+    parser.set_defaults(tokenizer="model/gemma-1.1-2b-it/tokenizer.model", num_hidden_layers=2)
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "bfloat16"])
+    parser.add_argument("--output_len", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,315 @@
+# Benchmark suite: load time, prefill / decode tokens/sec, sampler latency and peak RSS for the torch and MLX models.
+# 체크포인트 없이 랜덤 weight로 실행하며, 결과를 JSON으로 저장하여 커밋 사이의 회귀를 비교한다.
+# python -m benchmarks.bench_suite --variants 2b --num_hidden_layers 2 --output bench.json
+# python -m benchmarks.bench_suite --compare bench-old.json bench.json
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import subprocess
+from typing import (
+    Any,
+    Dict,
+    List
+    )
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from source.config import *
+from source.gemma_torch import *
+from benchmarks.common import init_random
+
+
+def mlx_available() -> bool:
+    try:
+        import mlx.core
+    except ImportError:
+        return False
+    return True
+
+
+def peak_rss_mib() -> float:
+    # ru_maxrss는 Linux에서 KiB, macOS에서 byte
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def get_config(args, variant: str) -> GemmaConfig:
+    config = get_model_config(variant)
+    config.dtype     = args.dtype
+    config.tokenizer = None
+    if args.num_hidden_layers is not None:
+        config.num_hidden_layers = args.num_hidden_layers
+    config.max_position_embeddings = max(max(args.prompt_lens), args.decode_prompt_len + args.decode_steps + 1)
+    return config
+
+
+def timeit(fn, iters: int) -> float:
+    # 한 번 warm-up 후 평균 초
+    fn()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    return (time.perf_counter() - start) / iters
+
+
+class TorchBackend:
+    name = "torch"
+
+    def __init__(self, config: GemmaConfig, safetensors_path=None):
+        self.config = config
+        with set_tensor_type(config.get_dtype()):
+            self.model = GemmaForCausalLM(config)
+            if safetensors_path is not None:
+                self.model.load_weights(safetensors_path)
+            else:
+                init_random(self.model)
+        self.model.eval()
+
+    def kv_caches(self, batch_size: int, max_seq_len: int):
+        size, dtype = (batch_size, max_seq_len, self.config.num_key_value_heads, self.config.head_dim), self.config.get_dtype()
+        return [(torch.zeros(size, dtype=dtype), torch.zeros(size, dtype=dtype)) for _ in range(self.config.num_hidden_layers)]
+
+    def step(self, token_ids: torch.Tensor, positions: torch.Tensor, kv_caches, max_seq_len: int):
+        # forward 한 번 + greedy 샘플링 (마지막 위치)
+        batch_size = token_ids.shape[0]
+        return self.model(
+            input_token_ids=token_ids,
+            input_positions=positions,
+            kv_write_indices=None,
+            kv_caches=kv_caches,
+            mask=causal_mask(positions, max_seq_len),
+            output_positions=torch.tensor([positions.shape[0] - 1]),
+            temperatures=None,
+            top_ps=torch.ones(batch_size),
+            top_ks=torch.ones(batch_size, dtype=torch.int64),
+            )
+
+    def sample(self, hidden_states: torch.Tensor, temperature) -> Any:
+        batch_size = hidden_states.shape[0]
+        return self.model.sampler(
+            embedding=self.model.model.embed_tokens,
+            hidden_states=hidden_states.type(self.config.get_dtype()),
+            output_positions=torch.tensor([0]),
+            temperatures=None if temperature is None else torch.full((batch_size,), temperature),
+            top_ps=torch.full((batch_size,), 0.95),
+            top_ks=torch.full((batch_size,), 100, dtype=torch.int64),
+            )
+
+
+class MLXBackend:
+    name = "mlx"
+
+    def __init__(self, config: GemmaConfig, safetensors_path=None):
+        import mlx.core as mxc
+        from mlx.utils import tree_flatten
+        from source.gemma_mlx import MLXGemmaForCausalLM
+        self.mxc    = mxc
+        self.config = config
+        self.model  = MLXGemmaForCausalLM(config)
+        if safetensors_path is not None:
+            self.model.load_torch_weights(safetensors_path)
+        else:
+            # torch와 같은 분포의 랜덤 weight (torch 모델을 거치지 않아 RSS에 사본이 남지 않는다)
+            dtype   = mxc.bfloat16 if config.dtype == "bfloat16" else mxc.float32
+            weights = [(key, (mxc.random.normal(value.shape) * 0.02).astype(dtype))
+                       for key, value in tree_flatten(self.model.parameters()) if key != "freqs_cis"]
+            self.model.load_weights(weights, strict=False)
+        self.mxc.eval(self.model.parameters())
+
+    def kv_caches(self, batch_size: int, max_seq_len: int):
+        size  = (batch_size, max_seq_len, self.config.num_key_value_heads, self.config.head_dim)
+        dtype = self.mxc.bfloat16 if self.config.dtype == "bfloat16" else self.mxc.float32
+        return [(self.mxc.zeros(size, dtype=dtype), self.mxc.zeros(size, dtype=dtype)) for _ in range(self.config.num_hidden_layers)]
+
+    def step(self, token_ids: torch.Tensor, positions: torch.Tensor, kv_caches, max_seq_len: int):
+        # MLX는 lazy evaluation이므로 토큰과 KV 캐시를 eval 해야 시간이 측정된다.
+        batch_size  = token_ids.shape[0]
+        next_tokens = self.model(
+            input_token_ids=token_ids,
+            input_positions=positions,
+            kv_write_indices=None,
+            kv_caches=kv_caches,
+            mask=causal_mask(positions, max_seq_len),
+            output_positions=torch.tensor([positions.shape[0] - 1]),
+            temperatures=None,
+            top_ps=torch.ones(batch_size),
+            top_ks=torch.ones(batch_size, dtype=torch.int64),
+            )
+        self.mxc.eval(next_tokens, kv_caches)
+        return torch.tensor(np.array(next_tokens))
+
+    def sample(self, hidden_states: torch.Tensor, temperature) -> Any:
+        batch_size = hidden_states.shape[0]
+        next_tokens = self.model.sampler(
+            embedding=self.model.embedder.embedding.weight,
+            hidden_states=self.mxc.array(hidden_states.numpy()),
+            output_positions=self.mxc.array([0]),
+            temperatures=None if temperature is None else self.mxc.full((batch_size,), temperature),
+            top_ps=self.mxc.full((batch_size,), 0.95),
+            top_ks=self.mxc.full((batch_size,), 100),
+            )
+        self.mxc.eval(next_tokens)
+        return next_tokens
+
+
+BACKENDS = {"torch": TorchBackend, "mlx": MLXBackend}
+
+
+@torch.no_grad()
+def measure(backend_name: str, variant: str, args) -> Dict:
+    config  = get_config(args, variant)
+    start   = time.perf_counter()
+    backend = BACKENDS[backend_name](config, args.safetensors)
+    result  = {
+        "backend": backend_name,
+        "variant": variant,
+        "dtype": config.dtype,
+        "num_hidden_layers": config.num_hidden_layers,
+        "load_s": time.perf_counter() - start,
+        "prefill_tokens_per_sec": {},
+        "decode_tokens_per_sec": {},
+        "sampler_ms": {},
+        }
+    generator = torch.Generator().manual_seed(0)
+
+    # prefill: batch 1, prompt_len 토큰을 한 번의 forward로
+    for prompt_len in args.prompt_lens:
+        token_ids = torch.randint(3, config.vocab_size, (1, prompt_len), generator=generator)
+        positions = torch.arange(0, prompt_len, dtype=torch.int64)
+        kv_caches = backend.kv_caches(1, prompt_len)
+        elapsed   = timeit(lambda: backend.step(token_ids, positions, kv_caches, prompt_len), args.iters)
+        result["prefill_tokens_per_sec"][str(prompt_len)] = prompt_len / elapsed
+
+    # decode: batch_size행이 decode_prompt_len 토큰 뒤에서 decode_steps 스텝 동안 한 토큰씩
+    for batch_size in args.batch_sizes:
+        max_seq_len = args.decode_prompt_len + args.decode_steps + 1
+        kv_caches   = backend.kv_caches(batch_size, max_seq_len)
+        token_ids   = torch.randint(3, config.vocab_size, (batch_size, args.decode_prompt_len), generator=generator)
+        next_tokens = backend.step(token_ids, torch.arange(0, args.decode_prompt_len), kv_caches, max_seq_len)
+        start = time.perf_counter()
+        for position in range(args.decode_prompt_len, args.decode_prompt_len + args.decode_steps):
+            next_tokens = backend.step(next_tokens.view(batch_size, 1), torch.tensor([position]), kv_caches, max_seq_len)
+        result["decode_tokens_per_sec"][str(batch_size)] = batch_size * args.decode_steps / (time.perf_counter() - start)
+
+    # sampler: LM head + greedy 또는 temperature / top-p / top-k
+    for batch_size in args.batch_sizes:
+        hidden_states = torch.randn(batch_size, 1, config.hidden_size, generator=generator)
+        for mode, temperature in (("greedy", None), ("top_p", 0.8)):
+            elapsed = timeit(lambda: backend.sample(hidden_states, temperature), args.iters)
+            result["sampler_ms"][f"{mode}/{batch_size}"] = elapsed * 1000
+
+    result["peak_rss_mib"] = peak_rss_mib()
+    return result
+
+
+def run(backend_name: str, variant: str, args, results):
+    # 조합마다 새 프로세스에서 측정하여 peak RSS가 섞이지 않는다.
+    torch.manual_seed(0)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    results.put(measure(backend_name, variant, args))
+
+
+def metadata(args) -> Dict:
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    meta = {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+        "torch": torch.__version__,
+        "num_threads": args.num_threads or torch.get_num_threads(),
+        "args": vars(args),
+        }
+    if mlx_available():
+        import mlx.core as mxc
+        meta["mlx"] = mxc.__version__
+    return meta
+
+
+def print_result(result: Dict):
+    prefill = " ".join(f"{k}:{v:.0f}" for k, v in result["prefill_tokens_per_sec"].items())
+    decode  = " ".join(f"{k}:{v:.1f}" for k, v in result["decode_tokens_per_sec"].items())
+    sampler = " ".join(f"{k}:{v:.2f}" for k, v in result["sampler_ms"].items())
+    print(f"[{result['backend']} {result['variant']} {result['dtype']} layers={result['num_hidden_layers']}] "
+          f"load {result['load_s']:.2f}s, peak RSS {result['peak_rss_mib']:.0f} MiB")
+    print(f"  prefill tok/s (len)   {prefill}")
+    print(f"  decode tok/s (batch)  {decode}")
+    print(f"  sampler ms (mode/bs)  {sampler}")
+
+
+def flatten(result: Dict) -> Dict[str, float]:
+    values = {"load_s": result["load_s"], "peak_rss_mib": result["peak_rss_mib"]}
+    for group in ("prefill_tokens_per_sec", "decode_tokens_per_sec", "sampler_ms"):
+        for key, value in result[group].items():
+            values[f"{group}/{key}"] = value
+    return values
+
+
+def compare(old_path: str, new_path: str):
+    # 같은 (backend, variant, dtype, layers)의 지표를 비율로 비교 (tokens/sec는 클수록, 나머지는 작을수록 좋다)
+    with open(old_path) as f:
+        old = {(r["backend"], r["variant"], r["dtype"], r["num_hidden_layers"]): r for r in json.load(f)["results"]}
+    with open(new_path) as f:
+        new = json.load(f)["results"]
+    for result in new:
+        key = (result["backend"], result["variant"], result["dtype"], result["num_hidden_layers"])
+        if key not in old:
+            continue
+        print(" ".join(map(str, key)))
+        old_values = flatten(old[key])
+        for name, value in flatten(result).items():
+            if name in old_values and old_values[name] > 0:
+                print(f"  {name:<36} {old_values[name]:>10.2f} -> {value:>10.2f} ({value / old_values[name]:.2f}x)")
+
+
+def main(args):
+    if args.compare is not None:
+        compare(*args.compare)
+        return
+    backends = args.backends or (["torch", "mlx"] if mlx_available() else ["torch"])
+    context  = mp.get_context("spawn")
+    results  = context.Manager().Queue()
+    output: List[Dict] = []
+    for backend_name in backends:
+        for variant in args.variants:
+            process = context.Process(target=run, args=(backend_name, variant, args, results))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError(f"{backend_name} {variant} failed (exit code {process.exitcode})")
+            output.append(results.get())
+            print_result(output[-1])
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"meta": metadata(args), "results": output}, f, indent=2)
+        print(f"saved {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backends", type=str, nargs="+", default=None, choices=["torch", "mlx"])
+    parser.add_argument("--variants", type=str, nargs="+", default=["2b"], help="2b, 7b or a model directory with config.json")
+    parser.add_argument("--safetensors", type=str, default=None)
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "bfloat16"])
+    # 메모리가 부족하면 레이어 수를 줄인 config로 측정 (레이어당 지표는 레이어 수에 비례)
+    parser.add_argument("--num_hidden_layers", type=int, default=None)
+    parser.add_argument("--prompt_lens", type=int, nargs="+", default=[16, 128, 512])
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--decode_prompt_len", type=int, default=16)
+    parser.add_argument("--decode_steps", type=int, default=16)
+    parser.add_argument("--iters", type=int, default=3)
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument("--output", type=str, default=None)
+    parser.add_argument("--compare", type=str, nargs=2, default=None, metavar=("OLD", "NEW"))
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,56 @@
+# Tensor-parallel scaling: decode tokens/sec for 1 / 2 / 4 local gloo ranks.
+# python -m benchmarks.bench_tensor_parallel --variant 7b --world_sizes 1 2 4
+import time
+import argparse
+
+import torch
+import torch.multiprocessing as mp
+from source.config import *
+from source.tensor_parallel import build_tensor_parallel_model, launch
+from benchmarks.common import add_model_args, build_config, init_random
+
+
+def bench_rank(rank: int, world_size: int, args, results):
+    model_config = build_config(args, dtype="float32")
+    model = build_tensor_parallel_model(model_config, rank, world_size, args.safetensors)
+    if args.safetensors is None:
+        # 체크포인트 없이 처리량만 측정: 복제되는 임베딩이 rank마다 같도록 같은 seed로 초기화
+        torch.manual_seed(0)
+        init_random(model)
+
+    prompt_tokens = [list(range(3, 3 + args.prompt_len))] * args.batch_size
+    generate = lambda: model.generate(prompt_tokens, None, output_len=args.output_len, temperature=None)
+    generate() # warm-up
+    start = time.perf_counter()
+    generate()
+    elapsed = time.perf_counter() - start
+    if rank == 0:
+        results.put(args.batch_size * args.output_len / elapsed)
+
+
+def main(args):
+    results = mp.get_context("spawn").Manager().Queue()
+    print(f"variant={args.variant} batch_size={args.batch_size} output_len={args.output_len}")
+    print(f"{'ranks':>5} {'threads':>7} {'tokens/sec':>11} {'speedup':>8}")
+    baseline = None
+    for world_size in args.world_sizes:
+        num_threads = args.num_threads or None
+        launch(bench_rank, world_size, (args, results), port=args.port + world_size, num_threads=num_threads)
+        tokens_per_sec = results.get()
+        baseline = baseline or tokens_per_sec
+        threads = num_threads or "auto"
+        print(f"{world_size:>5} {threads:>7} {tokens_per_sec:>11.2f} {tokens_per_sec / baseline:>7.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_model_args(parser)
+    parser.set_defaults(variant="7b")
+    parser.add_argument("--world_sizes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--num_threads", type=int, default=0)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--prompt_len", type=int, default=16)
+    parser.add_argument("--output_len", type=int, default=16)
+    parser.add_argument("--port", type=int, default=29500)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,58 @@
+# Tokenizer front-end throughput: per-string loop vs batched / prefix-cached encoding.
+# python -m benchmarks.bench_tokenizer --num_prompts 10000
+import time
+import random
+import argparse
+
+from source.tokenizer import Tokenizer
+
+
+SYSTEM_PROMPT = "<start_of_turn>user\n"
+WORDS = ("the meaning of life is a poem about machine learning and the capital of france "
+         "write me a short story explain how transformers work in simple terms").split()
+
+
+def make_prompts(num_prompts: int, seed: int):
+    rng = random.Random(seed)
+    return [" ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 64))) for _ in range(num_prompts)]
+
+
+def timeit(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def main(args):
+    tokenizer = Tokenizer(args.tokenizer, num_threads=args.num_threads)
+    prompts   = make_prompts(args.num_prompts, args.seed)
+    templated = [SYSTEM_PROMPT + p for p in prompts]
+
+    loop_sec, loop_tokens   = timeit(lambda: [tokenizer.encode(p) for p in templated])
+    batch_sec, batch_tokens = timeit(lambda: tokenizer.encode_batch(templated))
+    assert loop_tokens == batch_tokens
+    prefix_sec, _ = timeit(lambda: tokenizer.encode_batch(prompts, prefix=SYSTEM_PROMPT))
+    decode_loop_sec, texts = timeit(lambda: [tokenizer.decode(t) for t in batch_tokens])
+    decode_batch_sec, batch_texts = timeit(lambda: tokenizer.decode_batch(batch_tokens))
+    assert texts == batch_texts
+
+    num_tokens = sum(len(t) for t in batch_tokens)
+    print(f"prompts={args.num_prompts} tokens={num_tokens} threads={args.num_threads}")
+    for name, sec in [
+        ("encode loop", loop_sec),
+        ("encode_batch", batch_sec),
+        ("encode_batch + prefix cache", prefix_sec),
+        ("decode loop", decode_loop_sec),
+        ("decode_batch", decode_batch_sec),
+        ]:
+        print(f"{name:<28} {sec * 1000:>9.1f} ms {args.num_prompts / sec:>12.0f} prompts/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokenizer", type=str, default="model/gemma-1.1-2b-it/tokenizer.model")
+    parser.add_argument("--num_prompts", type=int, default=10000)
+    parser.add_argument("--num_threads", type=int, default=-1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,68 @@
+# Data-parallel worker pool: aggregate tokens/sec vs. worker count over one shared copy of the weights.
+# python -m benchmarks.bench_workers --workers 1 2 4 --num_requests 32 --max_tokens 32
+import time
+import argparse
+
+import torch
+from source.config import *
+from source.gemma_torch import *
+from benchmarks.common import add_model_args, load_model
+from source.server import GenerationRequest
+from source.worker_pool import WorkerPool
+
+
+def run(pool: WorkerPool, args) -> float:
+    generator = torch.Generator().manual_seed(0)
+    requests  = [
+        GenerationRequest(
+            prompt_tokens=torch.randint(3, 1000, (args.prompt_len,), generator=generator).tolist(),
+            max_tokens=args.max_tokens,
+            temperature=None,
+            )
+        for _ in range(args.num_requests)
+        ]
+    start = time.perf_counter()
+    for request in requests:
+        assert pool.submit(request)
+    num_tokens = 0
+    for request in requests:
+        while True:
+            token = request.tokens.get()
+            if token is None:
+                break
+            if isinstance(token, Exception):
+                raise token
+            num_tokens += 1
+    return num_tokens / (time.perf_counter() - start)
+
+
+def main(args):
+    model = load_model(args, dtype="float32")
+    param_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+    print(f"weights: {param_bytes / 2**30:.2f} GiB shared by all workers")
+    print(f"{'workers':>7} {'threads':>7} {'tokens/sec':>11}")
+    for num_workers in args.workers:
+        pool = WorkerPool(
+            model, torch.device("cpu"), num_workers,
+            threads_per_worker=args.threads_per_worker,
+            max_batch_size=args.max_batch_size,
+            max_queue_size=args.num_requests,
+            )
+        run(pool, args) # warm-up
+        tokens_per_sec = run(pool, args)
+        pool.close()
+        threads = args.threads_per_worker or "auto"
+        print(f"{num_workers:>7} {threads:>7} {tokens_per_sec:>11.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_model_args(parser)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--threads_per_worker", type=int, default=None)
+    parser.add_argument("--max_batch_size", type=int, default=1)
+    parser.add_argument("--num_requests", type=int, default=16)
+    parser.add_argument("--prompt_len", type=int, default=16)
+    parser.add_argument("--max_tokens", type=int, default=16)
+    args = parser.parse_args()
+    main(args)
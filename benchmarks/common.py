@@ -0,0 +1,52 @@
+# Shared helpers of the benchmarks: the model arguments and a checkpoint or random-weight model.
+import argparse
+
+import torch
+from source.config import *
+from source.gemma_torch import GemmaForCausalLM
+
+
+def add_model_args(parser: argparse.ArgumentParser):
+    # 벤치마크마다 다른 기본값은 parser.set_defaults로 바꾼다.
+    parser.add_argument("--safetensors", type=str, default=None, help="checkpoint; random weights if not given")
+    parser.add_argument("--tokenizer", type=str, default=None)
+    parser.add_argument("--variant", type=str, default="2b", help="2b, 7b or a model directory with config.json")
+    parser.add_argument("--num_hidden_layers", type=int, default=None)
+    # 랜덤 weight에서 LM head가 지연 시간을 지배하지 않도록 vocab을 줄인다.
+    parser.add_argument("--vocab_size", type=int, default=None)
+
+
+def build_config(args, max_seq_len: int = 0, **overrides) -> GemmaConfig:
+    """
+    The variant's config with the --tokenizer / --num_hidden_layers / --vocab_size arguments and overrides applied.
+    max_position_embeddings가 max_seq_len보다 작으면 max_seq_len으로 늘린다 (긴 프롬프트 측정).
+    """
+    model_config = get_model_config(args.variant)
+    model_config.max_position_embeddings = max(model_config.max_position_embeddings, max_seq_len)
+    if getattr(args, "tokenizer", None) is not None:
+        model_config.tokenizer = args.tokenizer
+    if getattr(args, "num_hidden_layers", None) is not None:
+        model_config.num_hidden_layers = args.num_hidden_layers
+    if getattr(args, "vocab_size", None) is not None:
+        model_config.vocab_size = args.vocab_size
+    for name, value in overrides.items():
+        setattr(model_config, name, value)
+    return model_config
+
+
+def init_random(model: torch.nn.Module, std: float = 0.02):
+    # 체크포인트 없이 속도 / 메모리만 측정: 랜덤 weight (RMSNorm weight도 0이 아니다)
+    for param in model.parameters():
+        torch.nn.init.normal_(param, std=std)
+
+
+def load_model(args, max_seq_len: int = 0, **overrides) -> GemmaForCausalLM:
+    """Builds the model of build_config(args, max_seq_len, **overrides) and loads --safetensors, or random weights without it."""
+    model_config = build_config(args, max_seq_len, **overrides)
+    with set_tensor_type(model_config.get_dtype()):
+        model = GemmaForCausalLM(model_config)
+        if args.safetensors is not None:
+            model.load_weights(args.safetensors)
+        else:
+            init_random(model)
+    return model.eval()
@@ -0,0 +1,100 @@
+# Load test for serve-gemma.py: throughput and latency percentiles under concurrency.
+# python -m benchmarks.load_test --url http://127.0.0.1:8000 --concurrency 8 --num_requests 64 --stream
+import json
+import time
+import argparse
+import threading
+import urllib.error
+import urllib.request
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    index  = min(len(values) - 1, max(0, int(round(q / 100 * (len(values) - 1)))))
+    return values[index]
+
+
+def send(args, index: int) -> dict:
+    body = {
+        "prompt": args.prompt,
+        "max_tokens": args.max_tokens,
+        "temperature": args.temperature,
+        "seed": index,
+        "stream": args.stream,
+        }
+    request = urllib.request.Request(
+        args.url + "/generate", data=json.dumps(body).encode("utf-8"),
+        headers={"Content-Type": "application/json"})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=args.timeout) as response:
+            if not args.stream:
+                result = json.loads(response.read())
+                latency = time.perf_counter() - start
+                return {"status": 200, "latency": latency, "ttft": latency, "num_tokens": result["num_tokens"]}
+            ttft, num_tokens = None, 0
+            for line in response:
+                line = line.decode("utf-8").strip()
+                if not line.startswith("data: "):
+                    continue
+                payload = line[len("data: "):]
+                if payload == "[DONE]":
+                    break
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                num_tokens = json.loads(payload).get("num_tokens", num_tokens)
+            return {"status": 200, "latency": time.perf_counter() - start, "ttft": ttft, "num_tokens": num_tokens}
+    except urllib.error.HTTPError as e:
+        return {"status": e.code}
+
+
+def main(args):
+    results = []
+    lock    = threading.Lock()
+    counter = iter(range(args.num_requests))
+
+    def worker():
+        while True:
+            with lock:
+                index = next(counter, None)
+            if index is None:
+                return
+            result = send(args, index)
+            with lock:
+                results.append(result)
+
+    start   = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    ok        = [r for r in results if r["status"] == 200]
+    rejected  = [r for r in results if r["status"] == 503]
+    latencies = [r["latency"] * 1000 for r in ok]
+    ttfts     = [r["ttft"] * 1000 for r in ok if r["ttft"] is not None]
+    tokens    = sum(r["num_tokens"] for r in ok)
+    print(f"requests={len(results)} ok={len(ok)} rejected(503)={len(rejected)} "
+          f"concurrency={args.concurrency} stream={args.stream}")
+    print(f"throughput: {len(ok) / elapsed:.2f} req/s, {tokens / elapsed:.2f} tokens/s")
+    for name, values in [("latency", latencies), ("ttft", ttfts)]:
+        print(f"{name:<8} p50={percentile(values, 50):.1f}ms p90={percentile(values, 90):.1f}ms "
+              f"p99={percentile(values, 99):.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:8000")
+    parser.add_argument("--prompt", type=str, default="The meaning of life is")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--num_requests", type=int, default=64)
+    parser.add_argument("--max_tokens", type=int, default=32)
+    parser.add_argument("--temperature", type=float, default=0.95)
+    parser.add_argument("--stream", action='store_true')
+    parser.add_argument("--timeout", type=float, default=600.0)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,43 @@
+# One-time pack: safetensors shard -> 런타임 레이아웃 snapshot (model.pack + model.pack.json manifest)
+# python pack-gemma.py --dtype bfloat16 --output model/gemma-1.1-2b-it/model-bfloat16.pack
+# python run-gemma.py --dtype bfloat16 --safetensors model/gemma-1.1-2b-it/model-bfloat16.pack
+import time
+import argparse
+
+import torch
+from source.config import *
+from source.gemma_torch import *
+
+
+def main(args):
+    # run-gemma.py와 같은 설정으로 로드해야 하므로 weight를 결정하는 옵션만 받는다 (manifest에 기록).
+    model_config = get_model_config(args.variant)
+    model_config.dtype = args.dtype
+    model_config.quant = args.quant
+    model_config.quant_bits = args.quant_bits
+    model_config.quant_group_size = args.quant_group_size
+    # quantize-gemma.py로 만든 파일이면 metadata의 quant_bits / quant_group_size를 사용
+    apply_quant_metadata(model_config, args.safetensors)
+    model_config.tokenizer = None
+
+    start = time.perf_counter()
+    with set_tensor_type(model_config.get_dtype()):
+        model = GemmaForCausalLM(model_config)
+        model.load_weights(args.safetensors)
+    nbytes = model.pack_weights(args.output, source=args.safetensors)
+    print(f"Packed {len(model.state_dict())} tensors ({nbytes / 2**30:.2f} GiB, {args.dtype}) "
+          f"to {args.output} in {time.perf_counter() - start:.1f} s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--safetensors", type=str, default= "model/gemma-1.1-2b-it/model-{}-of-{}.safetensors")
+    parser.add_argument("--variant", type=str, default="2b", help="2b, 7b or a model directory with config.json")
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "bfloat16"])
+    parser.add_argument("--quant", action='store_true')
+    parser.add_argument("--quant_bits", type=int, default=8, choices=[4, 8])
+    parser.add_argument("--quant_group_size", type=int, default=0,
+                        help="ignored if the quantized file records it in its metadata")
+    parser.add_argument("--output", type=str, default="model/gemma-1.1-2b-it/model-float32.pack")
+    args = parser.parse_args()
+    main(args)
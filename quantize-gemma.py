@@ -0,0 +1,142 @@
+import gc
+import time
+import argparse
+
+import torch
+import torch.nn.functional as F
+import safetensors
+from safetensors.torch import save_file
+from source.config import *
+from source.gemma_torch import *
+from source.quantize import (
+    QUANT_WEIGHT_PATTERN,
+    quantize_tensor
+    )
+
+
+DEFAULT_PROMPTS = [
+    "The meaning of life is",
+    "Write me a poem about Machine Learning.",
+    "The capital of France is",
+    "def fibonacci(n):",
+    ]
+
+
+def quantize(args):
+    # HF safetensors(bf16)를 텐서 하나씩 읽어 바로 양자화: 모델 전체의 float32 사본을 만들지 않는다.
+    # Linear / Embedding weight만 양자화하고, 나머지 (norm 등)는 float32로 저장
+    quant_tensors = {}
+    for path in get_weight_paths(args.safetensors):
+        with safetensors.safe_open(path, framework="pt") as model_file:
+            for key in model_file.keys():
+                if key in quant_tensors:
+                    continue
+                tensor = model_file.get_tensor(key)
+                if QUANT_WEIGHT_PATTERN.match(key) is None:
+                    tensor = tensor.type(torch.float32)
+                quant_tensors.update(quantize_tensor(key, tensor, bits=args.bits, group_size=args.group_size))
+                del tensor
+
+    save_file(quant_tensors, args.output, metadata={
+        "quant_bits": str(args.bits),
+        "quant_group_size": str(args.group_size),
+        })
+    print(f"Saved {args.output} (int{args.bits}, group_size={args.group_size})")
+
+
+def load_model(args, quant: bool):
+    model_config = get_model_config(args.variant)
+    model_config.dtype = "float32"
+    model_config.quant = quant
+    model_config.quant_bits = args.bits
+    model_config.quant_group_size = args.group_size
+    with set_tensor_type(model_config.get_dtype()):
+        model = GemmaForCausalLM(model_config)
+        model.load_weights(args.output if quant else args.safetensors)
+    return model.eval()
+
+
+@torch.no_grad()
+def prompt_logits(model, token_ids):
+    # 프롬프트의 모든 위치에 대한 로짓 [input_len, vocab_size]
+    config    = model.config
+    input_len = len(token_ids)
+    positions = torch.arange(0, input_len, dtype=torch.int64)
+    kv_caches = []
+    for _ in range(config.num_hidden_layers):
+        size = (1, input_len, config.num_key_value_heads, config.head_dim)
+        kv_caches.append((torch.zeros(size), torch.zeros(size)))
+    mask = torch.triu(torch.full((1, 1, input_len, input_len), -2.3819763e38), diagonal=1)
+
+    hidden_states = model.model.embed_tokens(torch.tensor([token_ids]))
+    hidden_states = hidden_states * (config.hidden_size**0.5)
+    hidden_states = model.model(
+        hidden_states=hidden_states,
+        freqs_cis=model.rotary_embedding(positions),
+        kv_write_indices=positions,
+        kv_caches=kv_caches,
+        mask=mask,
+        )
+    return torch.matmul(hidden_states[0], model.model.embed_tokens.dequantize().t()).float()
+
+
+def measure(model, prompts, output_len):
+    # 1. 파라미터 메모리 2. 프롬프트 로짓 3. greedy generate의 tokens/sec
+    param_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+    logits = [prompt_logits(model, model.tokenizer.encode(prompt)) for prompt in prompts]
+    start = time.time()
+    model.generate(prompts, torch.device("cpu"), output_len=output_len, temperature=None)
+    tokens_per_sec = len(prompts) * output_len / (time.time() - start)
+    return param_bytes, logits, tokens_per_sec
+
+
+def report(args):
+    prompts = DEFAULT_PROMPTS
+    if args.prompts is not None:
+        with open(args.prompts) as f:
+            prompts = [line.rstrip("\n") for line in f if line.strip()]
+
+    # float32 기준 모델과 양자화 모델을 차례로 로드하여 메모리를 두 배로 쓰지 않는다.
+    model = load_model(args, quant=False)
+    fp32_bytes, fp32_logits, fp32_tps = measure(model, prompts, args.output_len)
+    del model
+    gc.collect()
+
+    model = load_model(args, quant=True)
+    quant_bytes, quant_logits, quant_tps = measure(model, prompts, args.output_len)
+
+    # KL(p_fp32 || p_quant)를 프롬프트의 모든 위치에 대해 평균
+    kls, top1 = [], []
+    for ref, out in zip(fp32_logits, quant_logits):
+        ref_logp = F.log_softmax(ref, dim=-1)
+        out_logp = F.log_softmax(out, dim=-1)
+        kls.append(F.kl_div(out_logp, ref_logp, log_target=True, reduction="none").sum(dim=-1))
+        top1.append((ref.argmax(dim=-1) == out.argmax(dim=-1)).float())
+    kls, top1 = torch.cat(kls), torch.cat(top1)
+
+    print('======================================')
+    print(f'QUANT      : int{args.bits}, group_size={args.group_size}')
+    print(f'PROMPTS    : {len(prompts)} ({kls.numel()} positions)')
+    print(f'KL mean    : {kls.mean().item():.6f}')
+    print(f'KL max     : {kls.max().item():.6f}')
+    print(f'TOP-1 agree: {top1.mean().item() * 100:.2f}%')
+    print(f'MEMORY     : fp32 {fp32_bytes / 2**30:.2f} GiB -> quant {quant_bytes / 2**30:.2f} GiB')
+    print(f'TOKENS/SEC : fp32 {fp32_tps:.2f} -> quant {quant_tps:.2f}')
+    print('======================================')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--safetensors", type=str, default= "model/gemma-1.1-2b-it/model-{}-of-{}.safetensors")
+    parser.add_argument("--variant", type=str, default="2b", help="2b, 7b or a model directory with config.json")
+    parser.add_argument("--bits", type=int, default=8, choices=[4, 8])
+    parser.add_argument("--group_size", type=int, default=128)
+    parser.add_argument("--output", type=str, default="model/gemma-1.1-2b-it/model-int8.safetensors")
+    parser.add_argument("--report", action='store_true')
+    parser.add_argument("--prompts", type=str, default=None)
+    parser.add_argument("--output_len", type=int, default=32)
+    args = parser.parse_args()
+    if args.report:
+        report(args)
+    else:
+        quantize(args)
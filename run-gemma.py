@@ -11,62 +11,188 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import argparse
+# 시작 시간을 줄이기 위해 torch, mlx 등 무거운 모듈은 --backend에 따라 main 안에서 import한다.
+import json
+import time
 import random
-import contextlib
+import argparse
 
-import torch
-import numpy as np
-from source.config import *
-from source.gemma_torch import *
 
+class StartupTimer:
+    """Cold-start breakdown: 이전 mark 이후의 wall time을 단계마다 기록한다."""
+    def __init__(self):
+        self.phases = []
+        self.last   = time.perf_counter()
 
-@contextlib.contextmanager
-def set_tensor_type(dtype: torch.dtype):
-    # Sets the default torch dtype to the given dtype.
-    torch.set_default_dtype(dtype)
-    yield
-    torch.set_default_dtype(torch.float)
+    def mark(self, name: str):
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
 
+    def report(self) -> str:
+        total = sum(seconds for _, seconds in self.phases)
+        lines = [f"{name:>16} {seconds:>8.3f} s" for name, seconds in self.phases]
+        lines.append(f"{'total':>16} {total:>8.3f} s")
+        return "\n".join(lines)
+
+    def dump(self, path: str):
+        with open(path, "w") as f:
+            json.dump(dict(self.phases), f, indent=2)
+
+
+def load_torch_model(args, timer: StartupTimer):
+    import torch
+    import numpy as np
+    from source.config import apply_quant_metadata, get_model_config, set_tensor_type, warm_start_matches
+    from source.tokenizer import Tokenizer
+    from source.gemma_torch import GemmaForCausalLM
+    timer.mark("import")
 
-def main(args):
     # 모델 confiugration 설정
     model_config = get_model_config(args.variant)
-    model_config.dtype = "float32" if args.device == "cpu" else "float16"
+    # CPU에서는 float32 또는 bfloat16 (bfloat16은 weight, 활성값, KV 캐시 모두 bfloat16)
+    model_config.dtype = args.dtype if args.device == "cpu" else "float16"
     model_config.quant = args.quant
-    model_config.dtype = "float32"
+    model_config.quant_bits = args.quant_bits
+    model_config.quant_group_size = args.quant_group_size
+    # quantize-gemma.py로 만든 파일이면 metadata의 quant_bits / quant_group_size를 사용
+    apply_quant_metadata(model_config, args.safetensors)
+    model_config.compile_norm = args.compile_norm
+    model_config.prefill_chunk_size = args.prefill_chunk_size
+    model_config.low_memory = args.low_memory
 
     # 랜덤 시드
     random.seed(args.seed)
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
 
+    tokenizer = Tokenizer(model_config.tokenizer)
+    timer.mark("tokenizer")
+
     # 모델 인스턴스 생성 및 weight 로드
     device = torch.device(args.device)
     with set_tensor_type(model_config.get_dtype()):
-        model = GemmaForCausalLM(model_config)
-        model.load_weights(args.ckpt)
+        model = GemmaForCausalLM(model_config, tokenizer=tokenizer)
+        timer.mark("model init")
+        # warm start 파일은 shard 병합, dtype 변환이 끝난 weight이므로 그대로 읽는다.
+        warm = args.warm_start is not None and warm_start_matches(args.warm_start, model_config, args.safetensors)
+        model.load_weights(args.warm_start if warm else args.safetensors)
+        timer.mark("weights")
+        if args.warm_start is not None and not warm:
+            model.save_weights(args.warm_start, source=args.safetensors)
+            timer.mark("save warm start")
         model = model.to(device).eval()
+    if args.adapter is not None:
+        model.load_adapter("adapter", args.adapter)
+        timer.mark("adapter")
+    return model, device
+
+
+def load_mlx_model(args, timer: StartupTimer):
+    import numpy as np
+    import torch
+    from source.config import get_model_config, warm_start_matches
+    from source.tokenizer import Tokenizer
+    from source.gemma_mlx import MLXGemmaForCausalLM
+    timer.mark("import")
+
+    model_config = get_model_config(args.variant)
+    model_config.dtype = args.dtype
+    model_config.quant = args.quant
+
+    # 랜덤 시드 (MLX 모델의 샘플링은 torch.multinomial)
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    tokenizer = Tokenizer(model_config.tokenizer)
+    timer.mark("tokenizer")
+
+    model = MLXGemmaForCausalLM(model_config, tokenizer=tokenizer)
+    timer.mark("model init")
+    # warm start 파일은 torch 텐서 -> mlx.array 변환이 끝난 weight이므로 그대로 읽는다.
+    warm = args.warm_start is not None and warm_start_matches(args.warm_start, model_config, args.safetensors)
+    if warm:
+        model.load_weights_file(args.warm_start)
+    else:
+        model.load_torch_weights(args.safetensors)
+    timer.mark("weights")
+    if args.warm_start is not None and not warm:
+        model.save_weights(args.warm_start, source=args.safetensors)
+        timer.mark("save warm start")
+    model.eval()
+    return model, None
+
+
+def main(args):
+    timer = StartupTimer()
+    if args.backend == "mlx":
+        model, device = load_mlx_model(args, timer)
+        generate = lambda output_len: model.generate(args.prompt, output_len=output_len)
+    else:
+        model, device = load_torch_model(args, timer)
+        adapter  = None if args.adapter is None else "adapter"
+        generate = lambda output_len: model.generate(args.prompt, device, output_len=output_len, adapter=adapter)
     print("Model loading done")
 
+    if args.timings is not None:
+        # 첫 토큰: 처음 쓰는 위치의 RoPE 테이블, KV 캐시 할당 등 첫 호출에만 드는 비용을 포함한다.
+        generate(1)
+        timer.mark("first token")
+
+    if args.metrics is not None:
+        from source.metrics import GenerationMetrics
+        model.metrics = GenerationMetrics()
+
     # Generate the response.
-    result = model.generate(args.prompt, device, output_len=args.output_len)
+    if args.profile is not None:
+        # 모듈별 시간 / FLOPs / bytes를 출력하고 Chrome trace로 저장
+        from source.profiler import Profiler
+        with Profiler(model) as profiler:
+            result = generate(args.output_len)
+        print(profiler.report())
+        profiler.export_chrome_trace(args.profile)
+    else:
+        result = generate(args.output_len)
+    if args.metrics is not None:
+        # Prometheus text format
+        model.metrics.dump(args.metrics)
 
     # Print the prompts and results.
     print('======================================')
     print(f'PROMPT: {args.prompt}')
     print(f'RESULT: {result}')
     print('======================================')
+    if args.timings is not None:
+        timer.mark("generate")
+        print(timer.report())
+        timer.dump(args.timings)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", type=str, default="torch", choices=["torch", "mlx"])
     parser.add_argument("--safetensors", type=str, default= "model/gemma-1.1-2b-it/model-{}-of-{}.safetensors")
-    parser.add_argument("--variant", type=str, default="2b", choices=["2b", "7b"])
+    parser.add_argument("--variant", type=str, default="2b", help="2b, 7b or a model directory with config.json")
     parser.add_argument("--device", type=str, default="cpu", choices=["cpu", "cuda"])
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "bfloat16"])
     parser.add_argument("--output_len", type=int, default=100)
     parser.add_argument("--seed", type=int, default=12345)
     parser.add_argument("--quant", action='store_true')
+    parser.add_argument("--quant_bits", type=int, default=8, choices=[4, 8])
+    parser.add_argument("--quant_group_size", type=int, default=0,
+                        help="ignored if the quantized file records it in its metadata")
+    parser.add_argument("--compile_norm", action='store_true')
+    parser.add_argument("--prefill_chunk_size", type=int, default=None)
+    parser.add_argument("--low_memory", action='store_true')
     parser.add_argument("--prompt", type=str, default="The meaning of life is")
+    parser.add_argument("--adapter", type=str, default=None, help="PEFT LoRA adapter directory or safetensors file")
+    parser.add_argument("--warm_start", type=str, default=None,
+                        help="preprocessed weight file: loaded if saved with the same config, else written after loading")
+    parser.add_argument("--timings", type=str, default=None, help="cold-start breakdown output path (JSON)")
+    parser.add_argument("--profile", type=str, default=None, help="Chrome trace output path")
+    parser.add_argument("--metrics", type=str, default=None, help="metrics output path (Prometheus text format)")
     args = parser.parse_args()
-    main(args)
\ No newline at end of file
+    if args.backend == "mlx" and (args.profile is not None or args.metrics is not None or args.adapter is not None):
+        parser.error("--profile, --metrics and --adapter need --backend torch")
+    main(args)
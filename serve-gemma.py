@@ -0,0 +1,98 @@
+import argparse
+import random
+
+import torch
+import numpy as np
+from source.config import *
+from source.gemma_torch import *
+from source.server import BatchScheduler, GemmaHTTPServer
+from source.metrics import GenerationMetrics
+from source.worker_pool import WorkerPool
+
+
+def main(args):
+    # 모델 confiugration 설정
+    model_config = get_model_config(args.variant)
+    model_config.quant = args.quant
+    model_config.quant_bits = args.quant_bits
+    model_config.quant_group_size = args.quant_group_size
+    # quantize-gemma.py로 만든 파일이면 metadata의 quant_bits / quant_group_size를 사용
+    apply_quant_metadata(model_config, args.safetensors)
+    model_config.compile_norm = args.compile_norm
+    model_config.vocab_chunk_size = args.vocab_chunk_size
+    model_config.prefill_chunk_size = args.prefill_chunk_size
+    model_config.low_memory = args.low_memory
+    model_config.dtype = args.dtype
+
+    # 랜덤 시드
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    # 모델은 프로세스가 살아있는 동안 한 번만 로드
+    device = torch.device(args.device)
+    with set_tensor_type(model_config.get_dtype()):
+        model = GemmaForCausalLM(model_config)
+        model.load_weights(args.safetensors)
+        model = model.to(device).eval()
+    for adapter in args.adapters:
+        # NAME=PATH: 요청의 "adapter": NAME으로 선택하는 LoRA adapter (base weight는 하나만 둔다)
+        name, path = adapter.split("=", 1)
+        model.load_adapter(name, path)
+    print("Model loading done")
+    if not args.no_metrics:
+        # GET /metrics. 워커 프로세스 (--workers > 1)의 생성 메트릭은 합치지 않고 queue_depth만 보인다.
+        model.metrics = GenerationMetrics()
+
+    if args.workers > 1:
+        # weight를 공유 메모리에 한 번만 올리고 워커 프로세스를 코어 subset마다 하나씩 띄운다.
+        scheduler = WorkerPool(
+            model, device, args.workers,
+            threads_per_worker=args.threads_per_worker,
+            max_batch_size=args.max_batch_size,
+            max_queue_size=args.max_queue_size,
+            batch_wait_ms=args.batch_wait_ms,
+            max_active_batches=args.max_active_batches,
+            seed=args.seed,
+            )
+    else:
+        scheduler = BatchScheduler(
+            model, device,
+            max_batch_size=args.max_batch_size,
+            max_queue_size=args.max_queue_size,
+            batch_wait_ms=args.batch_wait_ms,
+            max_active_batches=args.max_active_batches,
+            ).start()
+    server = GemmaHTTPServer((args.host, args.port), scheduler, verbose=args.verbose)
+    print(f"Serving on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--safetensors", type=str, default= "model/gemma-1.1-2b-it/model-{}-of-{}.safetensors")
+    parser.add_argument("--variant", type=str, default="2b", help="2b, 7b or a model directory with config.json")
+    parser.add_argument("--device", type=str, default="cpu", choices=["cpu", "cuda"])
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "bfloat16"])
+    parser.add_argument("--seed", type=int, default=12345)
+    parser.add_argument("--quant", action='store_true')
+    parser.add_argument("--quant_bits", type=int, default=8, choices=[4, 8])
+    parser.add_argument("--quant_group_size", type=int, default=0,
+                        help="ignored if the quantized file records it in its metadata")
+    parser.add_argument("--compile_norm", action='store_true')
+    parser.add_argument("--vocab_chunk_size", type=int, default=None)
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max_batch_size", type=int, default=8)
+    parser.add_argument("--max_queue_size", type=int, default=64)
+    parser.add_argument("--batch_wait_ms", type=float, default=10.0)
+    parser.add_argument("--prefill_chunk_size", type=int, default=None)
+    parser.add_argument("--low_memory", action='store_true')
+    parser.add_argument("--max_active_batches", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads_per_worker", type=int, default=None)
+    parser.add_argument("--adapters", type=str, nargs="*", default=[], help="LoRA adapters as NAME=PATH")
+    parser.add_argument("--no_metrics", action='store_true')
+    parser.add_argument("--verbose", action='store_true')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,273 @@
+# Offline batch inference over JSONL with length bucketing and resumable output.
+import os
+import json
+import time
+import queue
+import threading
+import dataclasses
+from typing import (
+    Any,
+    Iterator,
+    List,
+    Optional,
+    Set
+    )
+from source.gemma_torch import GenerationSession
+
+
+@dataclasses.dataclass
+class BatchItem:
+    # 입력 JSONL의 한 행: 출력에 그대로 쓰는 id, 토크나이징된 프롬프트, 생성을 멈출 토큰
+    # error가 있으면 생성하지 않고 {"id", "error"} 행을 쓴다.
+    id: Any
+    index: int
+    prompt_tokens: List[int]
+    stop_token_ids: tuple = ()
+    error: Optional[str] = None
+    truncated: bool = False
+
+
+@dataclasses.dataclass
+class BatchStats:
+    rows: int = 0
+    skipped: int = 0
+    # 생성하지 않고 error 행을 쓴 행 (프롬프트가 너무 길거나 messages가 잘못된 행)
+    errors: int = 0
+    # truncate_prompts로 프롬프트 앞부분을 잘라낸 행
+    truncated: int = 0
+    batches: int = 0
+    prompt_tokens: int = 0
+    generated_tokens: int = 0
+    # 배치의 (최대 프롬프트 길이 - 행의 프롬프트 길이) 합: 버킷팅이 줄이는 패딩
+    padding_tokens: int = 0
+    # 실제로 실행한 forward 스텝 수 (prefill 포함)
+    steps: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def tokens_per_sec(self) -> float:
+        return self.generated_tokens / self.elapsed if self.elapsed > 0 else 0.0
+
+    def report(self) -> str:
+        padding = self.padding_tokens / max(1, self.prompt_tokens + self.padding_tokens)
+        return (f"rows={self.rows} skipped={self.skipped} errors={self.errors} truncated={self.truncated} "
+                f"batches={self.batches} steps={self.steps} "
+                f"generated={self.generated_tokens} padding={padding:.1%} "
+                f"elapsed={self.elapsed:.1f}s tokens/sec={self.tokens_per_sec:.1f}")
+
+
+def load_finished_ids(output_path: str) -> Set[str]:
+    """
+    Reads the ids already written to output_path (the checkpoint of a previous run).
+    마지막 행이 쓰다가 중단되어 JSON이 아니면 그 행을 잘라내고 다시 생성한다.
+    """
+    finished = set()
+    if not os.path.isfile(output_path):
+        return finished
+    valid_bytes = 0
+    with open(output_path, "rb") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                break
+            if not line.endswith(b"\n"):
+                break
+            finished.add(json.dumps(row["id"]))
+            valid_bytes += len(line)
+    if valid_bytes != os.path.getsize(output_path):
+        with open(output_path, "r+b") as f:
+            f.truncate(valid_bytes)
+    return finished
+
+
+class BatchRunner:
+    def __init__(self,
+        model: Any,
+        device: Any,
+        batch_size: int = 8,
+        bucket_size: int = 256,
+        output_len: int = 100,
+        temperature: Optional[float] = None,
+        top_p: float = 1.0,
+        top_k: int = 100,
+        seed: Optional[int] = None,
+        encode_chunk_size: int = 64,
+        max_queue_size: int = 1024,
+        truncate_prompts: bool = False,
+        ):
+        """
+        1. 토크나이저 스레드가 JSONL을 읽으며 encode_chunk_size행씩 미리 토크나이징하여 큐에 쌓는다.
+        2. 큐에서 bucket_size행을 모아 프롬프트 길이순으로 정렬한 뒤 batch_size개씩 배치를 만든다.
+           비슷한 길이끼리 묶이므로 패딩과 프롬프트 길이 차이만큼의 추가 디코딩 스텝이 줄어든다.
+        3. 배치는 generate_stream 한 번으로 생성하고, 모든 행이 EOS 또는 output_len에 도달하면 멈춘다.
+        4. 배치가 끝날 때마다 결과를 출력 JSONL에 append하고 fsync한다. 출력 파일이 체크포인트이며,
+           다시 실행하면 이미 쓰인 id는 건너뛴다.
+        seed가 주어지면 행마다 seed + (입력 행 번호)를 사용하므로 배치 구성, 재시작과 관계없이 같은 결과가 나온다.
+        5. 프롬프트 + output_len이 max_position_embeddings를 넘는 행과 messages가 잘못된 행은 생성하지 않고
+           {"id", "error"}를 쓴다 (다시 실행해도 건너뛴다). truncate_prompts이면 긴 프롬프트는 BOS 뒤의 앞부분을 잘라낸다.
+        """
+        self.model             = model
+        self.device            = device
+        self.batch_size        = batch_size
+        self.bucket_size       = max(bucket_size, batch_size)
+        self.output_len        = output_len
+        self.temperature       = temperature
+        self.top_p             = top_p
+        self.top_k             = top_k
+        self.seed              = seed
+        self.encode_chunk_size = encode_chunk_size
+        self.max_queue_size    = max_queue_size
+        self.truncate_prompts  = truncate_prompts
+        # 배치는 하나씩 생성하므로 KV 캐시 등의 버퍼를 모든 배치가 재사용한다.
+        self.session           = GenerationSession(model.config)
+
+    def _encode_rows(self, rows: List[dict], indices: List[int]) -> List[BatchItem]:
+        # "prompt"는 한 번에 배치 인코딩, "messages"는 채팅 템플릿으로 인코딩하고 <end_of_turn>에서 멈춘다.
+        items: List[Optional[BatchItem]] = [None] * len(rows)
+        prompt_rows = [i for i, row in enumerate(rows) if "messages" not in row]
+        if prompt_rows:
+            encoded = self.model.tokenizer.encode_batch([str(rows[i]["prompt"]) for i in prompt_rows])
+            for i, tokens in zip(prompt_rows, encoded):
+                items[i] = BatchItem(rows[i].get("id", indices[i]), indices[i], tokens)
+        for i, row in enumerate(rows):
+            if items[i] is None:
+                chat_template = self.model.chat_template
+                try:
+                    tokens = chat_template.encode(row["messages"])
+                except ValueError as e:
+                    items[i] = BatchItem(row.get("id", indices[i]), indices[i], [], error=str(e))
+                    continue
+                items[i] = BatchItem(row.get("id", indices[i]), indices[i], tokens, (chat_template.end_of_turn_id,))
+        for item in items:
+            self._check_length(item)
+        return items
+
+    def _check_length(self, item: BatchItem):
+        # generate_stream은 프롬프트 + output_len이 max_position_embeddings를 넘으면 assert로 배치 전체를 멈춘다.
+        max_prompt_len = self.model.config.max_position_embeddings - self.output_len
+        num_tokens     = len(item.prompt_tokens)
+        if item.error is not None or num_tokens <= max_prompt_len:
+            return
+        if self.truncate_prompts and max_prompt_len > 1:
+            # BOS는 남기고 그 뒤의 앞부분을 잘라낸다 (채팅 프롬프트의 마지막 턴과 생성 프롬프트가 남는다).
+            item.prompt_tokens = item.prompt_tokens[:1] + item.prompt_tokens[num_tokens - max_prompt_len + 1:]
+            item.truncated     = True
+            return
+        item.error = (f"prompt has {num_tokens} tokens, more than max_position_embeddings - output_len "
+                      f"= {max_prompt_len}")
+
+    def _tokenize(self, input_path: str, finished: Set[str], items: queue.Queue, stats: BatchStats):
+        # 토크나이저 스레드: 끝나면 None, 실패하면 Exception을 큐에 넣는다.
+        try:
+            rows, indices = [], []
+            with open(input_path, "r", encoding="utf-8") as f:
+                for index, line in enumerate(f):
+                    if not line.strip():
+                        continue
+                    row = json.loads(line)
+                    if json.dumps(row.get("id", index)) in finished:
+                        stats.skipped += 1
+                        continue
+                    rows.append(row)
+                    indices.append(index)
+                    if len(rows) == self.encode_chunk_size:
+                        for item in self._encode_rows(rows, indices):
+                            items.put(item)
+                        rows, indices = [], []
+            if rows:
+                for item in self._encode_rows(rows, indices):
+                    items.put(item)
+            items.put(None)
+        except Exception as e:
+            items.put(e)
+
+    def _batches(self, items: queue.Queue) -> Iterator[List[BatchItem]]:
+        # bucket_size행씩 길이순으로 정렬하여 batch_size개씩 나눈다.
+        done = False
+        while not done:
+            bucket = []
+            while len(bucket) < self.bucket_size:
+                item = items.get()
+                if item is None:
+                    done = True
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                bucket.append(item)
+            bucket.sort(key=lambda item: len(item.prompt_tokens))
+            for start in range(0, len(bucket), self.batch_size):
+                yield bucket[start:start + self.batch_size]
+
+    def generate_batch(self, batch: List[BatchItem], stats: BatchStats) -> List[List[int]]:
+        """Generates one batch and stops as soon as every row has finished."""
+        eos_id    = self.model.eos_id
+        outputs   = [[] for _ in batch]
+        finished  = [False] * len(batch)
+        seeds     = None if self.seed is None else [self.seed + item.index for item in batch]
+        stream    = self.model.generate_stream(
+            [item.prompt_tokens for item in batch],
+            self.device,
+            output_len=self.output_len,
+            temperature=self.temperature,
+            top_p=self.top_p,
+            top_k=self.top_k,
+            seed=seeds,
+            session=self.session,
+            stop_token_ids=[item.stop_token_ids for item in batch],
+            )
+        for step_tokens in stream:
+            stats.steps += 1
+            for i, token in enumerate(step_tokens):
+                if token is None or finished[i]:
+                    continue
+                if token == eos_id or token in batch[i].stop_token_ids:
+                    finished[i] = True
+                    continue
+                outputs[i].append(token)
+                finished[i] = len(outputs[i]) >= self.output_len
+            if all(finished):
+                break
+        stream.close()
+        max_prompt_len = max(len(item.prompt_tokens) for item in batch)
+        stats.prompt_tokens  += sum(len(item.prompt_tokens) for item in batch)
+        stats.padding_tokens += sum(max_prompt_len - len(item.prompt_tokens) for item in batch)
+        return outputs
+
+    def run(self, input_path: str, output_path: str, verbose: bool = False) -> BatchStats:
+        """Runs every row of input_path that is not yet in output_path and appends the results."""
+        stats    = BatchStats()
+        finished = load_finished_ids(output_path)
+        items    = queue.Queue(maxsize=self.max_queue_size)
+        thread   = threading.Thread(target=self._tokenize, args=(input_path, finished, items, stats), daemon=True)
+        start    = time.perf_counter()
+        thread.start()
+        with open(output_path, "a", encoding="utf-8") as out:
+            for batch in self._batches(items):
+                runnable = [item for item in batch if item.error is None]
+                outputs  = self.generate_batch(runnable, stats) if runnable else []
+                texts    = self.model.tokenizer.decode_batch(outputs) if runnable else []
+                results  = iter(zip(outputs, texts))
+                for item in batch:
+                    if item.error is not None:
+                        record = {"id": item.id, "error": item.error}
+                        stats.errors += 1
+                    else:
+                        tokens, text = next(results)
+                        record = {"id": item.id, "text": text, "num_tokens": len(tokens)}
+                        if item.truncated:
+                            record["truncated"] = True
+                            stats.truncated += 1
+                    out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                # 배치 단위 체크포인트
+                out.flush()
+                os.fsync(out.fileno())
+                stats.rows             += len(batch)
+                stats.batches          += 1
+                stats.generated_tokens += sum(len(tokens) for tokens in outputs)
+                stats.elapsed           = time.perf_counter() - start
+                if verbose:
+                    print(stats.report(), flush=True)
+        thread.join()
+        stats.elapsed = time.perf_counter() - start
+        return stats
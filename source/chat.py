@@ -0,0 +1,99 @@
+# Gemma chat template built from pre-tokenized control-token fragments.
+import os
+import json
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple
+    )
+from source.tokenizer import Tokenizer
+
+
+# special_tokens_map.json이 없을 때 사용하는 Gemma-it의 제어 토큰
+DEFAULT_START_OF_TURN = "<start_of_turn>"
+DEFAULT_END_OF_TURN   = "<end_of_turn>"
+
+
+class ChatTemplate:
+    def __init__(self, tokenizer: Tokenizer, model_dir: Optional[str] = None):
+        """
+        tokenizer_config.json의 chat_template과 같은 토큰을 만든다.
+        <bos><start_of_turn>user\\n{content}<end_of_turn>\\n<start_of_turn>model\\n{content}<end_of_turn>\\n ...
+        1. 제어 토큰은 model_dir의 special_tokens_map.json에서 읽어 토큰 아이디로 한 번만 변환
+        2. 역할 헤더와 턴 종료 fragment는 미리 토크나이징하여 보관
+        3. 요청마다 메시지의 content만 토크나이징한다.
+        """
+        self.tokenizer = tokenizer
+        start_of_turn, end_of_turn = self._load_control_tokens(model_dir)
+        self.start_of_turn_id = tokenizer.sp_model.piece_to_id(start_of_turn)
+        self.end_of_turn_id   = tokenizer.sp_model.piece_to_id(end_of_turn)
+        assert self.start_of_turn_id != tokenizer.sp_model.unk_id(), start_of_turn
+        assert self.end_of_turn_id != tokenizer.sp_model.unk_id(), end_of_turn
+
+        self.bos_fragment  = (tokenizer.bos_id,)
+        self.role_fragments: Dict[str, Tuple[int, ...]] = {
+            role: (self.start_of_turn_id,) + tuple(tokenizer.encode(role + "\n", bos=False))
+            for role in ("user", "model")
+            }
+        self.end_fragment  = (self.end_of_turn_id,) + tuple(tokenizer.encode("\n", bos=False))
+
+    def _load_control_tokens(self, model_dir: Optional[str]) -> Tuple[str, str]:
+        path = None if model_dir is None else os.path.join(model_dir, "special_tokens_map.json")
+        if path is None or not os.path.isfile(path):
+            return DEFAULT_START_OF_TURN, DEFAULT_END_OF_TURN
+        with open(path) as f:
+            special_tokens = json.load(f).get("additional_special_tokens", [])
+        if DEFAULT_START_OF_TURN in special_tokens and DEFAULT_END_OF_TURN in special_tokens:
+            return DEFAULT_START_OF_TURN, DEFAULT_END_OF_TURN
+        return tuple(special_tokens[:2])
+
+    def _check_roles(self, messages: Sequence[Dict[str, str]]) -> List[str]:
+        # chat_template과 같은 규칙: system 역할은 지원하지 않고, user / assistant가 번갈아 나와야 한다.
+        if not isinstance(messages, (list, tuple)) or not messages:
+            raise ValueError("messages must be a non-empty list")
+        roles = []
+        for i, message in enumerate(messages):
+            if not isinstance(message, dict) or not isinstance(message.get("content"), str):
+                raise ValueError("Each message must be an object with a role and a string content")
+            role = message.get("role")
+            if role == "system":
+                raise ValueError("System role not supported")
+            if role not in ("user", "assistant"):
+                raise ValueError(f"Unknown role {role!r}, expected user or assistant")
+            if (role == "user") != (i % 2 == 0):
+                raise ValueError("Conversation roles must alternate user/assistant/user/assistant/...")
+            roles.append("model" if role == "assistant" else role)
+        return roles
+
+    def encode(self, messages: Sequence[Dict[str, str]], add_generation_prompt: bool = True) -> List[int]:
+        """
+        Converts a list of {"role", "content"} messages into prompt token ids.
+        멀티 턴 대화에서 이전 턴의 content는 매 요청마다 반복되므로 tokenizer의 prefix 캐시를 사용하고,
+        마지막 메시지만 새로 토크나이징한다. 같은 대화의 이전 턴은 항상 같은 토큰 prefix가 된다.
+        """
+        return self.encode_batch([messages], add_generation_prompt)[0]
+
+    def encode_batch(self,
+        conversations: Sequence[Sequence[Dict[str, str]]],
+        add_generation_prompt: bool = True,
+        ) -> List[List[int]]:
+        """Converts a batch of conversations into prompt token ids (last messages tokenized in one call)."""
+        roles = [self._check_roles(messages) for messages in conversations]
+        last_tokens = self.tokenizer.encode_batch(
+            [messages[-1]["content"].strip() for messages in conversations], bos=False)
+        batch = []
+        for messages, conversation_roles, last in zip(conversations, roles, last_tokens):
+            tokens = list(self.bos_fragment)
+            for message, role in zip(messages[:-1], conversation_roles[:-1]):
+                tokens.extend(self.role_fragments[role])
+                tokens.extend(self.tokenizer.encode_prefix(message["content"].strip(), bos=False))
+                tokens.extend(self.end_fragment)
+            tokens.extend(self.role_fragments[conversation_roles[-1]])
+            tokens.extend(last)
+            tokens.extend(self.end_fragment)
+            if add_generation_prompt:
+                tokens.extend(self.role_fragments["model"])
+            batch.append(tokens)
+        return batch
@@ -14,9 +14,18 @@
 
 
 # Gemma model config.
+import os
+import re
+import glob
+import json
 import torch
+import contextlib
 import dataclasses
-from typing import Optional
+import safetensors
+from typing import (
+    List,
+    Optional
+    )
 
 
 # Keep a mapping from dtype strings to the supported torch dtypes.
@@ -28,6 +37,14 @@ DTYPE_TORCH = dict({
     })
 
 
+@contextlib.contextmanager
+def set_tensor_type(dtype: torch.dtype):
+    # Sets the default torch dtype to the given dtype.
+    torch.set_default_dtype(dtype)
+    yield
+    torch.set_default_dtype(torch.float)
+
+
 @dataclasses.dataclass
 class GemmaConfig:
     # The number of tokens in the vocabulary.
@@ -48,18 +65,83 @@ class GemmaConfig:
     head_dim: int = 256
     # The epsilon used by the rms normalization layers.
     rms_norm_eps: float = 1e-6
+    # The base period of the rotary position embeddings.
+    rope_theta: float = 10000.0
     # The dtype of the weights.
     dtype: str = 'bfloat16'
     # Whether a quantized version of the model is used.
     quant: bool = False
-    # The path to the model tokenizer.
+    # The number of bits of the quantized weights (8 or 4).
+    quant_bits: int = 8
+    # The group size of the quantized weights along the input dimension. 0 means per-row scales.
+    quant_group_size: int = 0
+    # The vocabulary tile size of the chunked LM head. None computes the full logits.
+    vocab_chunk_size: Optional[int] = None
+    # Whether the fused residual add + RMSNorm is compiled with torch.compile.
+    compile_norm: bool = False
+    # The prompt chunk size of chunked prefill. None prefills the whole prompt in one forward.
+    prefill_chunk_size: Optional[int] = None
+    # Whether the layer stack uses in-place activations and shared workspace buffers to lower peak activation memory.
+    low_memory: bool = False
+    # The path to the model tokenizer. None builds the model without a tokenizer (token ids only).
     tokenizer: Optional[str] = 'model/gemma-1.1-2b-it/tokenizer.model'
+    # The padding / end-of-sequence token ids used when the model has no tokenizer.
+    pad_token_id: int = 0
+    eos_token_id: int = 1
 
     def get_dtype(self) -> Optional[torch.dtype]:
         """Gets the torch dtype from the config dtype string."""
         return DTYPE_TORCH.get(self.dtype, None)
 
 
+# weight 텐서의 shape과 값을 결정하는 필드 (warm start 파일이 같은 설정에서 저장되었는지 확인)
+WEIGHT_CONFIG_FIELDS = (
+    'vocab_size', 'num_hidden_layers', 'num_attention_heads', 'num_key_value_heads', 'hidden_size',
+    'intermediate_size', 'head_dim', 'dtype', 'quant', 'quant_bits', 'quant_group_size',
+    )
+
+
+def weight_config(config: GemmaConfig) -> dict:
+    """The weight-determining config fields (quant_bits, quant_group_size only for quantized weights)."""
+    values = {field: getattr(config, field) for field in WEIGHT_CONFIG_FIELDS}
+    if not config.quant:
+        del values['quant_bits'], values['quant_group_size']
+    return values
+
+
+def weight_config_key(config: GemmaConfig, source: Optional[str] = None) -> str:
+    """The weight-determining config fields (and the source checkpoint path) as a JSON string."""
+    values = weight_config(config)
+    values['source'] = source
+    return json.dumps(values, sort_keys=True)
+
+
+def warm_start_matches(path: str, config: GemmaConfig, source: Optional[str] = None) -> bool:
+    """Whether path is a weight file saved by save_weights with the same config and source checkpoint."""
+    if not os.path.isfile(path):
+        return False
+    with safetensors.safe_open(path, framework="numpy") as weight_file:
+        metadata = weight_file.metadata() or {}
+    return metadata.get('weight_config') == weight_config_key(config, source)
+
+
+def apply_quant_metadata(config: GemmaConfig, model_path: str) -> GemmaConfig:
+    """
+    Sets quant_bits / quant_group_size from the metadata that quantize-gemma.py writes.
+    weight_scaler의 shape이 이 값으로 정해지므로, metadata가 있으면 명령행 값보다 우선한다.
+    양자화 모델이 아니거나 하나의 safetensors 파일이 아니면 (shard, snapshot) config를 그대로 둔다.
+    """
+    if not config.quant or not model_path.endswith('.safetensors') or not os.path.isfile(model_path):
+        return config
+    with safetensors.safe_open(model_path, framework="numpy") as weight_file:
+        metadata = weight_file.metadata() or {}
+    if 'quant_bits' in metadata:
+        config.quant_bits = int(metadata['quant_bits'])
+    if 'quant_group_size' in metadata:
+        config.quant_group_size = int(metadata['quant_group_size'])
+    return config
+
+
 def get_config_for_7b() -> GemmaConfig:
     return GemmaConfig()
 
@@ -74,9 +156,110 @@ def get_config_for_2b() -> GemmaConfig:
         )
 
 
+# GemmaConfig field -> config.json keys (HF 이름, gemma_pytorch 이름 순)
+CONFIG_JSON_KEYS = {
+    'vocab_size': ('vocab_size',),
+    'max_position_embeddings': ('max_position_embeddings',),
+    'num_hidden_layers': ('num_hidden_layers',),
+    'num_attention_heads': ('num_attention_heads',),
+    'num_key_value_heads': ('num_key_value_heads',),
+    'hidden_size': ('hidden_size',),
+    'intermediate_size': ('intermediate_size',),
+    'head_dim': ('head_dim',),
+    # gemma-1.1-2b-it의 config.json은 rms_nms_eps로 적혀 있다.
+    'rms_norm_eps': ('rms_norm_eps', 'rms_nms_eps'),
+    'rope_theta': ('rope_theta',),
+    'dtype': ('torch_dtype', 'dtype'),
+    'quant': ('quant',),
+    'pad_token_id': ('pad_token_id',),
+    'eos_token_id': ('eos_token_id',),
+    }
+REQUIRED_CONFIG_JSON_KEYS = ('vocab_size', 'num_hidden_layers', 'num_attention_heads', 'hidden_size', 'intermediate_size')
+
+
+def read_config_json(path: str) -> dict:
+    """
+    Reads a config.json; falls back to the gemma_pytorch style (single quotes, trailing commas)
+    that is not valid JSON.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    try:
+        return json.loads(text)
+    except ValueError:
+        relaxed = re.sub(r',\s*([}\]])', r'\1', text.replace("'", '"'))
+        try:
+            return json.loads(relaxed)
+        except ValueError as e:
+            raise ValueError(f'Cannot parse {path}: {e}') from None
+
+
+def get_config_from_json(path: str) -> GemmaConfig:
+    """
+    Builds a GemmaConfig from a HF-style config.json (or the model directory that contains it).
+    1. head_dim이 없으면 hidden_size // num_attention_heads, num_key_value_heads가 없으면 num_attention_heads
+    2. tokenizer는 모델 디렉토리의 tokenizer.model, 없으면 config.json의 tokenizer (디렉토리 기준 상대 경로)
+    """
+    config_path = os.path.join(path, 'config.json') if os.path.isdir(path) else path
+    model_dir   = os.path.dirname(config_path)
+    values      = read_config_json(config_path)
+    if values.get('model_type', 'gemma') != 'gemma':
+        raise ValueError(f'{config_path}: model_type {values["model_type"]} is not gemma')
+    missing = [key for key in REQUIRED_CONFIG_JSON_KEYS if key not in values]
+    if missing:
+        raise ValueError(f'{config_path}: missing {", ".join(missing)}')
+
+    config = GemmaConfig()
+    for field in dataclasses.fields(GemmaConfig):
+        for key in CONFIG_JSON_KEYS.get(field.name, ()):
+            if key in values:
+                setattr(config, field.name, values[key])
+                break
+    if 'head_dim' not in values:
+        config.head_dim = config.hidden_size // config.num_attention_heads
+    if 'num_key_value_heads' not in values:
+        config.num_key_value_heads = config.num_attention_heads
+    config.rope_theta   = float(config.rope_theta)
+    config.rms_norm_eps = float(config.rms_norm_eps)
+    if config.dtype not in DTYPE_TORCH:
+        raise ValueError(f'{config_path}: unsupported dtype {config.dtype}')
+
+    tokenizer_paths = [os.path.join(model_dir, 'tokenizer.model')]
+    if values.get('tokenizer'):
+        tokenizer_paths.append(os.path.join(model_dir, values['tokenizer']))
+    config.tokenizer = next((p for p in tokenizer_paths if os.path.isfile(p)), tokenizer_paths[0])
+    return config
+
+
 def get_model_config(variant: str) -> GemmaConfig:
+    """variant: "2b", "7b", 또는 config.json이 있는 모델 디렉토리 / config.json 경로"""
     if variant == '7b':
         return get_config_for_7b()
     elif variant == '2b':
         return get_config_for_2b()
-    return ValueError(f'Invalid variant {variant}. Supported variants are "2b"' 'and "7b"')
\ No newline at end of file
+    elif os.path.isdir(variant) or os.path.isfile(variant):
+        return get_config_from_json(variant)
+    raise ValueError(f'Invalid variant {variant}. Supported variants are "2b", "7b" '
+                     'and a model directory (or config.json path)')
+
+
+def get_weight_paths(model_path: str) -> List[str]:
+    """
+    The safetensors files of a checkpoint.
+    1. 디렉토리: model.safetensors.index.json의 shard, 없으면 디렉토리의 모든 *.safetensors
+    2. {}가 있는 경로 (model-{}-of-{}.safetensors): 있는 shard 전부
+    3. 그 외: 하나의 파일
+    """
+    if os.path.isdir(model_path):
+        index_path = os.path.join(model_path, 'model.safetensors.index.json')
+        if os.path.isfile(index_path):
+            weight_map = read_config_json(index_path)['weight_map']
+            return [os.path.join(model_path, name) for name in sorted(set(weight_map.values()))]
+        paths = sorted(glob.glob(os.path.join(model_path, '*.safetensors')))
+    elif '{}' in model_path:
+        paths = sorted(glob.glob(model_path.replace('{}', '*')))
+    else:
+        paths = [model_path]
+    if not paths:
+        raise ValueError(f'No safetensors files found for {model_path}')
+    return paths
\ No newline at end of file
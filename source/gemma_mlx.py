@@ -2,6 +2,7 @@
 import re
 from typing import (
     Any, 
+    Dict, 
     List, 
     Optional, 
     Sequence, 
@@ -15,8 +16,10 @@ import safetensors
 import mlx
 import mlx.nn as mx
 import mlx.core as mxc
+from mlx.utils import tree_flatten
 from source.config import *
 from source.tokenizer import *
+from source.snapshot import is_snapshot, read_snapshot
 
 
 def MLXprecompute_freqs_cis(dim: int, end: int, theta: float = 10000.0) -> mxc.array:
@@ -82,8 +85,8 @@ class MLXSampler(mx.Module):
         # temperature가 None이면, 가장 큰 값을 로짓으로 선택
         # 아니면, temperature 스케일링 적용
         if temperatures is None:
-            return mxc.argmax(logits, dim=-1).squeeze(dim=-1)
-        logits = logits / (temperatures[None, :])
+            return mxc.argmax(logits, axis=-1)
+        logits = logits / (temperatures[:, None])
 
         # 1. 모든 가능한 단어에 대한 모델 예측의 확률 분포를 계산
         # 2. 내림차순으로 정렬, probs_idx는 내림차순한 원소들이 몇 번 인덱스 인지를 반환
@@ -97,7 +100,7 @@ class MLXSampler(mx.Module):
         # 3. 누적확률이 top p에 도달하기 단어만 선택
         # 4. [0.5, 0.3, 0.2] top p = 0.8이면 [0.5, 0.3] 만 선택
         probs_sum   = mxc.cumsum(probs_sort, axis = -1, reverse = True)
-        top_ps_mask = (probs_sum - probs_sort) > top_ps[None, :]
+        top_ps_mask = (probs_sum - probs_sort) > top_ps[:, None]
         probs_sort  = mxc.where(top_ps_mask, 0, probs_sort)
 
         # 1. probs_idx 길이만큼의 0 ~ 숫자 텐서 생성
@@ -106,7 +109,8 @@ class MLXSampler(mx.Module):
         top_ks_mask = mxc.arange(probs_idx.shape[-1])
         top_ks_mask = top_ks_mask[None, :]
         # top_ks_mask = top_ks_mask >= top_ks[None, :] 오름차순으로 사용하기 때문에 주석 처리
-        top_ks_mask = top_ks_mask < top_ks[None, :]
+        # 오름차순에서 가장 큰 top_k개는 마지막 top_k개이므로 그 앞을 마스킹
+        top_ks_mask = top_ks_mask < (probs_idx.shape[-1] - top_ks[:, None])
         probs_sort  = mxc.where(top_ks_mask, 0, probs_sort)
 
         # 1. top-p, top-k로 필터링된 probs_sort를 재정규화
@@ -139,9 +143,10 @@ class MLXEmbedding(mx.Module):
         self.quant = quant
     
     def __call__(self, x):
-        if self.quant:
-            self.embedding.weight = self.embedding.weight * self.weight_scaler[ :, None]
         output = self.embedding(x)
+        if self.quant:
+            # weight를 덮어쓰지 않고 읽은 행에만 scaler를 곱한다.
+            output = output * self.weight_scaler[x][..., None]
         return output
     
 
@@ -180,15 +185,15 @@ class MLXLinear(mx.Module):
     def __init__(self, in_features: int, out_features: int, quant: bool):
         super().__init__()
         """
-        torch: [in_dim, out_dim] @ we
+        torch와 같이 weight는 [out_features, in_features]
         1. in_features, out_feature를 받아서 MLP 레이어를 만든다.
         2. Quantization을 한다면, out_feuatre로 weight_scaler를 만들어서 곱한다.
         """
         if quant:
-            self.weight        = mxc.zeros(shape = [in_features, out_features], dtype = mxc.int8)
+            self.weight        = mxc.zeros(shape = [out_features, in_features], dtype = mxc.int8)
             self.weight_scaler = mxc.zeros(shape = [out_features])
         else:
-            self.weight        = mxc.zeros(shape = [in_features, out_features], dtype = mxc.int8)
+            self.weight        = mxc.zeros(shape = [out_features, in_features])
         self.quant = quant
 
     def __call__(self, x):
@@ -207,13 +212,13 @@ class MLXGemmaMLP(mx.Module):
         quant: bool,
         ):
         super().__init__()
-        self.phi = mxc.array(np.pi)
+        self.phi = np.pi # 상수는 mx.array가 아니어야 parameters()에 포함되지 않는다.
         self.gate_proj = MLXLinear(hidden_size, intermediate_size, quant)
         self.up_proj   = MLXLinear(hidden_size, intermediate_size, quant)
         self.down_proj = MLXLinear(intermediate_size, hidden_size, quant)
 
     def gelu_appro_tanh(self, x):
-        output = 0.5 * x * (1 + mxc.tanh(mxc.sqrt(2/self.phi) * (x + 0.044715 * (x ** 3))))
+        output = 0.5 * x * (1 + mxc.tanh(np.sqrt(2 / self.phi) * (x + 0.044715 * (x ** 3))))
         return output
         
     def __call__(self, x):
@@ -225,7 +230,6 @@ class MLXGemmaMLP(mx.Module):
         return outputs
     
 
-## HC: MLXGemmaAttention을 수정해야함
 class MLXGemmaAttention(mx.Module):
     def __init__(self, hidden_size: int, num_heads: int, num_kv_heads: int, head_dim: int, quant: bool):
         super().__init__()
@@ -259,10 +263,9 @@ class MLXGemmaAttention(mx.Module):
         assert len(hidden_states_shape) == 3
 
         batch_size, input_len, _ = hidden_states_shape
-        qkv = self.qkv_proj(hidden_states)
-        xq = qkv[:, :, :self.q_size]
-        xk = qkv[:, :, self.q_size:self.q_size + self.kv_size]
-        xv = qkv[:, :, self.q_size+self.kv_size:]
+        xq = self.q_proj(hidden_states)
+        xk = self.k_proj(hidden_states)
+        xv = self.v_proj(hidden_states)
         xq = xq.reshape(batch_size, -1, self.num_heads, self.head_dim)
         xk = xk.reshape(batch_size, -1, self.num_kv_heads, self.head_dim)
         xv = xv.reshape(batch_size, -1, self.num_kv_heads, self.head_dim)
@@ -273,10 +276,10 @@ class MLXGemmaAttention(mx.Module):
 
         # Write new kv cache.
         # [batch_size, input_len, n_local_kv_heads, head_dim]
-        # cache의 kv_write_indices 인덱스를 xk의 kv_write_indices로 채우기
+        # cache의 kv_write_indices(입력 토큰의 절대 위치)에 이번 입력의 xk, xv를 순서대로 채우기
         k_cache, v_cache = kv_cache
-        k_cache[:, kv_write_indices, ...] = xk[:, kv_write_indices, ...]
-        v_cache[:, kv_write_indices, ...] = xv[:, kv_write_indices, ...]
+        k_cache[:, kv_write_indices, ...] = xk
+        v_cache[:, kv_write_indices, ...] = xv
     
         key   = k_cache
         value = v_cache
@@ -294,7 +297,7 @@ class MLXGemmaAttention(mx.Module):
         # [batch_size, n_local_heads, input_len, max_seq_len]
         scores = mxc.matmul(q, k.transpose(0, 1, 3, 2)) * self.scaling
         scores = scores + mask
-        # 240507: 소프트맥스 연산 전후가 다름
+        # 240507: 소프트맥스 연산 전후가 다름 -> KV 캐시 쓰기 위치 문제였음, 레이어별 차이는 benchmarks.bench_parity로 확인
         scores = mxc.softmax(scores.astype(mxc.float32), axis=-1).astype(q.dtype)
 
         # [batch_size, n_local_heads, input_len, head_dim]
@@ -338,7 +341,6 @@ class MLXGemmaDecoderLayer(mx.Module):
         # Self Attention
         residual = hidden_states
         hidden_states = self.input_layernorm(hidden_states)
-        print("어텐션 첫 번쨰 레이어 노름", hidden_states)
         hidden_states = self.self_attn(
             hidden_states=hidden_states,
             freqs_cis=freqs_cis,
@@ -398,44 +400,22 @@ class MLXGemmaModel(mx.Module):
     
 
 class MLXGemmaForCausalLM(mx.Module):
-    def __init__(self, config):
+    def __init__(self, config, tokenizer: Optional[Tokenizer] = None):
         super().__init__()
         self.config = config
         assert config.hidden_size % config.num_attention_heads == 0
-        print("dtype :   ", config.dtype)
-        max_seq_len    = config.max_position_embeddings
         head_dim       = config.head_dim
         vocab_size     = config.vocab_size
-        self.tokenizer = tokenizer.Tokenizer(config.tokenizer)
+        # config.tokenizer가 None이면 토큰 아이디만 다룬다 (벤치마크, parity 검사).
+        if tokenizer is None and config.tokenizer is not None:
+            tokenizer = Tokenizer(config.tokenizer)
+        self.tokenizer = tokenizer
         self.embedder  = MLXEmbedding(vocab_size, config.hidden_size, config.quant)
         self.model     = MLXGemmaModel(config)
         self.sampler   = MLXSampler(vocab_size)
 
-        rope_theta = getattr(config, "rope_theta", 10000)
-        self.freqs_cis = MLXprecompute_freqs_cis(head_dim, max_seq_len * 2, theta = rope_theta)
-
-        self.tensors = self.get_weight()
-        value        = self.tensors.get("embedder.weight", self.tensors.get("embed_tokens.weight", "Key not found"))
-        self.embedder.embedding.weight = mxc.array(value.numpy()).astype(mxc.float32)
-
-        mlx_weight  = mxc.load("model/gemma-1.1-2b-it/safe_mlx_model.safetensors")
-        for idx in range(len(self.model.layers)):
-            self.model.layers[idx].input_layernorm.weight = mlx_weight[
-                "model.layers.{}.input_layernorm.weight".format(idx)]
-            self.model.layers[idx].self_attn.qkv_proj.weight = mlx_weight[
-                "model.layers.{}.self_attn.qkv_proj.weight".format(idx)]
-            self.model.layers[idx].self_attn.o_proj.weight = mlx_weight[
-                "model.layers.{}.self_attn.o_proj.weight".format(idx)]
-            self.model.layers[idx].mlp.gate_proj.weight = mlx_weight[
-                "model.layers.{}.mlp.gate_proj.weight".format(idx)]
-            self.model.layers[idx].mlp.up_proj.weight = mlx_weight[
-                "model.layers.{}.mlp.up_proj.weight".format(idx)]
-            self.model.layers[idx].mlp.down_proj.weight = mlx_weight[
-                "model.layers.{}.mlp.down_proj.weight".format(idx)]
-            self.model.layers[idx].post_attention_layernorm.weight = mlx_weight[
-                "model.layers.{}.post_attention_layernorm.weight".format(idx)]
-        self.model.norm.weight = mlx_weight["model.norm.weight"]
-        print("MLX weight 업로드")
+        # GemmaForCausalLM.rotary_embedding처럼 필요한 위치까지만 계산하여 늘린다.
+        self.freqs_cis = mxc.zeros((0, head_dim // 2, 2), dtype=mxc.float32)
 
     def __call__(self,
         input_token_ids: mxc.array,
@@ -449,7 +429,38 @@ class MLXGemmaForCausalLM(mx.Module):
         top_ks: mxc.array,
         **kwargs,
         ) -> mxc.array:
-        freqs_cis        = self.freqs_cis[mxc.array(input_positions.numpy())]
+        hidden_states = self._hidden_states(input_token_ids, input_positions, kv_caches, mask)
+
+        # HC: embedder의 weight를 reuse한다.
+        embedder_weight = self.embedder.embedding.weight
+        if self.config.quant:
+            embedder_weight = (embedder_weight * self.embedder.weight_scaler[:, None])
+        next_tokens = self.sampler(
+            embedding=embedder_weight,
+            hidden_states=hidden_states,
+            output_positions=mxc.array(output_positions.numpy()),
+            temperatures=None if temperatures is None else mxc.array(temperatures.numpy()),
+            top_ps=mxc.array(top_ps.numpy()),
+            top_ks=mxc.array(top_ks.numpy()),
+            )
+        return next_tokens
+    
+    def rotary_embedding(self, positions: torch.Tensor) -> mxc.array:
+        """freqs_cis rows (cos, sin) of the given positions, extending the table on first use of a position."""
+        end = int(positions.max()) + 1
+        if end > self.freqs_cis.shape[0]:
+            size = max(256, 1 << (end - 1).bit_length())
+            self.freqs_cis = MLXprecompute_freqs_cis(self.config.head_dim, size, theta=self.config.rope_theta)
+        return self.freqs_cis[mxc.array(positions.numpy())]
+
+    def _hidden_states(self,
+        input_token_ids: torch.Tensor,
+        input_positions: torch.Tensor,
+        kv_caches: List[Tuple[mxc.array, mxc.array]],
+        mask: torch.Tensor,
+        ) -> mxc.array:
+        # GemmaForCausalLM._hidden_states와 같은 순서: 임베딩 -> 디코더 레이어 -> 마지막 RMSNorm
+        freqs_cis        = self.rotary_embedding(input_positions)
         kv_write_indices = mxc.array(input_positions.numpy())
 
         # 프롬프트 아이디를 임베딩: 해당되는 단어 아이디만 2048 차원 벡터로 변환하여 행렬 구성
@@ -458,7 +469,7 @@ class MLXGemmaForCausalLM(mx.Module):
         hidden_states = self.embedder(mxc.array(input_token_ids.numpy()))
         # Gemma normalizes the embedding by sqrt(hidden_size).
         hidden_states = hidden_states * (self.config.hidden_size**0.5)
-        hidden_states = self.model(
+        return self.model(
             hidden_states=hidden_states,
             freqs_cis=freqs_cis,
             kv_write_indices=kv_write_indices,
@@ -466,20 +477,6 @@ class MLXGemmaForCausalLM(mx.Module):
             mask=mxc.array(mask.numpy()),
             )
 
-        # HC: embedder의 weight를 reuse한다.
-        embedder_weight = self.embedder.embedding.weight
-        if self.config.quant:
-            embedder_weight = (embedder_weight * self.embedder.weight_scaler.unsqueeze(-1))
-        next_tokens = self.sampler(
-            embedding=embedder_weight,
-            hidden_states=hidden_states,
-            output_positions=mxc.array(output_positions.numpy()),
-            temperatures=mxc.array(temperatures.numpy()),
-            top_ps=mxc.array(top_ps.numpy()),
-            top_ks=mxc.array(top_ks.numpy()),
-            )
-        return next_tokens
-    
     def generate(self,
         prompts: Union[str, Sequence[str]],
         output_len: int = 100,
@@ -577,42 +574,53 @@ class MLXGemmaForCausalLM(mx.Module):
         return results[0] if is_str_prompt else results
 
 
-    def get_weight(self):
-        tensors     = {}
-        tmp_tensors = {}
-
-        # *.safetensor 버전
-        # path        = "./model/gemma-1.1-2b-it/"
-        # model_name  = "model-{}-of-{}.safetensors"
-        # model1 = safetensors.safe_open(path+model_name.format("00001", "00002"), framework="pt")
-        # model2 = safetensors.safe_open(path+model_name.format("00002", "00002"), framework="pt")
-
-        # # saftetensor를 그대로 쓰지 않고, q_proj, k_proj, v_proj를 하나로 엮어서 qkv_proj로 만들어야 올바른 추론이 됨
-        # for key in model1.keys() + model2.keys():
-        #     if key in model1.keys():
-        #         tmp_tensors[key] = model1.get_tensor(key).type(torch.float32)
-        #     elif key in model2.keys():
-        #         tmp_tensors[key] = model2.get_tensor(key).type(torch.float32)
-
-        # for idx in range(18):
-        #     qkv_weight = torch.cat([
-        #         tmp_tensors["model.layers.{}.self_attn.q_proj.weight".format(idx)],
-        #         tmp_tensors["model.layers.{}.self_attn.k_proj.weight".format(idx)],
-        #         tmp_tensors["model.layers.{}.self_attn.v_proj.weight".format(idx)]],
-        #         dim = 0)
-        #     tmp_tensors["model.layers.{}.self_attn.qkv_proj.weight".format(idx)] = qkv_weight
-
-        # for key in tmp_tensors.keys():
-        #     # q, k, v 행렬은 concat하여 qkv_proj 형태로 저장하므로 continue
-        #     if "q_proj" in key or "k_proj" in key or "v_proj" in key and "qkv_proj" not in key:
-        #         continue
-        #     else:
-        #         tensors[key] = tmp_tensors[key]
-        
-        # *.ckpt 버전
-        weight = torch.load("model/gemma-1.1-2b-it/gemma-1.1-2b-it.ckpt", mmap=True, weights_only=True)["model_state_dict"]
-        for key in weight.keys():
-            if "complex" in str(weight[key].dtype):
+    def load_state_dict(self, state_dict: Dict[str, torch.Tensor]):
+        """
+        Copies a GemmaForCausalLM state dict (torch 텐서) into this model.
+        embedding은 model.embed_tokens 또는 embedder 이름 모두 허용하고, freqs_cis 같은 buffer는 무시한다.
+        """
+        dtype   = mxc.bfloat16 if self.config.dtype == "bfloat16" else mxc.float32
+        weights = {}
+        for key, tensor in state_dict.items():
+            match = re.match(r"(?:model\.)?(embed_tokens|embedder)\.(weight|weight_scaler)$", key)
+            if match is not None:
+                key = "embedder.embedding.weight" if match.group(2) == "weight" else "embedder.weight_scaler"
+            elif not key.startswith("model.layers.") and not key.startswith("model.norm."):
                 continue
-            tensors[key] = weight[key].type(torch.float32)
-        return tensors
\ No newline at end of file
+            if tensor.is_floating_point():
+                weights[key] = mxc.array(tensor.float().numpy()).astype(dtype)
+            else:
+                weights[key] = mxc.array(tensor.numpy())
+        # freqs_cis는 weight가 아니므로 strict 대신 빠진 weight만 검사
+        missing = {key for key, _ in tree_flatten(self.parameters())} - set(weights) - {"freqs_cis"}
+        if missing:
+            raise ValueError(f"missing weights: {sorted(missing)[:5]}")
+        self.load_weights(list(weights.items()), strict=False)
+        return self
+
+    def save_weights(self, path: str, source: Optional[str] = None):
+        """
+        Saves the converted mlx weights as one safetensors file (warm start), without freqs_cis.
+        다음 실행은 torch 텐서 변환 없이 load_weights_file(path)로 읽는다.
+        """
+        weights = {key: value for key, value in tree_flatten(self.parameters()) if key != "freqs_cis"}
+        # 파일 객체로 저장하여 확장자가 .safetensors가 아닌 경로에도 그대로 쓴다.
+        with open(path, "wb") as f:
+            mxc.save_safetensors(f, weights, metadata={"weight_config": weight_config_key(self.config, source)})
+
+    def load_weights_file(self, path: str):
+        """Loads a file written by save_weights."""
+        self.load_weights(list(mxc.load(path, format="safetensors").items()), strict=False)
+        return self
+
+    def load_torch_weights(self, model_path: str):
+        """Loads the same safetensors files (or pack-gemma.py snapshot) as GemmaForCausalLM.load_weights."""
+        if is_snapshot(model_path):
+            return self.load_state_dict(read_snapshot(model_path)[0])
+        model_paths = get_weight_paths(model_path)
+        state_dict = {}
+        for path in model_paths:
+            with safetensors.safe_open(path, framework="pt") as model_file:
+                for key in model_file.keys():
+                    state_dict.setdefault(key, model_file.get_tensor(key))
+        return self.load_state_dict(state_dict)
@@ -12,20 +12,43 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # Inference-only Gemma model implementation.
+import os
+import math
 import re
+import dataclasses
 from typing import (
     Any, 
+    Dict, 
+    Iterator, 
     List, 
     Optional, 
     Sequence, 
+    Set, 
     Tuple, 
     Union)
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import safetensors
+from safetensors.torch import save_file
 from source.config import *
 from source.tokenizer import *
+from source.chat import ChatTemplate
+from source.metrics import GenerationMetrics
+from source.lora import (
+    LoRAWeights,
+    MultiLoRA
+    )
+from source.snapshot import (
+    is_snapshot,
+    read_snapshot,
+    write_snapshot
+    )
+from source.quantize import (
+    dequantize_weight,
+    get_quant_shapes,
+    quantized_linear
+    )
 
 
 def precompute_freqs_cis(dim: int, end: int, theta: float = 10000.0) -> torch.Tensor:
@@ -46,41 +69,264 @@ def apply_rotary_emb(x: torch.Tensor, freqs_cis: torch.Tensor) -> torch.Tensor:
     return x_out
 
 
+MASK_VALUE = -2.3819763e38
+
+
+def causal_mask(positions: torch.Tensor, max_seq_len: int) -> torch.Tensor:
+    """[1, 1, len(positions), max_seq_len] mask rows: 0 up to each position, a large negative value after it."""
+    mask = torch.full((1, 1, positions.shape[0], max_seq_len), MASK_VALUE, dtype=torch.float)
+    keys = torch.arange(max_seq_len, dtype=torch.int64)
+    return mask.masked_fill_(keys.unsqueeze(dim=0) <= positions.unsqueeze(dim=1), 0.0)
+
+
+MASK32 = 0xFFFFFFFF
+
+
+def _mul32(x: torch.Tensor, c: int) -> torch.Tensor:
+    # (x * c) mod 2^32, int64 곱셈이 overflow 되지 않도록 16비트씩 나누어 계산
+    lo = x * (c & 0xFFFF)
+    hi = ((x * (c >> 16)) & 0xFFFF) << 16
+    return (lo + hi) & MASK32
+
+
+def hash32(x: torch.Tensor) -> torch.Tensor:
+    # 32비트 정수 해시 (lowbias32), int64 텐서의 하위 32비트를 사용
+    x = x & MASK32
+    x = x ^ (x >> 16)
+    x = _mul32(x, 0x7FEB352D)
+    x = x ^ (x >> 15)
+    x = _mul32(x, 0x846CA68B)
+    x = x ^ (x >> 16)
+    return x
+
+
+def sampling_keys(seeds: torch.Tensor, offsets: torch.Tensor) -> torch.Tensor:
+    """Per-row [batch_size] keys from the request seeds and the position being sampled."""
+    keys = hash32(seeds)
+    keys = hash32(keys ^ ((seeds >> 32) & MASK32))
+    return hash32(keys ^ offsets)
+
+
+def gumbel_noise(keys: torch.Tensor, token_ids: torch.Tensor) -> torch.Tensor:
+    """
+    Counter-based Gumbel(0, 1) noise for (row key, token id) pairs.
+    1. 같은 seed, 같은 위치, 같은 토큰이면 배치 구성과 vocab 타일 크기에 관계없이 같은 값
+    2. token_ids는 [N] (모든 행에 공통) 또는 [batch_size, N]
+    """
+    u = hash32(keys.unsqueeze(dim=1) ^ hash32(token_ids + 0x9E3779B9))
+    # 상위 24비트로 (0, 1) 범위의 float32 uniform을 만든다.
+    u = ((u >> 8).float() + 0.5) / 16777216.0
+    return -torch.log(-torch.log(u))
+
+
+@dataclasses.dataclass
+class SamplingPenalties:
+    # [batch_size] 반복 패널티 (1.0이면 적용 안 함), 프롬프트와 출력에 등장한 토큰에 적용
+    repetition_penalties: torch.Tensor
+    # [batch_size] frequency / presence 패널티 (0.0이면 적용 안 함), 출력에 등장한 토큰에만 적용
+    frequency_penalties: torch.Tensor
+    presence_penalties: torch.Tensor
+    # [batch_size, vocab_size] 출력 토큰의 등장 횟수
+    output_token_counts: torch.Tensor
+    # [batch_size, vocab_size] 프롬프트에 등장한 토큰이면 True
+    prompt_token_mask: torch.Tensor
+
+    def apply(self, logits: torch.Tensor, start: int = 0, end: Optional[int] = None) -> torch.Tensor:
+        """Applies the penalties to the [batch_size, start:end] logits tile over the whole batch."""
+        counts    = self.output_token_counts[:, start:end]
+        appeared  = counts > 0
+        penalties = self.repetition_penalties.unsqueeze(dim=1)
+        # 양수 로짓은 나누고 음수 로짓은 곱하여 항상 확률을 낮춘다.
+        repeated  = appeared | self.prompt_token_mask[:, start:end]
+        logits    = torch.where(
+            repeated, torch.where(logits > 0, logits / penalties, logits * penalties), logits)
+        logits    = logits - self.frequency_penalties.unsqueeze(dim=1) * counts
+        logits    = logits - self.presence_penalties.unsqueeze(dim=1) * appeared
+        return logits
+
+    def update(self, token_ids: torch.Tensor, generated_mask: torch.Tensor):
+        # 이번 스텝에 생성된 (프롬프트가 아닌) 토큰의 등장 횟수를 더한다.
+        self.output_token_counts.scatter_add_(
+            1, token_ids.view(-1, 1), generated_mask.view(-1, 1).to(self.output_token_counts.dtype))
+
+
 class Sampler(nn.Module):
-    def __init__(self, vocab_size: int):
+    def __init__(self, vocab_size: int, vocab_chunk_size: Optional[int] = None):
         super().__init__()
         self.vocab_size = vocab_size
+        # None이면 [batch_size, vocab_size] 전체 로짓을 계산
+        # 아니면 vocab_chunk_size 단위의 타일로 로짓을 계산하며 top-k, max, logsumexp만 유지
+        self.vocab_chunk_size = vocab_chunk_size
+
+    def _embedding_tile(self, embedding, start: int, end: int) -> torch.Tensor:
+        # 양자화된 Embedding이면 해당 타일의 행만 역양자화
+        if isinstance(embedding, Embedding):
+            return embedding.dequantize(start, end)
+        return embedding[start:end]
+
+    def _logits_tiles(self, embedding, hidden_states, embedding_bias, penalties=None):
+        # (start, [batch_size, tile] float 로짓)을 vocab 순서대로 반환
+        chunk_size = self.vocab_chunk_size or self.vocab_size
+        for start in range(0, self.vocab_size, chunk_size):
+            end    = min(start + chunk_size, self.vocab_size)
+            logits = torch.matmul(hidden_states, self._embedding_tile(embedding, start, end).t()).float()
+            if embedding_bias is not None:
+                logits += embedding_bias[..., start:end]
+            if penalties is not None:
+                logits = penalties.apply(logits, start, end)
+            yield start, logits
+
+    @torch.no_grad()
+    def log_probs(self, embedding, hidden_states: torch.Tensor, token_ids: torch.Tensor) -> torch.Tensor:
+        """
+        Log-probabilities [N] of token_ids [N] given hidden_states [N, hidden_size].
+        logsumexp는 vocab 타일마다 누적하므로 [N, vocab_size] 로짓을 만들지 않는다 (vocab_chunk_size가 None이면 한 타일).
+        """
+        lse = None
+        for _, logits in self._logits_tiles(embedding, hidden_states, None):
+            tile_lse = torch.logsumexp(logits, dim=-1)
+            lse = tile_lse if lse is None else torch.logaddexp(lse, tile_lse)
+        # 정답 토큰의 로짓은 해당 임베딩 행과의 내적 (양자화된 경우 그 행만 역양자화)
+        if isinstance(embedding, Embedding):
+            rows = embedding(token_ids)
+        else:
+            rows = embedding[token_ids]
+        target = torch.matmul(hidden_states.unsqueeze(dim=1), rows.unsqueeze(dim=2)).flatten().float()
+        return target - lse
+
+    @torch.no_grad()
+    def chunked_argmax(self, embedding, hidden_states, embedding_bias=None, penalties=None) -> torch.Tensor:
+        """Greedy token ids over vocabulary tiles, identical to argmax of the full logits."""
+        max_values, max_ids = None, None
+        for start, logits in self._logits_tiles(embedding, hidden_states, embedding_bias, penalties):
+            values, ids = torch.max(logits, dim=-1)
+            if max_values is None:
+                max_values, max_ids = values, ids + start
+                continue
+            # 같은 값이면 앞쪽 인덱스를 유지 (torch.argmax와 동일)
+            better     = values > max_values
+            max_values = torch.where(better, values, max_values)
+            max_ids    = torch.where(better, ids + start, max_ids)
+        return max_ids
+
+    @torch.no_grad()
+    def chunked_top_k(self,
+        embedding,
+        hidden_states: torch.Tensor,
+        k: int,
+        temperatures: torch.Tensor,
+        embedding_bias: Optional[torch.Tensor] = None,
+        penalties: Optional[SamplingPenalties] = None,
+        ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Running top-k over vocabulary tiles.
+        Returns (top-k logits / temperature in descending order, their token ids,
+        logsumexp of logits / temperature over the whole vocabulary).
+        """
+        top_values, top_ids, lse = None, None, None
+        temperatures = temperatures.unsqueeze(dim=1)
+        for start, logits in self._logits_tiles(embedding, hidden_states, embedding_bias, penalties):
+            logits.div_(temperatures)
+            tile_lse = torch.logsumexp(logits, dim=-1)
+            values, ids = torch.topk(logits, min(k, logits.shape[-1]), dim=-1)
+            if top_values is None:
+                top_values, top_ids, lse = values, ids + start, tile_lse
+                continue
+            lse = torch.logaddexp(lse, tile_lse)
+            values = torch.cat([top_values, values], dim=-1)
+            ids    = torch.cat([top_ids, ids + start], dim=-1)
+            top_values, order = torch.topk(values, min(k, values.shape[-1]), dim=-1)
+            top_ids = torch.gather(ids, dim=-1, index=order)
+        return top_values, top_ids, lse
 
     @torch.no_grad()
     def forward(self,
-        embedding: torch.Tensor,
+        embedding: Union[torch.Tensor, "Embedding"],
         hidden_states: torch.Tensor,
         output_positions: torch.Tensor,
         temperatures: Union[torch.Tensor, None],
         top_ps: torch.Tensor,
         top_ks: torch.Tensor,
         embedding_bias: Optional[torch.Tensor] = None,
+        penalties: Optional[SamplingPenalties] = None,
+        sampling_keys: Optional[torch.Tensor] = None,
         ) -> torch.Tensor:
+        """
+        1. temperatures, top_ps, top_ks는 [batch_size]로 행마다 다른 값을 가질 수 있다.
+        2. temperatures가 0 이하인 행은 greedy, temperatures가 None이면 배치 전체가 greedy
+        3. embedding_bias는 [vocab_size] 또는 [batch_size, vocab_size]의 logit bias
+        4. sampling_keys가 있으면 전역 RNG의 multinomial 대신 행마다의 key로 Gumbel-max 샘플링
+        """
         # Select the last element for each sequence.
         # (batch_size, input_len, hidden_size) -> (batch_size, hidden_size)
         # output_position에 해당하는 인덱스 값의 dim = 1을 읽기
         hidden_states = hidden_states.index_select(1, output_positions).squeeze(dim=1)
+        if self.vocab_chunk_size is not None:
+            return self._chunked_forward(
+                embedding, hidden_states, temperatures, top_ps, top_ks, embedding_bias, penalties, sampling_keys)
 
         # embedding.t()와 matmul하여 256000개의 단어 사전 로짓을 계산
-        logits = torch.matmul(hidden_states, embedding.t())
+        # bfloat16 모델이어도 로짓 이후(패널티, softmax, top-p)는 float32로 계산
+        if isinstance(embedding, Embedding):
+            embedding = embedding.dequantize()
+        logits = torch.matmul(hidden_states, embedding.t()).float()
         if embedding_bias is not None:
             logits += embedding_bias
+        if penalties is not None:
+            logits = penalties.apply(logits)
 
         # temperature가 None이면, 가장 큰 값을 로짓으로 선택, 아니면 temperature 스케일링 적용
         if temperatures is None:
             return torch.argmax(logits, dim=-1).squeeze(dim=-1)
-        logits.div_(temperatures.unsqueeze(dim=1))
+        greedy_mask    = temperatures <= 0
+        greedy_ids     = torch.argmax(logits, dim=-1)
+        logits.div_(torch.where(greedy_mask, 1.0, temperatures).unsqueeze(dim=1))
 
         # 1. 모든 가능한 단어에 대한 모델 예측의 확률 분포를 계산
         # 2. 내림차순으로 정렬, probs_idx는 내림차순한 원소들이 몇 번 인덱스 인지를 반환
         probs = torch.softmax(logits, dim=-1, dtype=torch.float)
         probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)
+        probs_sort = self._filter_probs(probs_sort, top_ps, top_ks)
+
+        # 1. 필터링된 과정에서 prob_sort를 probs_idx에 따라 재정렬
+        # 2. multinomial에 따라 probs에서 1개를 선택하여 next_token으로 반환
+        probs = torch.gather(probs_sort, dim=-1, index=torch.argsort(probs_idx, dim=-1))
+        if sampling_keys is None:
+            next_token_ids = torch.multinomial(probs, num_samples=1, replacement=True).squeeze(dim=-1)
+        else:
+            token_ids = torch.arange(probs.shape[-1], device=probs.device)
+            next_token_ids = self._gumbel_max(probs, sampling_keys, token_ids)
+        return torch.where(greedy_mask, greedy_ids, next_token_ids)
+
+    def _gumbel_max(self, probs, keys, token_ids):
+        # argmax(log p + Gumbel)은 p에서 하나를 샘플링한 것과 같은 분포 (p = 0이면 -inf)
+        scores = torch.log(probs) + gumbel_noise(keys, token_ids)
+        return torch.argmax(scores, dim=-1)
+
+    def _chunked_forward(self,
+        embedding, hidden_states, temperatures, top_ps, top_ks, embedding_bias, penalties, sampling_keys=None):
+        # [batch_size, vocab_size] 로짓을 만들지 않는 경로
+        if temperatures is None:
+            return self.chunked_argmax(embedding, hidden_states, embedding_bias, penalties)
+
+        # top-k 후보의 확률은 exp(logit / T - logsumexp)로 전체 vocab에 대해 정규화된 값과 같다.
+        # top-p 마스크는 내림차순 누적합에만 의존하므로 k개 후보만으로 전체 경로와 동일한 분포를 얻는다.
+        # greedy 행은 temperature 1로 계산하고 top-1 후보를 그대로 사용한다.
+        greedy_mask = temperatures <= 0
+        k = min(int(top_ks.max()), self.vocab_size)
+        top_values, top_ids, lse = self.chunked_top_k(
+            embedding, hidden_states, k, torch.where(greedy_mask, 1.0, temperatures), embedding_bias, penalties)
+        probs_sort = torch.exp(top_values - lse.unsqueeze(dim=1))
+        probs_sort = self._filter_probs(probs_sort, top_ps, top_ks)
+        if sampling_keys is None:
+            next_token_ids = torch.multinomial(probs_sort, num_samples=1, replacement=True)
+        else:
+            # 노이즈는 후보의 토큰 아이디로 계산하므로 전체 로짓 경로와 같은 토큰을 고른다.
+            next_token_ids = self._gumbel_max(probs_sort, sampling_keys, top_ids).unsqueeze(dim=-1)
+        next_token_ids = torch.gather(top_ids, dim=-1, index=next_token_ids).squeeze(dim=-1)
+        return torch.where(greedy_mask, top_ids[:, 0], next_token_ids)
 
+    def _filter_probs(self, probs_sort, top_ps, top_ks):
         # 1. 정렬된 확률의 누적합을 계산 -> 모든 값을 더하면 끝에서 1
         # 2. 누적합과 내림차순확률의 차이를 계산 -> 차이가 top_pos보다 큰 것만 선택 
         # 3. 누적확률이 top p에 도달하기 단어만 선택
@@ -89,49 +335,88 @@ class Sampler(nn.Module):
         top_ps_mask = (probs_sum - probs_sort) > top_ps.unsqueeze(dim=1)
         probs_sort  = torch.where(top_ps_mask, 0, probs_sort) # (boolean, x, y), True이면 x, False이면 y
 
-        # 1. probs_idx 길이만큼의 0 ~ 숫자 텐서 생성
+        # 1. probs_sort 길이만큼의 0 ~ 숫자 텐서 생성
         # 2. top_ks보다 큰 것은 True로 마스킹
         # 3. 마스킹한 위치가 True이면 0, False이면 probs_sort로 하여 선택
-        top_ks_mask = torch.arange(probs_idx.shape[-1], device=probs_idx.device)
-        top_ks_mask = top_ks_mask.expand(probs_idx.shape[0], -1)
+        top_ks_mask = torch.arange(probs_sort.shape[-1], device=probs_sort.device)
+        top_ks_mask = top_ks_mask.expand(probs_sort.shape[0], -1)
         top_ks_mask = top_ks_mask >= top_ks.unsqueeze(dim=1)
         probs_sort  = torch.where(top_ks_mask, 0, probs_sort)
 
-        # 1. top-p, top-k로 필터링된 probs_sort를 재정규화
-        # 2. 필터링된 과정에서 prob_sort를 probs_idx에 따라 재정렬
-        # 3. multinomial에 따라 probs에서 1개를 선택하여 next_token으로 반환
+        # top-p, top-k로 필터링된 probs_sort를 재정규화
         probs_sort.div_(probs_sort.sum(dim=-1, keepdim=True))
-        probs = torch.gather(probs_sort, dim=-1, index=torch.argsort(probs_idx, dim=-1))
-        next_token_ids = torch.multinomial(probs, num_samples=1, replacement=True).squeeze(dim=-1)
-        return next_token_ids
+        return probs_sort
 
 
 class Embedding(nn.Module):
-    def __init__(self, num_embeddings: int, embedding_dim: int, quant: bool):
+    def __init__(self,
+        num_embeddings: int,
+        embedding_dim: int,
+        quant: bool,
+        quant_bits: int = 8,
+        quant_group_size: int = 0,
+        ):
         super().__init__()
         """
         1. in_features, out_feature를 받아서 embedding 레이어를 만든다.
         2. Quantization을 한다면, out_feuatre로 weight_scaler를 만들어서 곱한다.
+        3. quant_group_size > 0이면 embedding_dim을 그룹으로 나누어 그룹마다 weight_scaler를 둔다.
         """
         if quant:
+            weight_shape, weight_dtype, scaler_shape = get_quant_shapes(
+                num_embeddings, embedding_dim, quant_bits, quant_group_size)
             self.weight = nn.Parameter(
-                torch.empty((num_embeddings, embedding_dim), dtype=torch.int8), 
+                torch.empty(weight_shape, dtype=weight_dtype), 
                 requires_grad=False
                 )
-            self.weight_scaler = nn.Parameter(torch.Tensor(num_embeddings))
+            self.weight_scaler = nn.Parameter(torch.empty(scaler_shape), requires_grad=False)
         else:
             self.weight = nn.Parameter(
                 torch.empty((num_embeddings, embedding_dim)), 
                 requires_grad=False
                 )
         self.quant = quant
+        self.quant_bits = quant_bits
+        self.quant_group_size = quant_group_size
+
+    def dequantize(self, start: int = 0, end: Optional[int] = None) -> torch.Tensor:
+        """Returns rows [start, end) of the float embedding table (the tied LM head)."""
+        weight = self.weight[start:end]
+        if not self.quant:
+            return weight
+        return dequantize_weight(
+            weight, self.weight_scaler[start:end], self.quant_bits, self.quant_group_size)
 
     def forward(self, x):
-        weight = self.weight
-        if self.quant:
-            weight = weight * self.weight_scaler.unsqueeze(-1)
-        output = F.embedding(x, weight)
-        return output
+        if not self.quant:
+            return F.embedding(x, self.weight)
+        # 전체 테이블이 아니라 조회한 행만 역양자화
+        return dequantize_weight(
+            self.weight[x], self.weight_scaler[x], self.quant_bits, self.quant_group_size)
+
+
+def add_rms_norm(
+    x: torch.Tensor,
+    residual: Optional[torch.Tensor],
+    scale: torch.Tensor,
+    eps: float,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Fused residual add + RMSNorm: returns (normed output, updated residual) in one pass.
+    1. residual이 None이면 x 자체가 residual (첫 레이어)
+    2. 더하기와 정규화는 float32로 계산하고, scale은 미리 계산해 둔 float32 (1 + weight)
+    3. float32 입력이면 x에 in-place로 더하므로 x는 이후에 사용하지 않아야 한다 (sublayer의 출력).
+    """
+    hidden = x.float()
+    if residual is not None:
+        hidden = hidden.add_(residual) if hidden is x else hidden + residual
+    residual = hidden.to(x.dtype)
+    if hasattr(F, "rms_norm"):
+        output = F.rms_norm(hidden, hidden.shape[-1:], scale, eps)
+    else:
+        output = hidden * torch.rsqrt(hidden.pow(2).mean(-1, keepdim=True) + eps)
+        output.mul_(scale)
+    return output.to(x.dtype), residual
 
 
 class RMSNorm(torch.nn.Module):
@@ -139,52 +424,178 @@ class RMSNorm(torch.nn.Module):
         dim: int,
         eps: float = 1e-6,
         add_unit_offset: bool = True,
+        use_compile: bool = False,
         ):
         super().__init__()
         # https://arxiv.org/abs/1910.07467
         self.eps = eps
         self.add_unit_offset = add_unit_offset
         self.weight = nn.Parameter(torch.zeros(dim))
+        # float32 (1 + weight): weight가 로드되거나 바뀌면 (_version) 한 번만 다시 계산
+        self.register_buffer("scale", torch.zeros(dim, dtype=torch.float32), persistent=False)
+        self._scale_version = None
+        # use_compile이면 torch.compile로 더하기와 정규화를 하나의 CPU 커널로 합친다.
+        self._add_rms_norm = torch.compile(add_rms_norm, dynamic=True) if use_compile else add_rms_norm
+
+    def _scale(self) -> torch.Tensor:
+        version = (self.weight._version, self.weight.data_ptr())
+        if self._scale_version != version:
+            weight = self.weight.detach().float()
+            self.scale.copy_(weight + 1 if self.add_unit_offset else weight)
+            self._scale_version = version
+        return self.scale
+
+    def forward(self, x, residual: Optional[torch.Tensor] = None):
+        """
+        residual이 없으면 정규화한 x를, 있으면 (정규화한 x + residual, x + residual)을 반환한다.
+        bfloat16 입력도 정규화와 scale 곱은 float32로 계산하고 마지막에 원래 dtype으로 변환
+        """
+        output, new_residual = self._add_rms_norm(x, residual, self._scale(), self.eps)
+        if residual is None:
+            return output
+        return output, new_residual
 
-    def _norm(self, x):
-        return x * torch.rsqrt(x.pow(2).mean(-1, keepdim=True) + self.eps)
 
-    def forward(self, x):
-        x = self._norm(x.float()).type_as(x)
+class Workspace:
+    # 슬롯 0: attention score, MLP gate (동시에 살아있지 않음) / 슬롯 1: MLP up
+    SCORES, GATE, UP = 0, 0, 1
 
-        if self.add_unit_offset:
-            output = x * (1 + self.weight)
-        else:
-            output = x * self.weight
-        return output
+    def __init__(self):
+        """
+        Activation buffers shared by every layer (config.low_memory).
+        레이어는 순서대로 실행되므로 슬롯마다 버퍼 하나를 최대 크기 (high-water mark)로 두고
+        모든 레이어와 스텝이 그 앞부분을 view로 재사용한다.
+        forward마다 trim(), generate_stream이 끝나면 clear()를 호출한다.
+        """
+        self.buffers: Dict[int, torch.Tensor] = {}
+        self.num_tokens = 0
+
+    def get(self, slot: int, shape: Tuple[int, ...], dtype: torch.dtype, device: Any) -> torch.Tensor:
+        numel  = math.prod(shape)
+        buffer = self.buffers.get(slot)
+        if buffer is None or buffer.numel() < numel or buffer.dtype != dtype or buffer.device != torch.device(device):
+            # 새로 할당하기 전에 기존 버퍼를 먼저 놓아준다.
+            self.buffers.pop(slot, None)
+            buffer = torch.empty(numel, dtype=dtype, device=device)
+            self.buffers[slot] = buffer
+        return buffer[:numel].view(shape)
+
+    def trim(self, num_tokens: int):
+        # forward의 토큰 수가 지난 forward의 1/4보다 작으면 (prefill 뒤의 디코딩) prefill 크기의 버퍼를 놓아준다.
+        if num_tokens * 4 < self.num_tokens:
+            self.buffers.clear()
+        self.num_tokens = num_tokens
+
+    def nbytes(self) -> int:
+        return sum(buffer.numel() * buffer.element_size() for buffer in self.buffers.values())
+
+    def clear(self):
+        self.buffers.clear()
+        self.num_tokens = 0
+
+
+class GenerationSession:
+    def __init__(self, config: GemmaConfig):
+        """
+        Buffers of generate_stream kept across calls: generate(..., session=session).
+        1. KV 캐시와 토큰 아이디 버퍼는 지금까지의 최대 batch_size * max_seq_len 크기로 한 번만 할당하고 (high-water mark),
+           요청마다 앞부분을 [batch_size, max_seq_len, ...] 연속 view로 사용한다. 요청마다 0으로 다시 채우지 않는다:
+           이전 요청이 남긴 위치는 causal 마스크로 가려지고, 모든 위치는 읽히기 전에 이번 요청이 다시 쓴다.
+        2. 디코딩 스텝의 마스크 행은 [0] * S + [MASK_VALUE] * S 버퍼의 view이므로 스텝마다 할당하지 않는다.
+        한 세션은 한 번에 하나의 generate_stream만 사용할 수 있다.
+        """
+        self.config      = config
+        self.device      = None
+        self.capacity    = 0
+        self.max_seq_len = 0
+        self.kv_buffers: List[Tuple[torch.Tensor, torch.Tensor]] = []
+        self.token_buffer: Optional[torch.Tensor] = None
+        self.mask_buffer: Optional[torch.Tensor] = None
+        self.in_use      = False
+
+    def acquire(self, batch_size: int, max_seq_len: int, device: Any):
+        assert not self.in_use, "a GenerationSession serves one generate_stream at a time"
+        if device is not None and torch.device(device) != self.device:
+            self.capacity, self.max_seq_len, self.device = 0, 0, torch.device(device)
+        num_tokens = batch_size * max_seq_len
+        if num_tokens > self.capacity:
+            # 새로 할당하기 전에 기존 버퍼를 놓아준다. 처음 한 번은 0으로 채워 유한한 값만 남긴다.
+            self.kv_buffers = []
+            numel = num_tokens * self.config.num_key_value_heads * self.config.head_dim
+            dtype = self.config.get_dtype()
+            for _ in range(self.config.num_hidden_layers):
+                self.kv_buffers.append((torch.zeros(numel, dtype=dtype, device=self.device),
+                                        torch.zeros(numel, dtype=dtype, device=self.device)))
+            self.token_buffer = torch.empty(num_tokens, dtype=torch.int64)
+            self.capacity     = num_tokens
+        if max_seq_len > self.max_seq_len:
+            self.mask_buffer = torch.full((2 * max_seq_len,), MASK_VALUE, dtype=torch.float)
+            self.mask_buffer[:max_seq_len] = 0.0
+            self.max_seq_len = max_seq_len
+        self.in_use = True
+
+    def release(self):
+        self.in_use = False
+
+    def kv_caches(self, batch_size: int, max_seq_len: int) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+        size  = (batch_size, max_seq_len, self.config.num_key_value_heads, self.config.head_dim)
+        numel = math.prod(size)
+        return [(k[:numel].view(size), v[:numel].view(size)) for k, v in self.kv_buffers]
+
+    def token_ids(self, batch_size: int, max_seq_len: int, pad_id: int) -> torch.Tensor:
+        return self.token_buffer[:batch_size * max_seq_len].view(batch_size, max_seq_len).fill_(pad_id)
+
+    def mask_row(self, position: int, max_seq_len: int) -> torch.Tensor:
+        # causal_mask(torch.tensor([position]), max_seq_len)와 같은 값: 키 k는 k <= position이면 0
+        start = self.max_seq_len - 1 - position
+        return self.mask_buffer[start:start + max_seq_len].view(1, 1, 1, max_seq_len)
 
 
 class Linear(nn.Module):
-    def __init__(self, in_features: int, out_features: int, quant: bool):
+    def __init__(self,
+        in_features: int,
+        out_features: int,
+        quant: bool,
+        quant_bits: int = 8,
+        quant_group_size: int = 0,
+        ):
         super().__init__()
         """
         1. in_features, out_feature를 받아서 MLP 레이어를 만든다.
         2. Quantization을 한다면, out_feuatre로 weight_scaler를 만들어서 곱한다.
         3. nn.Parameters로 torch.empty(~~)를 담는다.
+        4. quant_bits = 4이면 두 개의 int4 값을 uint8 하나에 packing한다.
         """
         if quant:
+            weight_shape, weight_dtype, scaler_shape = get_quant_shapes(
+                out_features, in_features, quant_bits, quant_group_size)
             self.weight = nn.Parameter(
-                torch.empty((out_features, in_features), dtype=torch.int8), 
+                torch.empty(weight_shape, dtype=weight_dtype), 
                 requires_grad=False
                 )
-            self.weight_scaler = nn.Parameter(torch.Tensor(out_features))
+            self.weight_scaler = nn.Parameter(torch.empty(scaler_shape), requires_grad=False)
         else:
             self.weight = nn.Parameter(
                 torch.empty((out_features, in_features)), 
                 requires_grad=False
                 )
         self.quant = quant
+        self.quant_bits = quant_bits
+        self.quant_group_size = quant_group_size
+        # load_adapter로 LoRA adapter를 로드하면 모든 adapter의 low-rank delta (LoRAWeights, state_dict에 포함되지 않음)
+        self.lora: Optional[LoRAWeights] = None
 
-    def forward(self, x):
-        weight = self.weight
+    def forward(self, x, out: Optional[torch.Tensor] = None):
+        # out (Workspace 버퍼)은 float weight에서만 사용하고, 양자화된 weight는 새 텐서를 반환
         if self.quant:
-            weight = weight * self.weight_scaler.unsqueeze(-1)
-        output = F.linear(x, weight)
+            output = quantized_linear(
+                x, self.weight, self.weight_scaler, self.quant_bits, self.quant_group_size)
+        elif out is not None:
+            output = torch.matmul(x, self.weight.t(), out=out)
+        else:
+            output = F.linear(x, self.weight)
+        if self.lora is not None:
+            output = self.lora(x, output)
         return output
 
 
@@ -193,13 +604,19 @@ class GemmaMLP(nn.Module):
         hidden_size: int,
         intermediate_size: int,
         quant: bool,
+        quant_bits: int = 8,
+        quant_group_size: int = 0,
+        workspace: Optional[Workspace] = None,
         ):
         super().__init__()
-        self.gate_proj = Linear(hidden_size, intermediate_size, quant)
-        self.up_proj   = Linear(hidden_size, intermediate_size, quant)
-        self.down_proj = Linear(intermediate_size, hidden_size, quant)
+        self.gate_proj = Linear(hidden_size, intermediate_size, quant, quant_bits, quant_group_size)
+        self.up_proj   = Linear(hidden_size, intermediate_size, quant, quant_bits, quant_group_size)
+        self.down_proj = Linear(intermediate_size, hidden_size, quant, quant_bits, quant_group_size)
+        self.workspace = workspace
 
     def forward(self, x):
+        if self.workspace is not None:
+            return self._low_memory_forward(x)
         gate    = self.gate_proj(x)
         gate    = F.gelu(gate, approximate="tanh")
         up      = self.up_proj(x)
@@ -207,6 +624,15 @@ class GemmaMLP(nn.Module):
         outputs = self.down_proj(fuse)
         return outputs
 
+    def _low_memory_forward(self, x):
+        # gate, GELU, up, fuse 네 개 대신 intermediate 폭의 버퍼 두 개 (gate, up)만 사용:
+        # GELU와 곱셈은 gate 버퍼에 in-place로 계산한다. gate 버퍼는 attention score와 같은 슬롯이다.
+        shape = (*x.shape[:-1], self.gate_proj.weight.shape[0])
+        gate  = self.gate_proj(x, out=self.workspace.get(Workspace.GATE, shape, x.dtype, x.device))
+        torch.ops.aten.gelu_(gate, approximate="tanh")
+        up    = self.up_proj(x, out=self.workspace.get(Workspace.UP, shape, x.dtype, x.device))
+        return self.down_proj(gate.mul_(up))
+
 
 class GemmaAttention(nn.Module):
     def __init__(self,
@@ -215,8 +641,12 @@ class GemmaAttention(nn.Module):
         num_kv_heads: int,
         head_dim: int,
         quant: bool,
+        quant_bits: int = 8,
+        quant_group_size: int = 0,
+        workspace: Optional[Workspace] = None,
         ):
         super().__init__()
+        self.workspace    = workspace
         self.num_heads    = num_heads
         self.num_kv_heads = num_kv_heads
         assert self.num_heads % self.num_kv_heads == 0
@@ -233,13 +663,13 @@ class GemmaAttention(nn.Module):
         # self.qkv_proj = Linear(
         #     self.hidden_size, (self.num_heads + 2 * self.num_kv_heads) * self.head_dim, quant=quant)
         self.q_proj      = Linear(
-            self.hidden_size, (self.num_heads) * self.head_dim, quant=quant)
+            self.hidden_size, (self.num_heads) * self.head_dim, quant, quant_bits, quant_group_size)
         self.k_proj      = Linear(
-            self.hidden_size, (self.num_kv_heads) * self.head_dim, quant=quant)
+            self.hidden_size, (self.num_kv_heads) * self.head_dim, quant, quant_bits, quant_group_size)
         self.v_proj      = Linear(
-            self.hidden_size, (self.num_kv_heads) * self.head_dim, quant=quant)
+            self.hidden_size, (self.num_kv_heads) * self.head_dim, quant, quant_bits, quant_group_size)
         self.o_proj      = Linear(
-            self.num_heads * self.head_dim, self.hidden_size, quant=quant)
+            self.num_heads * self.head_dim, self.hidden_size, quant, quant_bits, quant_group_size)
 
     def forward(self,
         hidden_states: torch.Tensor,
@@ -265,15 +695,24 @@ class GemmaAttention(nn.Module):
         xq = apply_rotary_emb(xq, freqs_cis=freqs_cis)
         xk = apply_rotary_emb(xk, freqs_cis=freqs_cis)
 
-        # Write new kv cache.
-        # [batch_size, input_len, n_local_kv_heads, head_dim]
-        # xk의 kv_write_indices 인덱스에 1로 채우기
-        k_cache, v_cache = kv_cache
-        k_cache.index_copy_(1, kv_write_indices, xk)
-        v_cache.index_copy_(1, kv_write_indices, xv)
-
-        key   = k_cache
-        value = v_cache
+        if kv_cache is None:
+            # KV 캐시 없이 한 번의 prefill (score, embed): 현재 입력의 K, V만 사용
+            key   = xk
+            value = xv
+        else:
+            # Write new kv cache.
+            # [batch_size, input_len, n_local_kv_heads, head_dim]
+            # xk의 kv_write_indices 인덱스에 1로 채우기
+            k_cache, v_cache = kv_cache
+            k_cache.index_copy_(1, kv_write_indices, xk)
+            v_cache.index_copy_(1, kv_write_indices, xv)
+
+            key   = k_cache
+            value = v_cache
+        if self.workspace is not None:
+            output = self._low_memory_attention(xq, key, value, mask)
+            output = (output.transpose(1, 2).contiguous().view(batch_size, input_len, -1))
+            return self.o_proj(output)
         if self.num_kv_heads != self.num_heads:
             # [batch_size, max_seq_len, n_local_heads, head_dim]
             key   = torch.repeat_interleave(key, self.num_queries_per_kv, dim = 2)
@@ -301,9 +740,43 @@ class GemmaAttention(nn.Module):
         output = self.o_proj(output)
         return output
 
+    def _low_memory_attention(self,
+        xq: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        mask: torch.Tensor,
+        ) -> torch.Tensor:
+        """
+        1. repeat_interleave로 K, V를 head 수만큼 복사하지 않고, query head를 kv head마다 묶어
+           [batch_size, n_kv_heads, queries_per_kv * input_len, head_dim]으로 matmul한다.
+        2. score는 Workspace 버퍼 하나에 q dtype으로만 두고, scale, mask, softmax를 in-place로 계산한다.
+           bfloat16이면 softmax의 합만 float32로 누적한다.
+        """
+        batch_size, input_len = xq.shape[:2]
+        seq_len = key.shape[1]
+        q = xq.transpose(1, 2).reshape(
+            batch_size, self.num_kv_heads, self.num_queries_per_kv * input_len, self.head_dim)
+        k = key.transpose(1, 2)
+        v = value.transpose(1, 2)
+
+        scores = self.workspace.get(
+            Workspace.SCORES, (batch_size, self.num_kv_heads, self.num_queries_per_kv * input_len, seq_len), q.dtype, q.device)
+        torch.matmul(q, k.transpose(2, 3), out=scores)
+        del q
+        # [batch_size, n_local_heads, input_len, max_seq_len]로 보고 mask를 더한다.
+        probs = scores.view(batch_size, self.num_heads, input_len, seq_len)
+        # dtype이 다른 텐서와의 in-place 연산은 float32 임시 텐서를 만들므로 mask와 합을 score dtype으로 맞춘다.
+        probs.mul_(self.scaling).add_(mask.to(probs.dtype))
+        probs.sub_(probs.amax(dim=-1, keepdim=True)).exp_()
+        probs.mul_(probs.sum(dim=-1, keepdim=True, dtype=torch.float32).reciprocal_().to(probs.dtype))
+
+        # [batch_size, n_local_heads, input_len, head_dim]
+        output = torch.matmul(scores, v)
+        return output.view(batch_size, self.num_heads, input_len, self.head_dim)
+
 
 class GemmaDecoderLayer(nn.Module):
-    def __init__(self, config):
+    def __init__(self, config, workspace: Optional[Workspace] = None):
         super().__init__()
         self.self_attn = GemmaAttention(
             hidden_size=config.hidden_size,
@@ -311,14 +784,22 @@ class GemmaDecoderLayer(nn.Module):
             num_kv_heads=config.num_key_value_heads,
             head_dim=config.head_dim,
             quant=config.quant,
+            quant_bits=config.quant_bits,
+            quant_group_size=config.quant_group_size,
+            workspace=workspace,
             )
         self.mlp = GemmaMLP(
             hidden_size=config.hidden_size,
             intermediate_size=config.intermediate_size,
             quant=config.quant,
+            quant_bits=config.quant_bits,
+            quant_group_size=config.quant_group_size,
+            workspace=workspace,
             )
-        self.input_layernorm = RMSNorm(config.hidden_size, eps=config.rms_norm_eps)
-        self.post_attention_layernorm = RMSNorm(config.hidden_size, eps=config.rms_norm_eps)
+        self.input_layernorm = RMSNorm(
+            config.hidden_size, eps=config.rms_norm_eps, use_compile=config.compile_norm)
+        self.post_attention_layernorm = RMSNorm(
+            config.hidden_size, eps=config.rms_norm_eps, use_compile=config.compile_norm)
 
     def forward(self,
         hidden_states: torch.Tensor,
@@ -326,14 +807,21 @@ class GemmaDecoderLayer(nn.Module):
         kv_write_indices: torch.Tensor,
         kv_cache: Tuple[torch.Tensor, torch.Tensor],
         mask: torch.Tensor,
-        ) -> torch.Tensor:
+        residual: Optional[torch.Tensor] = None,
+        ) -> Tuple[torch.Tensor, torch.Tensor]:
         """
-        1. hidden -> RMSNorm -> GemmaAttention = hidden + residual
-        2. hidden -> RMXNorm -> GemmaMLP -> hidden + residual
+        1. (hidden + residual) -> RMSNorm -> GemmaAttention
+        2. (hidden + residual) -> RMSNorm -> GemmaMLP
+        residual 더하기는 다음 RMSNorm과 합쳐서 (add_rms_norm) 계산하므로,
+        (MLP 출력, residual)을 반환하고 hidden + residual은 다음 레이어 (또는 마지막 norm)가 더한다.
+        첫 레이어는 residual = None으로 호출한다.
         """
         # Self Attention
-        residual = hidden_states
-        hidden_states = self.input_layernorm(hidden_states)
+        if residual is None:
+            residual = hidden_states
+            hidden_states = self.input_layernorm(hidden_states)
+        else:
+            hidden_states, residual = self.input_layernorm(hidden_states, residual)
         hidden_states = self.self_attn(
             hidden_states=hidden_states,
             freqs_cis=freqs_cis,
@@ -341,14 +829,11 @@ class GemmaDecoderLayer(nn.Module):
             kv_cache=kv_cache,
             mask=mask,
             )
-        hidden_states = residual + hidden_states
 
         # MLP
-        residual = hidden_states
-        hidden_states = self.post_attention_layernorm(hidden_states)
+        hidden_states, residual = self.post_attention_layernorm(hidden_states, residual)
         hidden_states = self.mlp(hidden_states)
-        hidden_states = residual + hidden_states
-        return hidden_states
+        return hidden_states, residual
 
 
 class GemmaModel(nn.Module):
@@ -360,57 +845,82 @@ class GemmaModel(nn.Module):
         """
         self.config        = config
         self.vocab_size    = config.vocab_size
-        self.embed_tokens  = Embedding(self.vocab_size, config.hidden_size, config.quant)
+        self.embed_tokens  = Embedding(
+            self.vocab_size, config.hidden_size, config.quant, config.quant_bits, config.quant_group_size)
+        # low_memory이면 모든 레이어가 하나의 Workspace를 공유한다.
+        self.workspace = Workspace() if config.low_memory else None
         self.layers = nn.ModuleList()
         for _ in range(config.num_hidden_layers):
-            self.layers.append(GemmaDecoderLayer(config))
-        self.norm   = RMSNorm(config.hidden_size, eps=config.rms_norm_eps)
+            self.layers.append(GemmaDecoderLayer(config, self.workspace))
+        self.norm   = RMSNorm(config.hidden_size, eps=config.rms_norm_eps, use_compile=config.compile_norm)
 
     def forward(self,
         hidden_states: torch.Tensor,
         freqs_cis: torch.Tensor,
         kv_write_indices: torch.Tensor,
-        kv_caches: List[Tuple[torch.Tensor, torch.Tensor]],
+        kv_caches: Optional[List[Tuple[torch.Tensor, torch.Tensor]]],
         mask: torch.Tensor,
         ) -> torch.Tensor:
 
         # hidden_states, freqs_cis, kv_write_indeices, kv_caches, mask를 입력받아서,
+        # kv_caches가 None이면 KV 캐시 없이 입력 시퀀스 안에서만 attention
         # gemma-2b는 디코더 레이어 18번 반복
+        if self.workspace is not None:
+            self.workspace.trim(hidden_states.shape[0] * hidden_states.shape[1])
+        residual = None
         for i in range(len(self.layers)):
             # nn.ModuleList의 GemmaDecoderLayer를 순회
             layer = self.layers[i]
-            hidden_states = layer(
+            hidden_states, residual = layer(
                 hidden_states=hidden_states,
                 freqs_cis=freqs_cis,
                 kv_write_indices=kv_write_indices,
-                kv_cache=kv_caches[i],
+                kv_cache=None if kv_caches is None else kv_caches[i],
                 mask=mask,
+                residual=residual,
                 )
             # if i == 0:
             #     break
             
-        # 마지막 RMSNorm 레이어 포워드
-        hidden_states = self.norm(hidden_states)        
+        # 마지막 RMSNorm 레이어 포워드 (마지막 레이어의 residual 더하기 포함)
+        if residual is None:
+            return self.norm(hidden_states)
+        hidden_states, _ = self.norm(hidden_states, residual)
         return hidden_states
 
 
 class GemmaForCausalLM(nn.Module):
-    def __init__(self, config):
+    def __init__(self, config, tokenizer: Optional[Tokenizer] = None):
         super().__init__()
         self.config = config
         assert config.hidden_size % config.num_attention_heads == 0
         print("dtype :   ", config.dtype)
-        max_seq_len      = config.max_position_embeddings
         head_dim         = config.head_dim
         vocab_size       = config.vocab_size
-        self.tokenizer   = Tokenizer(config.tokenizer)
+        # config.tokenizer가 None이면 토큰 아이디만 다룬다 (벤치마크, parity 검사).
+        # 이미 로드한 tokenizer를 넘기면 다시 로드하지 않는다.
+        if tokenizer is None and config.tokenizer is not None:
+            tokenizer = Tokenizer(config.tokenizer)
+        self.tokenizer   = tokenizer
         self.model       = GemmaModel(config)
-        self.sampler     = Sampler(vocab_size)
+        self.sampler     = Sampler(vocab_size, config.vocab_chunk_size)
+        # GenerationMetrics를 넣으면 generate_stream이 TTFT, 토큰 사이 시간, KV 캐시 사용량 등을 기록한다.
+        self.metrics: Optional[GenerationMetrics] = None
+        # load_adapter로 처음 adapter를 로드할 때 만든다 (모든 Linear가 공유).
+        self.lora: Optional[MultiLoRA] = None
+
+        # Rotary embedding table: 생성 시 max_seq_len * 2 위치를 미리 계산하지 않고
+        # rotary_embedding()이 필요한 위치까지 2의 거듭제곱 단위로 늘린다.
+        self.register_buffer('freqs_cis', torch.empty((0, head_dim // 2), dtype=torch.complex64), persistent=False)
 
-        # Pre-compute rotary embedding table.
-        rope_theta       = getattr(config, 'rope_theta', 10000)
-        freqs_cis        = precompute_freqs_cis(head_dim, max_seq_len * 2, theta=rope_theta)
-        self.register_buffer('freqs_cis', freqs_cis)
+    @property
+    def pad_id(self) -> int:
+        # tokenizer가 없으면 config의 pad_token_id (토큰 아이디만 다루는 벤치마크, parity 검사)
+        return self.tokenizer.pad_id if self.tokenizer is not None else self.config.pad_token_id
+
+    @property
+    def eos_id(self) -> int:
+        return self.tokenizer.eos_id if self.tokenizer is not None else self.config.eos_token_id
 
     @torch.no_grad()
     def forward(self,
@@ -423,9 +933,49 @@ class GemmaForCausalLM(nn.Module):
         temperatures: Union[torch.Tensor, None],
         top_ps: torch.Tensor,
         top_ks: torch.Tensor,
+        embedding_bias: Optional[torch.Tensor] = None,
+        penalties: Optional[SamplingPenalties] = None,
+        sampling_keys: Optional[torch.Tensor] = None,
+        adapter_ids: Optional[torch.Tensor] = None,
         **kwargs,
         ) -> torch.Tensor:
-        freqs_cis        = self.freqs_cis.index_select(0, input_positions)
+        hidden_states = self._hidden_states(input_token_ids, input_positions, kv_caches, mask, adapter_ids)
+
+        # HC: embedder의 weight를 reuse한다.
+        # 양자화된 경우 Sampler가 필요한 타일만 역양자화하도록 Embedding을 그대로 넘긴다.
+        next_tokens = self.sampler(
+            embedding=self.model.embed_tokens,
+            hidden_states=hidden_states,
+            output_positions=output_positions,
+            temperatures=temperatures,
+            top_ps=top_ps,
+            top_ks=top_ks,
+            embedding_bias=embedding_bias,
+            penalties=penalties,
+            sampling_keys=sampling_keys,
+            )
+        return next_tokens
+
+    def rotary_embedding(self, positions: torch.Tensor) -> torch.Tensor:
+        """freqs_cis rows of the given positions, extending the table on first use of a position."""
+        end = int(positions.max()) + 1
+        if end > self.freqs_cis.shape[0]:
+            size = max(256, 1 << (end - 1).bit_length())
+            self.freqs_cis = precompute_freqs_cis(self.config.head_dim, size, theta=self.config.rope_theta).to(self.freqs_cis.device)
+        return self.freqs_cis.index_select(0, positions)
+
+    def _hidden_states(self,
+        input_token_ids: torch.Tensor,
+        input_positions: torch.Tensor,
+        kv_caches: Optional[List[Tuple[torch.Tensor, torch.Tensor]]],
+        mask: torch.Tensor,
+        adapter_ids: Optional[torch.Tensor] = None,
+        ) -> torch.Tensor:
+        # 임베딩 -> 디코더 레이어 -> 마지막 RMSNorm, input_positions에 K, V를 쓴다.
+        # adapter_ids [batch_size]: 행마다의 LoRA adapter (None이면 모든 행이 base 모델)
+        if self.lora is not None:
+            self.lora.set_rows(adapter_ids)
+        freqs_cis        = self.rotary_embedding(input_positions)
         kv_write_indices = input_positions
 
         # 프롬프트 아이디를 임베딩: 해당되는 단어 아이디만 2048 차원 벡터로 변환하여 행렬 구성
@@ -433,48 +983,245 @@ class GemmaForCausalLM(nn.Module):
         hidden_states = self.model.embed_tokens(input_token_ids)
         # hidden_states.shape = [batch_size, input_len, 2048]
         # Gemma normalizes the embedding by sqrt(hidden_size).
-        hidden_states = hidden_states * (self.config.hidden_size**0.5) 
-        hidden_states = self.model(
+        # normalizer는 hidden states와 같은 dtype으로 반올림 (bfloat16이면 HF 구현과 같은 값)
+        normalizer    = torch.tensor(self.config.hidden_size**0.5, dtype=hidden_states.dtype)
+        hidden_states = hidden_states * normalizer
+        return self.model(
             hidden_states=hidden_states,
             freqs_cis=freqs_cis,
             kv_write_indices=kv_write_indices,
             kv_caches=kv_caches,
             mask=mask,
             )
-        
-        # HC: embedder의 weight를 reuse한다.
-        embedder_weight = self.model.embed_tokens.weight
-        if self.config.quant:
-            embedder_weight = (embedder_weight * self.model.embed_tokens.weight_scaler.unsqueeze(-1))
-        next_tokens = self.sampler(
-            embedding=embedder_weight,
-            hidden_states=hidden_states,
-            output_positions=output_positions,
-            temperatures=temperatures,
-            top_ps=top_ps,
-            top_ks=top_ks,
-            )
-        return next_tokens
 
-    def generate(self,
-        prompts: Union[str, Sequence[str]],
+    def _length_batches(self, token_lists: Sequence[Sequence[int]], batch_size: int) -> Iterator[List[int]]:
+        # 길이순으로 정렬한 인덱스를 batch_size개씩 묶어 패딩을 줄인다.
+        order = sorted(range(len(token_lists)), key=lambda i: len(token_lists[i]))
+        for start in range(0, len(order), batch_size):
+            yield order[start:start + batch_size]
+
+    @torch.no_grad()
+    def _prefill(self, token_lists: Sequence[Sequence[int]]) -> torch.Tensor:
+        """
+        One prefill pass without sampling and without KV caches.
+        오른쪽 패딩: causal 마스크만으로 각 행의 실제 토큰은 패딩을 보지 않는다. [batch_size, max_len, hidden_size]
+        """
+        max_len   = max(len(tokens) for tokens in token_lists)
+        token_ids = torch.full((len(token_lists), max_len), self.pad_id, dtype=torch.int64)
+        for i, tokens in enumerate(token_lists):
+            token_ids[i, :len(tokens)] = torch.tensor(tokens, dtype=torch.int64)
+        positions = torch.arange(0, max_len, dtype=torch.int64)
+        hidden_states = self._hidden_states(token_ids, positions, None, causal_mask(positions, max_len))
+        if self.model.workspace is not None:
+            self.model.workspace.clear()
+        return hidden_states
+
+    @torch.no_grad()
+    def score(self,
+        prompts: Union[Sequence[str], Sequence[Sequence[int]]],
+        continuations: Union[Sequence[str], Sequence[Sequence[int]]],
+        batch_size: int = 16,
+        ) -> List[List[float]]:
+        """
+        Per-token log-probs of each continuation given its prompt.
+        1. 프롬프트는 BOS를 붙여, continuation은 BOS 없이 토크나이징 (또는 토큰 아이디를 그대로 사용)
+        2. 길이순으로 batch_size개씩 한 번의 prefill로 계산하며 샘플링과 KV 캐시가 없다.
+        3. 결과는 입력 순서대로, continuation 토큰마다의 log p (합하면 시퀀스 log-likelihood)
+        """
+        assert len(prompts) == len(continuations), (len(prompts), len(continuations))
+        prompt_tokens = self.encode_prompts(prompts)
+        if isinstance(continuations[0], str):
+            continuation_tokens = self.tokenizer.encode_batch(continuations, bos=False)
+        else:
+            continuation_tokens = [list(c) for c in continuations]
+        sequences = [p + c for p, c in zip(prompt_tokens, continuation_tokens)]
+
+        results: List[List[float]] = [[] for _ in sequences]
+        for indices in self._length_batches(sequences, batch_size):
+            hidden_states = self._prefill([sequences[i] for i in indices])
+            # 위치 t의 hidden state가 t + 1번째 토큰을 예측한다.
+            rows, positions, targets = [], [], []
+            for row, i in enumerate(indices):
+                start = len(prompt_tokens[i])
+                for position in range(start, len(sequences[i])):
+                    rows.append(row)
+                    positions.append(position - 1)
+                    targets.append(sequences[i][position])
+            if not targets:
+                continue
+            log_probs = self.sampler.log_probs(
+                self.model.embed_tokens,
+                hidden_states[torch.tensor(rows), torch.tensor(positions)],
+                torch.tensor(targets, dtype=torch.int64),
+                ).tolist()
+            offset = 0
+            for i in indices:
+                count = len(continuation_tokens[i])
+                results[i] = log_probs[offset:offset + count]
+                offset += count
+        return results
+
+    @torch.no_grad()
+    def embed(self,
+        texts: Union[Sequence[str], Sequence[Sequence[int]]],
+        pooling: str = "mean",
+        normalize: bool = False,
+        batch_size: int = 16,
+        ) -> torch.Tensor:
+        """
+        Pooled final hidden states (after the last RMSNorm) of GemmaModel, [len(texts), hidden_size] float32.
+        pooling: "mean"은 패딩을 제외한 토큰 평균, "last"는 마지막 토큰
+        """
+        if pooling not in ("mean", "last"):
+            raise ValueError(f'Invalid pooling {pooling}. Supported poolings are mean and last')
+        token_lists = self.encode_prompts(texts)
+        embeddings  = torch.empty((len(token_lists), self.config.hidden_size), dtype=torch.float)
+        for indices in self._length_batches(token_lists, batch_size):
+            hidden_states = self._prefill([token_lists[i] for i in indices]).float()
+            lengths = torch.tensor([len(token_lists[i]) for i in indices], dtype=torch.int64)
+            if pooling == "last":
+                pooled = hidden_states[torch.arange(len(indices)), lengths - 1]
+            else:
+                valid  = torch.arange(hidden_states.shape[1]).unsqueeze(dim=0) < lengths.unsqueeze(dim=1)
+                pooled = (hidden_states * valid.unsqueeze(dim=-1)).sum(dim=1) / lengths.unsqueeze(dim=1)
+            embeddings[torch.tensor(indices)] = pooled
+        if normalize:
+            embeddings = F.normalize(embeddings, dim=-1)
+        return embeddings
+
+    @property
+    def chat_template(self) -> ChatTemplate:
+        # special_tokens_map.json은 tokenizer.model과 같은 디렉토리에 있다.
+        if getattr(self, "_chat_template", None) is None:
+            self._chat_template = ChatTemplate(self.tokenizer, os.path.dirname(self.config.tokenizer))
+        return self._chat_template
+
+    def chat(self,
+        messages: Union[Sequence[Dict[str, str]], Sequence[Sequence[Dict[str, str]]]],
         device: Any,
         output_len: int = 100,
-        temperature: Union[float, None] = 0.95,
-        top_p: float = 1.0,
-        top_k: int = 100,
+        **kwargs,
         ) -> Union[str, Sequence[str]]:
         """
+        Generates the model turn for one conversation or a batch of conversations.
+        messages는 [{"role": "user", "content": ...}, ...] 또는 그 리스트, kwargs는 generate의 샘플링 파라미터
+        """
+        is_single = len(messages) > 0 and isinstance(messages[0], dict)
+        conversations = [messages] if is_single else messages
+        prompt_tokens = self.chat_template.encode_batch(conversations)
+        results = self.generate(
+            prompt_tokens, device, output_len=output_len,
+            stop_token_ids=[self.chat_template.end_of_turn_id], **kwargs)
+        return results[0] if is_single else results
+
+    def generate(self,
+        prompts: Union[str, Sequence[str], Sequence[Sequence[int]]],
+        device: Any,
+        output_len: int = 100,
+        temperature: Union[float, None, Sequence[Optional[float]]] = 0.95,
+        top_p: Union[float, Sequence[float]] = 1.0,
+        top_k: Union[int, Sequence[int]] = 100,
+        repetition_penalty: Union[float, Sequence[float]] = 1.0,
+        frequency_penalty: Union[float, Sequence[float]] = 0.0,
+        presence_penalty: Union[float, Sequence[float]] = 0.0,
+        logit_bias: Union[Dict[int, float], Sequence[Optional[Dict[int, float]]], None] = None,
+        seed: Union[int, Sequence[Optional[int]], None] = None,
+        stop_token_ids: Optional[Sequence[int]] = None,
+        prefill_chunk_size: Optional[int] = None,
+        session: Optional[GenerationSession] = None,
+        adapter: Union[str, None, Sequence[Optional[str]]] = None,
+        ) -> Union[str, Sequence[str], List[List[int]]]:
+        """
         Generates responses for given prompts using Gemma model.
         HC: Mac에서 추론할 것이므로 .to(device)는 모두 제거
+        샘플링 파라미터는 스칼라이면 배치 전체에, 시퀀스이면 프롬프트마다 적용한다.
+        temperature가 None 또는 0인 행은 greedy로 디코딩한다.
+        seed가 주어진 행은 배치 구성과 관계없이 같은 토큰을 생성한다.
+        prompts는 문자열 또는 이미 토크나이징된 토큰 아이디 리스트 (chat 템플릿 등)
+        session (GenerationSession)을 넘기면 KV 캐시 등의 버퍼를 호출 사이에 재사용한다.
+        adapter는 load_adapter로 로드한 LoRA adapter 이름 (스칼라 또는 프롬프트마다)
+        tokenizer가 없으면 (config.tokenizer = None) 토큰 아이디 프롬프트만 받고 토큰 아이디 리스트를 반환한다.
         """
         # If a single prompt is provided, treat it as a batch of 1.
         is_str_prompt = isinstance(prompts, str)
         if is_str_prompt:
             prompts = [prompts]
+        prompt_tokens = self.encode_prompts(prompts)
+
+        # 스텝마다 생성된 토큰을 행별로 모음
+        outputs = [[] for _ in prompt_tokens]
+        for step_tokens in self.generate_stream(
+            prompt_tokens, device, output_len=output_len,
+            temperature=temperature, top_p=top_p, top_k=top_k,
+            repetition_penalty=repetition_penalty, frequency_penalty=frequency_penalty,
+            presence_penalty=presence_penalty, logit_bias=logit_bias, seed=seed,
+            prefill_chunk_size=prefill_chunk_size, session=session, adapter=adapter,
+            stop_token_ids=stop_token_ids,
+            ):
+            for i, token in enumerate(step_tokens):
+                if token is not None:
+                    outputs[i].append(token)
+
+        # HC: 디토크나이징 과정, 생성된 토큰을 문장으로 치환
+        stop_ids = {self.eos_id, *(stop_token_ids or [])}
+        for i, tokens in enumerate(outputs):
+            trimmed_output = tokens[:output_len]
+            for eos_index, token in enumerate(trimmed_output):
+                if token in stop_ids:
+                    trimmed_output = trimmed_output[:eos_index]
+                    break
+            outputs[i] = trimmed_output
+        # tokenizer가 없으면 (config.tokenizer = None) 토큰 아이디 리스트를 그대로 반환
+        results = self.tokenizer.decode_batch(outputs) if self.tokenizer is not None else outputs
+
+        # 하나의 문장으로 반환
+        return results[0] if is_str_prompt else results
+
+    def encode_prompts(self, prompts: Union[Sequence[str], Sequence[Sequence[int]]]) -> List[List[int]]:
+        # 문자열이면 배치의 각 프롬프트들을 한 번에 인코딩, 토큰 아이디이면 그대로 사용
+        if isinstance(prompts[0], str):
+            if self.tokenizer is None:
+                raise ValueError("string prompts need a tokenizer (config.tokenizer is None), pass token ids")
+            return self.tokenizer.encode_batch(prompts)
+        return [list(p) for p in prompts]
 
+    @torch.no_grad()
+    def generate_stream(self,
+        prompts: Union[Sequence[str], Sequence[Sequence[int]]],
+        device: Any,
+        output_len: int = 100,
+        temperature: Union[float, None, Sequence[Optional[float]]] = 0.95,
+        top_p: Union[float, Sequence[float]] = 1.0,
+        top_k: Union[int, Sequence[int]] = 100,
+        repetition_penalty: Union[float, Sequence[float]] = 1.0,
+        frequency_penalty: Union[float, Sequence[float]] = 0.0,
+        presence_penalty: Union[float, Sequence[float]] = 0.0,
+        logit_bias: Union[Dict[int, float], Sequence[Optional[Dict[int, float]]], None] = None,
+        seed: Union[int, Sequence[Optional[int]], None] = None,
+        prefill_chunk_size: Optional[int] = None,
+        session: Optional[GenerationSession] = None,
+        adapter: Union[str, None, Sequence[Optional[str]]] = None,
+        stop_token_ids: Union[Sequence[int], Sequence[Sequence[int]], None] = None,
+        max_tokens: Union[int, Sequence[int], None] = None,
+        ) -> Iterator[List[Optional[int]]]:
+        """
+        Yields, after every forward step, the newly generated token id of each row
+        (None while the row is still reading its own prompt).
+        1. 행마다 최대 max_prompt_len - len(prompt) + output_len개의 토큰이 나온다.
+        2. 호출하는 쪽에서 모든 행이 끝나면 반복을 멈추면 된다 (EOS, 요청별 길이 등).
+        3. prefill_chunk_size (기본값 config.prefill_chunk_size)가 있으면 프롬프트를 그 크기의 chunk로 나누어
+           KV 캐시를 채운다. attention score와 MLP 활성값이 chunk 크기로 제한되며,
+           chunk마다 모든 행이 None인 스텝을 yield하므로 호출하는 쪽이 다른 요청의 디코딩과 번갈아 실행할 수 있다.
+        4. session이 있으면 KV 캐시, 토큰 아이디, 디코딩 마스크를 새로 할당하지 않고 세션의 버퍼를 사용한다.
+        5. adapter는 load_adapter로 로드한 LoRA adapter 이름 (스칼라이면 배치 전체, 시퀀스이면 행마다, None이면 base 모델)
+        6. stop_token_ids (EOS 외에 행을 끝내는 토큰, 토큰 아이디 리스트이면 배치 전체, 리스트의 리스트이면 행마다)와
+           max_tokens (행마다의 최대 생성 토큰 수, 기본값 output_len)는 metrics가 행이 끝난 시점을 알기 위해서만 쓴다.
+        """
+        if prefill_chunk_size is None:
+            prefill_chunk_size = self.config.prefill_chunk_size
         batch_size     = len(prompts) # 1개의 문장이면 batch_size = 1
-        prompt_tokens  = [self.tokenizer.encode(prompt) for prompt in prompts] # 배치의 각 프롬프트트들을 인코딩
+        adapter_ids    = self._adapter_ids(adapter, batch_size)
+        prompt_tokens  = self.encode_prompts(prompts)
         min_prompt_len = min(len(p) for p in prompt_tokens) # 숫자로 표현한 프롬프트들 중 가장 짧은 프롬프트 길이
         max_prompt_len = max(len(p) for p in prompt_tokens) # 숫자로 표현한 프롬프트들 중 가장 긴 프롬프트 길이
         max_seq_len    = max_prompt_len + output_len # 출력 길이는 100
@@ -483,89 +1230,279 @@ class GemmaForCausalLM(nn.Module):
 
         # KV 캐시 빌드
         # num_hidden_layers 수 많큼 size, dtype 크기의 torch.zeros k, v를 kv_caches에 담기
-        kv_caches = []
-        for _ in range(self.config.num_hidden_layers):
-            size    = (batch_size, max_seq_len, self.config.num_key_value_heads, self.config.head_dim)
-            dtype   = self.config.get_dtype()
-            k_cache = torch.zeros(size=size, dtype=dtype, device=device)
-            v_cache = torch.zeros(size=size, dtype=dtype, device=device)
-            kv_caches.append((k_cache, v_cache))
+        if session is not None:
+            session.acquire(batch_size, max_seq_len, device)
+            kv_caches        = session.kv_caches(batch_size, max_seq_len)
+            token_ids_tensor = session.token_ids(batch_size, max_seq_len, self.pad_id)
+        else:
+            kv_caches = []
+            for _ in range(self.config.num_hidden_layers):
+                size    = (batch_size, max_seq_len, self.config.num_key_value_heads, self.config.head_dim)
+                dtype   = self.config.get_dtype()
+                k_cache = torch.zeros(size=size, dtype=dtype, device=device)
+                v_cache = torch.zeros(size=size, dtype=dtype, device=device)
+                kv_caches.append((k_cache, v_cache))
+            token_ids_tensor = torch.full((batch_size, max_seq_len), self.pad_id, dtype=torch.int64)
 
 
         # HC: 프롬프트를 토크나이징하고, 숫자 아이디로 매핑
-        token_ids_tensor        = torch.full((batch_size, max_seq_len), self.tokenizer.pad_id, dtype=torch.int64)
-        input_token_ids_tensor  = torch.full((batch_size, min_prompt_len), self.tokenizer.pad_id, dtype=torch.int64)
+        input_token_ids_tensor  = torch.full((batch_size, min_prompt_len), self.pad_id, dtype=torch.int64)
         for i, p in enumerate(prompt_tokens):
             token_ids_tensor[i, :len(p)] = torch.tensor(p)
             input_token_ids_tensor[i, :min_prompt_len] = torch.tensor(p[:min_prompt_len])
 
-        prompt_mask_tensor      = token_ids_tensor != self.tokenizer.pad_id
-        input_positions_tensor  = torch.arange(0, min_prompt_len, dtype=torch.int64) # tensor([0, 1, 2, 3, 4, 5])
-
-        mask_tensor = torch.full((1, 1, max_seq_len, max_seq_len), -2.3819763e38).to(torch.float)
-        mask_tensor = torch.triu(mask_tensor, diagonal=1)
-
-        curr_mask_tensor        = mask_tensor.index_select(2, input_positions_tensor)
-        output_positions_tensor = torch.LongTensor([min_prompt_len - 1])
-        temperatures_tensor = None if not temperature else torch.FloatTensor([temperature] * batch_size)
-        top_ps_tensor = torch.FloatTensor([top_p] * batch_size)
-        top_ks_tensor = torch.LongTensor([top_k] * batch_size)
-        output_index  = torch.tensor(min_prompt_len, dtype=torch.int64)
-
-        # HC: 실제 모델 포워드, 
-        # max_sqe_len - min_prompt_len의 의미: 아마도 2개 이상의 배치를 추론할때 토큰 길이를 맞추기 위해서이지 않을까?
-        for i in range(max_seq_len - min_prompt_len):
-            # 처음에는 입력 프롬프트 전체를 넣고, 입력 프롬프트를 통해 K, V를 연산하여 보관
-            # 두 번째부터는 출력 토큰을 다시 입력으로 넣어서 다음 언어를 K, V를 참고하여 예측
-            # 각 출력마다 다음 단어를 예측하고 이들을 모아서 하나의 출력 문장을 구성
-            next_token_ids = self(
-                input_token_ids=input_token_ids_tensor, # tensor([[   2,  651, 6996,  576, 1913,  603]])
-                input_positions=input_positions_tensor, # tensor([0, 1, 2, 3, 4, 5])
-                kv_write_indices=None, # None
-                kv_caches=kv_caches, # torch.zeros의 K, V size를 num_hidden_layer만큼 리스트 선언
-                mask=curr_mask_tensor,
-                output_positions=output_positions_tensor, # 상수: min_prompt_len - 1
-                temperatures=temperatures_tensor, # 상수: 0.95
-                top_ps=top_ps_tensor, # tensor([1.])
-                top_ks=top_ks_tensor, # tensor([100])
-                )
-
-            curr_prompt_mask = prompt_mask_tensor.index_select(1, output_index).squeeze(dim=1)
-            curr_token_ids   = token_ids_tensor.index_select(1, output_index).squeeze(dim=1)
-            output_token_ids = torch.where(curr_prompt_mask, curr_token_ids, next_token_ids).unsqueeze(dim=1)
-            token_ids_tensor.index_copy_(1, output_index, output_token_ids)
-
-            input_token_ids_tensor  = output_token_ids
-            input_positions_tensor  = output_index.unsqueeze(dim=-1)
-            curr_mask_tensor        = mask_tensor.index_select(2, input_positions_tensor)
-            output_positions_tensor = torch.tensor(0, dtype=torch.int64)
-            output_index = output_index + 1
-
-            # if i == 0:
-            #     break
-
-        # HC: 디토크나이징 과정, token_ids_tensor를 문장으로 치환
-        token_ids = token_ids_tensor.tolist()
-        results = []
-        for i, tokens in enumerate(token_ids):
-            trimmed_output = tokens[len(prompt_tokens[i]):len(prompt_tokens[i]) + output_len]
-            if self.tokenizer.eos_id in trimmed_output:
-                eos_index = trimmed_output.index(self.tokenizer.eos_id)
-                trimmed_output = trimmed_output[:eos_index]
-            results.append(self.tokenizer.decode(trimmed_output))
-            
-        # 하나의 문장으로 반환
-        return results[0] if is_str_prompt else results
+        prompt_mask_tensor      = token_ids_tensor != self.pad_id
+
+        # metrics가 없으면 아무것도 기록하지 않는다.
+        batch_metrics = None
+        if self.metrics is not None:
+            kv_cache_bytes = sum(k.numel() * k.element_size() * 2 for k, _ in kv_caches)
+            batch_metrics  = self.metrics.start_batch([len(p) for p in prompt_tokens], kv_cache_bytes)
+            stop_ids       = self._stop_ids(stop_token_ids, batch_size)
+            max_tokens     = [output_len] * batch_size if max_tokens is None else (
+                [max_tokens] * batch_size if isinstance(max_tokens, int) else list(max_tokens))
+
+        try:
+            # chunk prefill: 마지막 chunk를 제외한 프롬프트 구간은 샘플링 없이 KV 캐시만 채운다.
+            prefill_start = 0
+            if prefill_chunk_size is not None and min_prompt_len > prefill_chunk_size:
+                prefill_start = (min_prompt_len - 1) // prefill_chunk_size * prefill_chunk_size
+                for start in range(0, prefill_start, prefill_chunk_size):
+                    if batch_metrics is not None:
+                        batch_metrics.begin_step()
+                    chunk_positions = torch.arange(start, start + prefill_chunk_size, dtype=torch.int64)
+                    self._hidden_states(
+                        input_token_ids_tensor[:, start:start + prefill_chunk_size],
+                        chunk_positions,
+                        kv_caches,
+                        causal_mask(chunk_positions, max_seq_len),
+                        adapter_ids,
+                        )
+                    if batch_metrics is not None:
+                        batch_metrics.step("prefill", [None] * batch_size, stop_ids, max_tokens,
+                                           (start + prefill_chunk_size) / max_seq_len)
+                    yield [None] * batch_size
+                input_token_ids_tensor = input_token_ids_tensor[:, prefill_start:]
+            input_positions_tensor  = torch.arange(prefill_start, min_prompt_len, dtype=torch.int64) # tensor([0, 1, 2, 3, 4, 5])
+
+            # [1, 1, max_seq_len, max_seq_len] 전체 마스크 대신 현재 위치의 행만 만든다.
+            curr_mask_tensor        = causal_mask(input_positions_tensor, max_seq_len)
+            output_positions_tensor = torch.LongTensor([min_prompt_len - prefill_start - 1])
+            temperatures_tensor = self._batch_tensor(temperature, batch_size, torch.float)
+            # 모든 행이 greedy이면 temperatures를 None으로 두어 샘플링을 생략
+            if not bool((temperatures_tensor > 0).any()):
+                temperatures_tensor = None
+            top_ps_tensor = self._batch_tensor(top_p, batch_size, torch.float)
+            top_ks_tensor = self._batch_tensor(top_k, batch_size, torch.int64)
+            output_index  = torch.tensor(min_prompt_len, dtype=torch.int64)
+            embedding_bias = self._logit_bias_tensor(logit_bias, batch_size)
+            penalties = self._penalties(
+                repetition_penalty, frequency_penalty, presence_penalty,
+                token_ids_tensor, prompt_mask_tensor, batch_size)
+            seeds_tensor = self._seeds_tensor(seed, batch_size)
+
+            # HC: 실제 모델 포워드, 
+            # max_sqe_len - min_prompt_len의 의미: 아마도 2개 이상의 배치를 추론할때 토큰 길이를 맞추기 위해서이지 않을까?
+            for i in range(max_seq_len - min_prompt_len):
+                # 처음에는 입력 프롬프트 전체를 넣고, 입력 프롬프트를 통해 K, V를 연산하여 보관
+                # 두 번째부터는 출력 토큰을 다시 입력으로 넣어서 다음 언어를 K, V를 참고하여 예측
+                # 각 출력마다 다음 단어를 예측하고 이들을 모아서 하나의 출력 문장을 구성
+                if batch_metrics is not None:
+                    batch_metrics.begin_step()
+                next_token_ids = self(
+                    input_token_ids=input_token_ids_tensor, # tensor([[   2,  651, 6996,  576, 1913,  603]])
+                    input_positions=input_positions_tensor, # tensor([0, 1, 2, 3, 4, 5])
+                    kv_write_indices=None, # None
+                    kv_caches=kv_caches, # torch.zeros의 K, V size를 num_hidden_layer만큼 리스트 선언
+                    mask=curr_mask_tensor,
+                    output_positions=output_positions_tensor, # 상수: min_prompt_len - 1
+                    temperatures=temperatures_tensor, # 상수: 0.95
+                    top_ps=top_ps_tensor, # tensor([1.])
+                    top_ks=top_ks_tensor, # tensor([100])
+                    embedding_bias=embedding_bias,
+                    penalties=penalties,
+                    # 샘플링하는 위치(output_index)를 카운터로 사용
+                    sampling_keys=None if seeds_tensor is None else sampling_keys(seeds_tensor, output_index),
+                    adapter_ids=adapter_ids,
+                    )
+
+                curr_prompt_mask = prompt_mask_tensor.index_select(1, output_index).squeeze(dim=1)
+                curr_token_ids   = token_ids_tensor.index_select(1, output_index).squeeze(dim=1)
+                output_token_ids = torch.where(curr_prompt_mask, curr_token_ids, next_token_ids).unsqueeze(dim=1)
+                token_ids_tensor.index_copy_(1, output_index, output_token_ids)
+                if penalties is not None:
+                    penalties.update(output_token_ids, ~curr_prompt_mask)
+
+                input_token_ids_tensor  = output_token_ids
+                input_positions_tensor  = output_index.unsqueeze(dim=-1)
+                if session is not None:
+                    curr_mask_tensor    = session.mask_row(min_prompt_len + i, max_seq_len)
+                else:
+                    curr_mask_tensor    = causal_mask(input_positions_tensor, max_seq_len)
+                output_positions_tensor = torch.tensor(0, dtype=torch.int64)
+                output_index = output_index + 1
+
+                # 프롬프트를 읽는 중인 행은 None, 생성 중인 행은 토큰 아이디
+                step_tokens = output_token_ids.squeeze(dim=1).tolist()
+                step_tokens = [None if in_prompt else token
+                               for in_prompt, token in zip(curr_prompt_mask.tolist(), step_tokens)]
+                if batch_metrics is not None:
+                    # KV 캐시에는 min_prompt_len + i개의 위치가 쓰여 있다.
+                    batch_metrics.step("prefill" if i == 0 else "decode", step_tokens, stop_ids, max_tokens,
+                                       (min_prompt_len + i) / max_seq_len)
+                yield step_tokens
+        finally:
+            if batch_metrics is not None:
+                batch_metrics.close()
+            if self.model.workspace is not None:
+                self.model.workspace.clear()
+            if session is not None:
+                session.release()
+
+    def _stop_ids(self, stop_token_ids, batch_size: int) -> List[Set[int]]:
+        # 행마다 EOS + stop_token_ids (토큰 아이디 리스트이면 모든 행에 같은 값)
+        eos_id = self.eos_id
+        if not stop_token_ids:
+            stop_token_ids = [()] * batch_size
+        elif isinstance(stop_token_ids[0], int):
+            stop_token_ids = [stop_token_ids] * batch_size
+        assert len(stop_token_ids) == batch_size, (len(stop_token_ids), batch_size)
+        return [{eos_id, *row} for row in stop_token_ids]
+
+    def _batch_tensor(self, value, batch_size: int, dtype: torch.dtype) -> torch.Tensor:
+        # 스칼라는 배치 크기만큼 복제하고, 시퀀스는 행마다의 값으로 사용 (None은 0)
+        if value is None or isinstance(value, (int, float)):
+            value = [value] * batch_size
+        assert len(value) == batch_size, (len(value), batch_size)
+        return torch.tensor([0 if v is None else v for v in value], dtype=dtype)
+
+    def _adapter_ids(self, adapter, batch_size: int) -> Optional[torch.Tensor]:
+        # adapter 이름 (스칼라 또는 행마다)을 [batch_size] adapter id로 변환, 모든 행이 base 모델이면 None
+        if adapter is None or isinstance(adapter, str):
+            adapter = [adapter] * batch_size
+        assert len(adapter) == batch_size, (len(adapter), batch_size)
+        if all(name is None for name in adapter):
+            return None
+        if self.lora is None:
+            raise ValueError(f"unknown adapter {next(name for name in adapter if name is not None)}")
+        return self.lora.adapter_ids(adapter)
+
+    def load_adapter(self, name: str, path: str) -> int:
+        """
+        Loads a PEFT LoRA adapter (directory or adapter_model.safetensors) under name and returns its id.
+        base weight는 바뀌지 않으며, generate(..., adapter=name)인 행에만 low-rank delta가 더해진다.
+        """
+        if self.lora is None:
+            self.lora = MultiLoRA()
+        return self.lora.load(self, name, path)
+
+    def unload_adapter(self, name: str):
+        self.lora.unload(name)
+
+    def _seeds_tensor(self, seed, batch_size: int) -> Optional[torch.Tensor]:
+        # seed가 없는 행은 전역 RNG에서 seed를 뽑아 기존처럼 torch.manual_seed로 재현된다.
+        if seed is None:
+            return None
+        if isinstance(seed, int):
+            seed = [seed] * batch_size
+        assert len(seed) == batch_size, (len(seed), batch_size)
+        random_seeds = torch.randint(0, 2**62, (batch_size,), dtype=torch.int64).tolist()
+        return torch.tensor([r if s is None else s for s, r in zip(seed, random_seeds)], dtype=torch.int64)
+
+    def _logit_bias_tensor(self, logit_bias, batch_size: int) -> Optional[torch.Tensor]:
+        # {token_id: bias} 또는 행마다의 dict를 [batch_size, vocab_size] 텐서로 변환
+        if logit_bias is None:
+            return None
+        if isinstance(logit_bias, dict):
+            logit_bias = [logit_bias] * batch_size
+        assert len(logit_bias) == batch_size, (len(logit_bias), batch_size)
+        rows, cols, values = [], [], []
+        for i, bias in enumerate(logit_bias):
+            for token_id, value in (bias or {}).items():
+                rows.append(i)
+                cols.append(int(token_id))
+                values.append(float(value))
+        if not rows:
+            return None
+        embedding_bias = torch.zeros((batch_size, self.config.vocab_size), dtype=torch.float)
+        embedding_bias[rows, cols] = torch.tensor(values)
+        return embedding_bias
+
+    def _penalties(self,
+        repetition_penalty,
+        frequency_penalty,
+        presence_penalty,
+        token_ids_tensor: torch.Tensor,
+        prompt_mask_tensor: torch.Tensor,
+        batch_size: int,
+        ) -> Optional[SamplingPenalties]:
+        # 패널티가 하나도 없으면 None으로 두어 [batch_size, vocab_size] 텐서를 만들지 않는다.
+        repetition_penalties = self._batch_tensor(repetition_penalty, batch_size, torch.float)
+        frequency_penalties  = self._batch_tensor(frequency_penalty, batch_size, torch.float)
+        presence_penalties   = self._batch_tensor(presence_penalty, batch_size, torch.float)
+        if (bool((repetition_penalties == 1.0).all()) and not frequency_penalties.any()
+            and not presence_penalties.any()):
+            return None
+        size = (batch_size, self.config.vocab_size)
+        prompt_token_mask = torch.zeros(size, dtype=torch.int32)
+        prompt_token_mask.scatter_add_(1, token_ids_tensor, prompt_mask_tensor.to(torch.int32))
+        return SamplingPenalties(
+            repetition_penalties=repetition_penalties,
+            frequency_penalties=frequency_penalties,
+            presence_penalties=presence_penalties,
+            output_token_counts=torch.zeros(size, dtype=torch.int32),
+            prompt_token_mask=prompt_token_mask > 0,
+            )
 
     def load_weights(self, model_path: str):
-        model1 = safetensors.safe_open(model_path.format("00001", "00002"), framework="pt")
-        model2 = safetensors.safe_open(model_path.format("00002", "00002"), framework="pt")
+        """
+        1. model_path가 디렉토리이거나 {}가 있으면 (model-{}-of-{}.safetensors) 모든 shard를 로드 (get_weight_paths)
+        2. 아니면 quantize-gemma.py로 만든 하나의 safetensors 파일을 로드
+        3. float 텐서만 config.dtype(float32 또는 bfloat16)으로 변환하고, 양자화된 int8 / uint8 weight는 그대로 둔다.
+           bfloat16으로 저장된 체크포인트를 bfloat16으로 로드하면 float32 사본을 만들지 않는다.
+        4. 읽은 텐서를 파라미터로 그대로 쓰므로 (assign) 생성 시 할당한 빈 파라미터로 다시 복사하지 않는다.
+        5. pack-gemma.py로 만든 snapshot이면 변환 없이 mmap한 텐서를 그대로 쓴다 (load_snapshot).
+        """
+        if is_snapshot(model_path):
+            return self.load_snapshot(model_path)
+        dtype = self.config.get_dtype()
+        model_paths = get_weight_paths(model_path)
         # model1, model2의 tensor들을 담음
         safe_tensors = {}
-        for key in model1.keys() + model2.keys():
-            if key in model1.keys():
-                safe_tensors[key] = model1.get_tensor(key).type(torch.float32)
-            elif key in model2.keys():
-                safe_tensors[key] = model2.get_tensor(key).type(torch.float32)
+        for path in model_paths:
+            with safetensors.safe_open(path, framework="pt") as model_file:
+                for key in model_file.keys():
+                    if key in safe_tensors:
+                        continue
+                    tensor = model_file.get_tensor(key)
+                    if tensor.is_floating_point():
+                        tensor = tensor.type(dtype)
+                    safe_tensors[key] = tensor
+
+        self.load_state_dict(safe_tensors, strict=False, assign=True)
+
+    def pack_weights(self, path: str, source: Optional[str] = None) -> int:
+        """
+        Writes the loaded weights as a snapshot in the runtime layout (config.dtype, quantized packing) and returns its size.
+        manifest의 metadata에 weight config를 넣어 다른 설정으로 로드하면 오류를 낸다.
+        """
+        metadata = {"config": weight_config(self.config), "source": source}
+        return write_snapshot(self.state_dict(), path, metadata=metadata)
+
+    def load_snapshot(self, path: str):
+        """Maps a snapshot written by pack_weights; the parameters are views of the mapping (no copy)."""
+        tensors, manifest = read_snapshot(path)
+        packed_config = manifest["metadata"].get("config")
+        if packed_config != weight_config(self.config):
+            raise ValueError(f"{path} was packed with {packed_config}, model config is {weight_config(self.config)}")
+        self.load_state_dict(tensors, strict=False, assign=True)
+
+    def save_weights(self, path: str, source: Optional[str] = None):
+        """
+        Saves the loaded weights as one safetensors file (warm start).
+        shard를 합치고 config.dtype으로 변환한 그대로 저장하므로 load_weights(path)는 변환 없이 읽기만 한다.
+        metadata의 weight_config (config + 원본 체크포인트 경로)로 같은 설정에서 저장한 파일인지 확인한다 (warm_start_matches).
+        """
+        tensors = {key: value.detach().cpu().contiguous() for key, value in self.state_dict().items()}
+        save_file(tensors, path, metadata={"weight_config": weight_config_key(self.config, source)})
 
-        self.load_state_dict(safe_tensors, strict=False)
\ No newline at end of file
@@ -0,0 +1,170 @@
+# Multi-LoRA: 하나의 frozen base 모델에서 여러 LoRA adapter를 행마다 다르게 적용한다.
+# Linear마다 모든 adapter의 A, B를 [num_slots, ...]로 쌓아두고, 배치의 행마다 adapter id로 gather하여 bmm한다.
+import os
+import re
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Sequence
+    )
+
+import torch
+import torch.nn as nn
+import safetensors
+from source.config import read_config_json
+
+
+# PEFT adapter_model.safetensors 키: base_model.model.model.layers.0.self_attn.q_proj.lora_A.weight
+LORA_KEY_PATTERN = re.compile(r"^(?:base_model\.model\.)?(.+)\.lora_([AB])(?:\.[^.]+)?\.weight$")
+
+
+class LoRAWeights:
+    """
+    Stacked low-rank deltas of one Linear: A [num_slots, rank, in_features], B [num_slots, out_features, rank].
+    1. slot 0은 base 모델 (A, B = 0), adapter마다 slot 하나
+    2. rank가 다른 adapter는 가장 큰 rank로 0을 채워 쌓는다 (0인 행 / 열은 결과에 영향이 없다).
+    3. PEFT scaling (lora_alpha / r)은 로드할 때 B에 곱해둔다.
+    """
+    def __init__(self, lora: "MultiLoRA", in_features: int, out_features: int, dtype: torch.dtype):
+        self.lora = lora
+        self.A = torch.zeros((lora.num_slots, 0, in_features), dtype=dtype)
+        self.B = torch.zeros((lora.num_slots, out_features, 0), dtype=dtype)
+
+    def nbytes(self) -> int:
+        return self.A.numel() * self.A.element_size() + self.B.numel() * self.B.element_size()
+
+    def set(self, slot: int, A: Optional[torch.Tensor], B: Optional[torch.Tensor]):
+        # A: [rank, in_features], B: [out_features, rank] (None이면 이 Linear에는 adapter가 없다)
+        rank = 0 if A is None else A.shape[0]
+        if slot >= self.A.shape[0] or rank > self.A.shape[1]:
+            num_slots = max(slot + 1, self.A.shape[0])
+            max_rank  = max(rank, self.A.shape[1])
+            new_A = self.A.new_zeros((num_slots, max_rank, self.A.shape[2]))
+            new_B = self.B.new_zeros((num_slots, self.B.shape[1], max_rank))
+            new_A[:self.A.shape[0], :self.A.shape[1]] = self.A
+            new_B[:self.B.shape[0], :, :self.B.shape[2]] = self.B
+            self.A, self.B = new_A, new_B
+        self.A[slot].zero_()
+        self.B[slot].zero_()
+        if A is not None:
+            self.A[slot, :rank] = A
+            self.B[slot, :, :rank] = B
+
+    def delta(self, slot: int) -> torch.Tensor:
+        """The merged weight delta B @ A [out_features, in_features] of one adapter."""
+        return self.B[slot] @ self.A[slot]
+
+    def __call__(self, x: torch.Tensor, output: torch.Tensor) -> torch.Tensor:
+        """output (base Linear 결과)에 현재 배치의 행마다의 adapter delta를 더한다."""
+        row_ids = self.lora.row_ids
+        if row_ids is None:
+            return output
+        if self.lora.single_id is not None:
+            # 모든 행이 같은 adapter: gather 없이 두 번의 작은 matmul
+            slot = self.lora.single_id
+            return output.add_(x @ self.A[slot].t() @ self.B[slot].t())
+        # 행마다 다른 adapter: [batch, tokens, in] x [batch, in, rank] x [batch, rank, out]
+        batch = row_ids.shape[0]
+        x_3d  = x.reshape(batch, -1, x.shape[-1])
+        A = self.A.index_select(0, row_ids)
+        B = self.B.index_select(0, row_ids)
+        delta = torch.bmm(torch.bmm(x_3d, A.transpose(1, 2)), B.transpose(1, 2))
+        return output.add_(delta.view(output.shape))
+
+
+class MultiLoRA:
+    """
+    Adapters shared by every adapted Linear of one model (Workspace처럼 모델 전체가 하나를 공유).
+    1. load(model, name, path): PEFT adapter를 빈 slot에 로드하고 adapter id를 반환
+    2. set_rows(adapter_ids): 다음 forward의 행마다 adapter id [batch_size] (0 또는 None이면 base 모델)
+       generate_stream이 forward마다 호출하므로 번갈아 실행되는 배치끼리 섞이지 않는다.
+    """
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.free_slots: List[int] = []
+        self.num_slots = 1
+        self.weights: Dict[str, LoRAWeights] = {}
+        self.row_ids: Optional[torch.Tensor] = None
+        self.single_id: Optional[int] = None
+
+    def nbytes(self) -> int:
+        return sum(weights.nbytes() for weights in self.weights.values())
+
+    def adapter_ids(self, adapters: Sequence[Optional[str]]) -> Optional[torch.Tensor]:
+        """Per-row adapter names -> ids tensor (None if no row uses an adapter)."""
+        for name in adapters:
+            if name is not None and name not in self.ids:
+                raise ValueError(f"unknown adapter {name}")
+        if all(name is None for name in adapters):
+            return None
+        return torch.tensor([0 if name is None else self.ids[name] for name in adapters], dtype=torch.int64)
+
+    def set_rows(self, adapter_ids: Optional[torch.Tensor]):
+        self.row_ids, self.single_id = None, None
+        if adapter_ids is None or not bool(adapter_ids.any()):
+            return
+        self.row_ids = adapter_ids
+        if bool((adapter_ids == adapter_ids[0]).all()):
+            self.single_id = int(adapter_ids[0])
+
+    def load(self, model: nn.Module, name: str, path: str) -> int:
+        """
+        Loads a PEFT LoRA adapter (a directory with adapter_model.safetensors and adapter_config.json, or the file).
+        1. adapter_config.json의 r, lora_alpha (use_rslora이면 lora_alpha / sqrt(r))로 scaling, 없으면 1
+        2. 대상은 model의 Linear (q/k/v/o_proj, gate/up/down_proj)이고, 다른 모듈 (embedding 등)이면 ValueError
+        3. 같은 이름이 이미 있으면 그 slot을 새 weight로 바꾼다.
+        """
+        weight_path = os.path.join(path, "adapter_model.safetensors") if os.path.isdir(path) else path
+        config_path = os.path.join(os.path.dirname(weight_path), "adapter_config.json")
+        adapter_config = read_config_json(config_path) if os.path.isfile(config_path) else {}
+
+        pairs: Dict[str, Dict[str, torch.Tensor]] = {}
+        with safetensors.safe_open(weight_path, framework="pt") as adapter_file:
+            for key in adapter_file.keys():
+                match = LORA_KEY_PATTERN.match(key)
+                if match is None:
+                    raise ValueError(f"{weight_path}: unsupported adapter tensor {key}")
+                pairs.setdefault(match.group(1), {})[match.group(2)] = adapter_file.get_tensor(key)
+
+        modules = {}
+        for module_name, pair in pairs.items():
+            try:
+                module = model.get_submodule(module_name)
+            except AttributeError:
+                module = None
+            if module is None or not hasattr(module, "lora") or set(pair) != {"A", "B"}:
+                raise ValueError(f"{weight_path}: unsupported LoRA target {module_name}")
+            modules[module_name] = module
+
+        if name in self.ids:
+            slot = self.ids[name]
+        elif self.free_slots:
+            slot = self.free_slots.pop()
+        else:
+            slot = self.num_slots
+            self.num_slots += 1
+        for module_name, module in modules.items():
+            rank = pairs[module_name]["A"].shape[0]
+            alpha = adapter_config.get("lora_alpha", rank)
+            scaling = alpha / rank**0.5 if adapter_config.get("use_rslora", False) else alpha / rank
+            if module_name not in self.weights:
+                out_features, in_features = module.weight.shape[0], pairs[module_name]["A"].shape[1]
+                self.weights[module_name] = module.lora = LoRAWeights(
+                    self, in_features, out_features, model.config.get_dtype())
+            dtype = self.weights[module_name].A.dtype
+            self.weights[module_name].set(
+                slot, pairs[module_name]["A"].to(dtype), (pairs[module_name]["B"].float() * scaling).to(dtype))
+        # 이 adapter가 쓰지 않는 Linear의 slot은 0 (이전에 같은 slot을 쓰던 adapter의 값을 지운다)
+        for module_name, weights in self.weights.items():
+            if module_name not in modules:
+                weights.set(slot, None, None)
+        self.ids[name] = slot
+        return slot
+
+    def unload(self, name: str):
+        """Zeroes the adapter's slot and reuses it for the next load."""
+        slot = self.ids.pop(name)
+        for weights in self.weights.values():
+            weights.set(slot, None, None)
+        self.free_slots.append(slot)
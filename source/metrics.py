@@ -0,0 +1,252 @@
+# Runtime metrics of the generation path in the Prometheus text exposition format.
+import math
+import time
+import bisect
+import threading
+from typing import (
+    Collection,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple
+    )
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name   = name
+        self.help   = help
+        self.labels = tuple(labels)
+        self._lock  = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        assert set(labels) == set(self.labels), (labels, self.labels)
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0.0)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = value
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float], labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self.buckets = sorted(buckets)
+        # label 값 -> (버킷별 개수 (+Inf 포함), 합, 개수)
+        self.values: Dict[Tuple[str, ...], List] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0, 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = [counts, total + value, count + 1]
+
+    def count(self, **labels) -> int:
+        value = self.values.get(self._key(labels))
+        return 0 if value is None else value[2]
+
+    def sum(self, **labels) -> float:
+        value = self.values.get(self._key(labels))
+        return 0.0 if value is None else value[1]
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + [math.inf], counts):
+                    cumulative += bucket_count
+                    le = _format_labels(self.labels, key, f'le="{_format_value(bound)}"')
+                    lines.append(f"{self.name}_bucket{le} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def _register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, help, labels))
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float], labels: Sequence[str] = ()) -> Histogram:
+        return self._register(Histogram(name, help, buckets, labels))
+
+    def render(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str):
+        with open(path, "w") as f:
+            f.write(self.render())
+
+
+TTFT_BUCKETS          = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+INTER_TOKEN_BUCKETS   = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+STEP_BUCKETS          = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class GenerationMetrics(MetricsRegistry):
+    def __init__(self):
+        """
+        Metrics updated by GemmaForCausalLM.generate_stream when model.metrics is set.
+        1. 요청 (배치의 행) 수, 프롬프트 / 생성 토큰 수, 처리량
+        2. TTFT (generate_stream 호출부터 행의 첫 토큰까지), 행마다의 토큰 사이 시간 히스토그램
+        3. 스텝(prefill / decode) 시간, 진행 중인 배치의 행 수와 occupancy, 사용 중인 KV 캐시 bytes
+        4. queue_depth (스크레이프 시점)와 queue_wait는 서버 (BatchScheduler)가 채운다.
+           서버 요청의 TTFT = queue_wait + time_to_first_token
+        """
+        super().__init__()
+        self.requests          = self.counter("gemma_requests_total", "Sequences submitted to generate_stream.")
+        self.prompt_tokens     = self.counter("gemma_prompt_tokens_total", "Prompt tokens processed.")
+        self.generated_tokens  = self.counter("gemma_generated_tokens_total", "Tokens generated before a stop token or the row's max tokens.")
+        self.ttft              = self.histogram("gemma_time_to_first_token_seconds", "Time from the start of generation to the first token of a sequence.", TTFT_BUCKETS)
+        self.inter_token       = self.histogram("gemma_inter_token_latency_seconds", "Time between consecutive tokens of a sequence.", INTER_TOKEN_BUCKETS)
+        self.step_seconds      = self.histogram("gemma_step_seconds", "Wall time of one forward step.", STEP_BUCKETS, labels=("phase",))
+        self.tokens_per_second = self.gauge("gemma_tokens_per_second", "Generated tokens per second of the last finished batch.")
+        self.active_sequences  = self.gauge("gemma_active_sequences", "Sequences still generating in running batches.")
+        self.batch_occupancy   = self.gauge("gemma_batch_occupancy", "Fraction of rows of the last stepped batch that are still generating.")
+        self.kv_cache_bytes    = self.gauge("gemma_kv_cache_bytes", "KV cache bytes holding written positions, over running batches.")
+        self.kv_cache_capacity = self.gauge("gemma_kv_cache_capacity_bytes", "KV cache bytes allocated by running batches.")
+        self.queue_depth       = self.gauge("gemma_queue_depth", "Requests waiting in the server queue.")
+        self.queue_wait        = self.histogram("gemma_queue_wait_seconds", "Time a server request waited in the queue before its batch started.", TTFT_BUCKETS)
+
+    def start_batch(self, prompt_lens: Sequence[int], kv_cache_bytes: int) -> "BatchMetrics":
+        return BatchMetrics(self, prompt_lens, kv_cache_bytes)
+
+
+class BatchMetrics:
+    # generate_stream 한 번의 상태: 행마다 첫 토큰 여부, 마지막 토큰 시각, 생성한 토큰 수
+    def __init__(self, metrics: GenerationMetrics, prompt_lens: Sequence[int], kv_cache_bytes: int):
+        self.metrics     = metrics
+        self.start       = time.perf_counter()
+        self.last_time   = [None] * len(prompt_lens)
+        self.num_tokens  = [0] * len(prompt_lens)
+        self.finished    = [False] * len(prompt_lens)
+        self.kv_bytes    = kv_cache_bytes
+        self.kv_used     = 0
+        self.step_start  = self.start
+        metrics.requests.inc(len(prompt_lens))
+        metrics.prompt_tokens.inc(sum(prompt_lens))
+        metrics.active_sequences.inc(len(prompt_lens))
+        metrics.kv_cache_capacity.inc(kv_cache_bytes)
+
+    def begin_step(self):
+        # 스텝 시간은 forward만 잰다 (호출하는 쪽이 다른 배치를 실행하는 시간 제외).
+        self.step_start = time.perf_counter()
+
+    def step(self,
+        phase: str,
+        tokens: Sequence[Optional[int]],
+        stop_ids: Sequence[Collection[int]],
+        max_tokens: Sequence[int],
+        used_fraction: float,
+        ):
+        """
+        Records one yielded step: tokens[i] is None while row i reads its prompt.
+        행 i는 stop_ids[i] (EOS, <end_of_turn> 등)의 토큰이 나오거나 max_tokens[i]개를 생성하면 끝난다 (stop 토큰은 세지 않는다).
+        """
+        now = time.perf_counter()
+        self.metrics.step_seconds.observe(now - self.step_start, phase=phase)
+        self.step_start = now
+        for i, token in enumerate(tokens):
+            if token is None or self.finished[i]:
+                continue
+            if token in stop_ids[i]:
+                self._finish(i)
+                continue
+            if self.last_time[i] is None:
+                self.metrics.ttft.observe(now - self.start)
+            else:
+                self.metrics.inter_token.observe(now - self.last_time[i])
+            self.last_time[i] = now
+            self.num_tokens[i] += 1
+            self.metrics.generated_tokens.inc()
+            if self.num_tokens[i] >= max_tokens[i]:
+                self._finish(i)
+        self.metrics.batch_occupancy.set(self.finished.count(False) / len(self.finished))
+        kv_used = int(self.kv_bytes * used_fraction)
+        self.metrics.kv_cache_bytes.inc(kv_used - self.kv_used)
+        self.kv_used = kv_used
+
+    def _finish(self, i: int):
+        self.finished[i] = True
+        self.metrics.active_sequences.dec()
+
+    def close(self):
+        # 제너레이터가 끝나거나 호출하는 쪽이 멈추면 (close) 진행 중인 행과 KV 캐시를 반환
+        for i, finished in enumerate(self.finished):
+            if not finished:
+                self._finish(i)
+        self.metrics.kv_cache_bytes.dec(self.kv_used)
+        self.metrics.kv_cache_capacity.dec(self.kv_bytes)
+        self.kv_used = 0
+        elapsed = time.perf_counter() - self.start
+        if elapsed > 0:
+            self.metrics.tokens_per_second.set(sum(self.num_tokens) / elapsed)
@@ -0,0 +1,278 @@
+# Pipeline-parallel inference: contiguous slices of decoder layers per stage with micro-batching.
+import re
+import dataclasses
+from typing import (
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union
+    )
+import torch
+import torch.distributed as dist
+import safetensors
+from source.config import GemmaConfig, get_weight_paths
+from source.gemma_torch import GemmaForCausalLM, sampling_keys
+
+
+LAYER_KEY_PATTERN = re.compile(r"^model\.layers\.(\d+)\.(.*)$")
+
+
+def get_stage_layers(num_layers: int, num_stages: int) -> List[Tuple[int, int]]:
+    """Splits num_layers decoder layers into num_stages contiguous [start, end) slices (앞 stage가 하나 더)."""
+    if not 0 < num_stages <= num_layers:
+        raise ValueError(f'num_stages {num_stages} must be in [1, {num_layers}]')
+    base, extra = divmod(num_layers, num_stages)
+    slices, start = [], 0
+    for stage in range(num_stages):
+        end = start + base + (1 if stage < extra else 0)
+        slices.append((start, end))
+        start = end
+    return slices
+
+
+def load_stage_weights(
+    model: GemmaForCausalLM,
+    model_path: str,
+    layer_range: Tuple[int, int],
+    load_embedding: bool,
+    ):
+    """
+    load_weights와 같은 파일에서 이 stage의 레이어만 읽고 model.layers.{i}를 로컬 인덱스로 바꾼다.
+    임베딩은 첫 stage(입력)와 마지막 stage(tied LM head)만 읽는다.
+    """
+    start, end = layer_range
+    model_paths = get_weight_paths(model_path)
+    safe_tensors = {}
+    for path in model_paths:
+        with safetensors.safe_open(path, framework="pt") as model_file:
+            for key in model_file.keys():
+                match = LAYER_KEY_PATTERN.match(key)
+                if match is not None:
+                    index = int(match.group(1))
+                    if not start <= index < end:
+                        continue
+                    local_key = f"model.layers.{index - start}.{match.group(2)}"
+                elif key.startswith("model.embed_tokens.") and not load_embedding:
+                    continue
+                else:
+                    local_key = key
+                if local_key in safe_tensors:
+                    continue
+                tensor = model_file.get_tensor(key)
+                if tensor.is_floating_point():
+                    tensor = tensor.type(model.config.get_dtype())
+                safe_tensors[local_key] = tensor
+    model.load_state_dict(safe_tensors, strict=False)
+
+
+def build_stage_model(
+    config: GemmaConfig,
+    stage: int,
+    num_stages: int,
+    model_path: Optional[str] = None,
+    ) -> GemmaForCausalLM:
+    """
+    Builds the GemmaForCausalLM of one stage with only its slice of decoder layers.
+    중간 stage의 임베딩은 torch.empty로만 만들어 두고 읽지 않으므로 메모리에 올라오지 않는다.
+    """
+    layer_range  = get_stage_layers(config.num_hidden_layers, num_stages)[stage]
+    stage_config = dataclasses.replace(config, num_hidden_layers=layer_range[1] - layer_range[0])
+    model = GemmaForCausalLM(stage_config)
+    if model_path is not None:
+        load_stage_weights(model, model_path, layer_range, stage in (0, num_stages - 1))
+    return model.eval()
+
+
+@dataclasses.dataclass
+class MicroBatch:
+    # generate_stream과 같은 디코딩 상태를 micro-batch마다 둔다.
+    token_ids: torch.Tensor
+    prompt_mask: torch.Tensor
+    input_token_ids: torch.Tensor
+    input_positions: torch.Tensor
+    output_index: torch.Tensor
+    output_positions: torch.Tensor
+    kv_caches: List[Tuple[torch.Tensor, torch.Tensor]]
+    num_steps: int
+    seeds: Optional[torch.Tensor] = None
+    # 첫 stage: 보낸 스텝의 토큰을 아직 받지 않음
+    pending: bool = False
+
+
+class PipelineGenerator:
+    def __init__(self, model: GemmaForCausalLM, stage: int, num_stages: int):
+        """
+        1. stage s는 레이어 slice와 그 레이어들의 KV 캐시만 가진다.
+        2. hidden states는 gloo send / recv로 다음 stage로 넘기고, 마지막 stage가 고른 토큰은 첫 stage로 돌려보낸다.
+        3. 배치를 micro-batch로 나누어 돌아가며 보내므로, micro-batch 수가 stage 수 이상이면 모든 stage가 쉬지 않는다.
+        init_process_group을 먼저 호출해야 하며 stage = rank이다.
+        """
+        self.model      = model
+        self.config     = model.config
+        self.stage      = stage
+        self.num_stages = num_stages
+        self.is_first   = stage == 0
+        self.is_last    = stage == num_stages - 1
+        self._pending   = []
+
+    def _micro_batch(self, prompt_tokens: Sequence[Sequence[int]], output_len: int, seeds) -> MicroBatch:
+        config         = self.config
+        batch_size     = len(prompt_tokens)
+        pad_id         = self.model.pad_id
+        min_prompt_len = min(len(p) for p in prompt_tokens)
+        max_seq_len    = max(len(p) for p in prompt_tokens) + output_len
+        assert max_seq_len <= config.max_position_embeddings
+
+        kv_caches = []
+        for _ in range(config.num_hidden_layers):
+            size = (batch_size, max_seq_len, config.num_key_value_heads, config.head_dim)
+            kv_caches.append((torch.zeros(size, dtype=config.get_dtype()), torch.zeros(size, dtype=config.get_dtype())))
+        token_ids = torch.full((batch_size, max_seq_len), pad_id, dtype=torch.int64)
+        for i, p in enumerate(prompt_tokens):
+            token_ids[i, :len(p)] = torch.tensor(p)
+        return MicroBatch(
+            token_ids=token_ids,
+            prompt_mask=token_ids != pad_id,
+            input_token_ids=token_ids[:, :min_prompt_len].clone(),
+            input_positions=torch.arange(0, min_prompt_len, dtype=torch.int64),
+            output_index=torch.tensor(min_prompt_len, dtype=torch.int64),
+            output_positions=torch.LongTensor([min_prompt_len - 1]),
+            kv_caches=kv_caches,
+            num_steps=max_seq_len - min_prompt_len,
+            seeds=None if seeds is None else torch.tensor(seeds, dtype=torch.int64),
+            )
+
+    def _send(self, tensor: torch.Tensor, dst: int):
+        # isend로 보내서 다음 micro-batch 계산과 겹치게 하고, 끝나지 않은 핸들은 버퍼가 살아있도록 보관
+        self._pending = [(handle, buffer) for handle, buffer in self._pending if not handle.is_completed()]
+        self._pending.append((dist.isend(tensor, dst), tensor))
+
+    def _wait_sends(self):
+        for handle, _ in self._pending:
+            handle.wait()
+        self._pending = []
+
+    def _step(self, batch: MicroBatch, mask_tensor: torch.Tensor, temperatures, top_ps, top_ks) -> Optional[torch.Tensor]:
+        model, config = self.model, self.config
+        batch_size    = batch.token_ids.shape[0]
+        input_len     = batch.input_positions.shape[0]
+        if self.is_first:
+            hidden_states = model.model.embed_tokens(batch.input_token_ids)
+            hidden_states = hidden_states * torch.tensor(config.hidden_size**0.5, dtype=hidden_states.dtype)
+        else:
+            hidden_states = torch.empty((batch_size, input_len, config.hidden_size), dtype=config.get_dtype())
+            dist.recv(hidden_states, self.stage - 1)
+
+        freqs_cis = model.rotary_embedding(batch.input_positions)
+        mask      = mask_tensor.index_select(2, batch.input_positions)
+        residual  = None
+        for layer, kv_cache in zip(model.model.layers, batch.kv_caches):
+            hidden_states, residual = layer(
+                hidden_states=hidden_states,
+                freqs_cis=freqs_cis,
+                kv_write_indices=batch.input_positions,
+                kv_cache=kv_cache,
+                mask=mask,
+                residual=residual,
+                )
+        if not self.is_last:
+            # 다음 stage는 residual = None으로 시작하므로 마지막 레이어의 residual을 더해서 보낸다.
+            self._send(hidden_states + residual, self.stage + 1)
+            return None
+
+        hidden_states, _ = model.model.norm(hidden_states, residual)
+        next_token_ids = model.sampler(
+            embedding=model.model.embed_tokens,
+            hidden_states=hidden_states,
+            output_positions=batch.output_positions,
+            temperatures=temperatures,
+            top_ps=top_ps,
+            top_ks=top_ks,
+            sampling_keys=None if batch.seeds is None else sampling_keys(batch.seeds, batch.output_index),
+            )
+        curr_prompt_mask = batch.prompt_mask.index_select(1, batch.output_index).squeeze(dim=1)
+        curr_token_ids   = batch.token_ids.index_select(1, batch.output_index).squeeze(dim=1)
+        output_token_ids = torch.where(curr_prompt_mask, curr_token_ids, next_token_ids).unsqueeze(dim=1)
+        if not self.is_first:
+            self._send(output_token_ids, 0)
+        return output_token_ids
+
+    def _advance(self, batch: MicroBatch, output_token_ids: Optional[torch.Tensor]):
+        # 마지막 stage가 고른 토큰을 받아 다음 스텝의 입력으로 (중간 stage는 위치만 갱신)
+        if output_token_ids is None and self.is_first:
+            output_token_ids = torch.empty((batch.token_ids.shape[0], 1), dtype=torch.int64)
+            dist.recv(output_token_ids, self.num_stages - 1)
+        if output_token_ids is not None:
+            batch.token_ids.index_copy_(1, batch.output_index, output_token_ids)
+            batch.input_token_ids = output_token_ids
+        batch.input_positions  = batch.output_index.unsqueeze(dim=-1)
+        batch.output_positions = torch.tensor(0, dtype=torch.int64)
+        batch.output_index     = batch.output_index + 1
+        batch.num_steps       -= 1
+
+    @torch.no_grad()
+    def generate(self,
+        prompts: Optional[Sequence[Sequence[int]]] = None,
+        output_len: int = 100,
+        num_micro_batches: int = 1,
+        temperature: Optional[float] = None,
+        top_p: float = 1.0,
+        top_k: int = 100,
+        seed: Union[int, Sequence[Optional[int]], None] = None,
+        ) -> Optional[List[List[int]]]:
+        """
+        Runs pipelined generation; prompts (token ids) are only needed on stage 0.
+        첫 stage는 행마다 생성된 토큰 아이디 (output_len개)를, 나머지 stage는 None을 반환한다.
+        generate_stream의 repetition / frequency / presence 패널티와 logit_bias는 지원하지 않는다.
+        """
+        # 프롬프트와 파라미터를 모든 stage에 보내서 같은 스케줄을 계산한다.
+        meta = [(prompts, output_len, num_micro_batches, temperature, top_p, top_k, seed)]
+        if self.num_stages > 1:
+            dist.broadcast_object_list(meta, src=0)
+        prompts, output_len, num_micro_batches, temperature, top_p, top_k, seed = meta[0]
+        prompts = [list(p) for p in prompts]
+        if temperature:
+            # 샘플링은 마지막 stage에서만 하므로 시드가 없는 행은 카운터 기반 샘플링의 랜덤 시드를 사용
+            if isinstance(seed, int) or seed is None:
+                seed = [seed] * len(prompts)
+            random_seeds = torch.randint(0, 2**62, (len(prompts),), dtype=torch.int64).tolist()
+            seed = [r if s is None else s for s, r in zip(seed, random_seeds)]
+
+        micro_size = -(-len(prompts) // num_micro_batches)
+        bounds     = [(i, min(i + micro_size, len(prompts))) for i in range(0, len(prompts), micro_size)]
+        batches    = [self._micro_batch(prompts[s:e], output_len, seed[s:e] if temperature else None)
+                      for s, e in bounds]
+        max_seq_len = max(batch.token_ids.shape[1] for batch in batches)
+        mask_tensor = torch.triu(torch.full((1, 1, max_seq_len, max_seq_len), -2.3819763e38), diagonal=1)
+
+        sampling = [
+            (None if not temperature else torch.full((e - s,), float(temperature)),
+             torch.full((e - s,), float(top_p)),
+             torch.full((e - s,), int(top_k), dtype=torch.int64))
+            for s, e in bounds
+            ]
+        # micro-batch를 돌아가며 한 스텝씩: stage 0은 앞 micro-batch가 뒤 stage에 있는 동안 다음 것을 계산하고,
+        # 같은 micro-batch의 다음 스텝 직전에만 마지막 stage가 고른 토큰을 기다린다.
+        while any(batch.num_steps > 0 for batch in batches):
+            for batch, (temperatures, top_ps, top_ks) in zip(batches, sampling):
+                if batch.pending:
+                    self._advance(batch, None)
+                    batch.pending = False
+                if batch.num_steps == 0:
+                    continue
+                mask = mask_tensor[..., :batch.token_ids.shape[1]]
+                output_token_ids = self._step(batch, mask, temperatures, top_ps, top_ks)
+                if self.is_first and not self.is_last:
+                    batch.pending = True
+                else:
+                    self._advance(batch, output_token_ids)
+        self._wait_sends()
+
+        if not self.is_first:
+            return None
+        outputs = []
+        for (s, e), batch in zip(bounds, batches):
+            for i, p in enumerate(prompts[s:e]):
+                outputs.append(batch.token_ids[i, len(p):len(p) + output_len].tolist())
+        return outputs
@@ -0,0 +1,300 @@
+# Opt-in per-module profiling of GemmaForCausalLM: wall time, estimated FLOPs / bytes, KV cache occupancy.
+import json
+import time
+import threading
+import collections
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Tuple
+    )
+import torch
+import torch.nn as nn
+from source.gemma_torch import (
+    Embedding,
+    GemmaAttention,
+    GemmaForCausalLM,
+    GemmaMLP,
+    Linear,
+    RMSNorm,
+    Sampler
+    )
+
+
+def _tensor_bytes(tensor: Optional[torch.Tensor]) -> int:
+    return 0 if tensor is None else tensor.numel() * tensor.element_size()
+
+
+def _module_bytes(module: nn.Module) -> int:
+    # weight + weight_scaler (int4 packing이면 uint8 한 바이트에 두 개)
+    return sum(_tensor_bytes(p) for p in module.parameters())
+
+
+def linear_dims(linear: Linear) -> Tuple[int, int]:
+    """(in_features, out_features) of a possibly quantized Linear."""
+    out_features, in_features = linear.weight.shape
+    if linear.quant and linear.quant_bits == 4:
+        in_features *= 2
+    return in_features, out_features
+
+
+def _linear_flops(linear: Linear, num_tokens: int) -> int:
+    in_features, out_features = linear_dims(linear)
+    return 2 * num_tokens * in_features * out_features
+
+
+def _arg(args: tuple, kwargs: dict, index: int, name: str):
+    return kwargs[name] if name in kwargs else args[index]
+
+
+def estimate_cost(module: nn.Module, args: tuple, kwargs: dict, output: Any) -> Tuple[int, int]:
+    """
+    Estimated (FLOPs, bytes moved) of one module call.
+    1. Linear, MLP: 2 * 토큰 수 * in * out, bytes는 weight + 입력 / 출력 활성값
+    2. Attention: q / k / v / o projection + QK^T, PV (캐시 길이 전체에 대해 계산), bytes에 KV 캐시 읽기 포함
+    3. RMSNorm: 원소당 약 4 FLOPs, 입력 / 출력 (residual이 있으면 residual 읽기 / 쓰기 포함)
+    4. Sampler: tied embedding과의 matmul 2 * batch * hidden * vocab, embedding 전체를 읽는다.
+    """
+    if isinstance(module, Linear):
+        x = args[0]
+        num_tokens = x.numel() // x.shape[-1]
+        return _linear_flops(module, num_tokens), _module_bytes(module) + _tensor_bytes(x) + _tensor_bytes(output)
+    if isinstance(module, GemmaMLP):
+        x = args[0]
+        num_tokens = x.numel() // x.shape[-1]
+        flops = sum(_linear_flops(linear, num_tokens) for linear in (module.gate_proj, module.up_proj, module.down_proj))
+        return flops, _module_bytes(module) + _tensor_bytes(x) + _tensor_bytes(output)
+    if isinstance(module, GemmaAttention):
+        hidden_states = _arg(args, kwargs, 0, "hidden_states")
+        kv_cache      = _arg(args, kwargs, 3, "kv_cache")
+        batch_size, input_len, _ = hidden_states.shape
+        kv_len   = input_len if kv_cache is None else kv_cache[0].shape[1]
+        flops    = sum(_linear_flops(linear, batch_size * input_len)
+                       for linear in (module.q_proj, module.k_proj, module.v_proj, module.o_proj))
+        flops   += 4 * batch_size * module.num_heads * input_len * kv_len * module.head_dim
+        kv_bytes = 0 if kv_cache is None else _tensor_bytes(kv_cache[0]) + _tensor_bytes(kv_cache[1])
+        return flops, _module_bytes(module) + kv_bytes + _tensor_bytes(hidden_states) + _tensor_bytes(output)
+    if isinstance(module, RMSNorm):
+        x = args[0]
+        residual = args[1] if len(args) > 1 else kwargs.get("residual")
+        io_bytes = 2 * _tensor_bytes(x) * (2 if residual is not None else 1)
+        return 4 * x.numel(), io_bytes + _module_bytes(module)
+    if isinstance(module, Embedding):
+        x = args[0]
+        return 0, x.numel() * module.weight.shape[-1] * module.weight.element_size() + _tensor_bytes(output)
+    if isinstance(module, Sampler):
+        embedding     = _arg(args, kwargs, 0, "embedding")
+        hidden_states = _arg(args, kwargs, 1, "hidden_states")
+        weight_bytes  = _module_bytes(embedding) if isinstance(embedding, nn.Module) else _tensor_bytes(embedding)
+        batch_size, hidden_size = hidden_states.shape[0], hidden_states.shape[-1]
+        return 2 * batch_size * hidden_size * module.vocab_size, weight_bytes
+    return 0, 0
+
+
+class Profiler:
+    def __init__(self, model: GemmaForCausalLM, include_linear: bool = False):
+        """
+        Records every module call of model while active (with Profiler(model) as profiler: ...).
+        1. with 블록 밖에서는 hook이 등록되어 있지 않으므로 오버헤드가 없다.
+        2. 모듈마다 wall time, 추정 FLOPs, bytes를 prefill / decode로 나누어 집계한다.
+           GemmaModel의 입력 길이가 1보다 크면 prefill (chunk prefill 포함), 1이면 decode
+        3. GemmaForCausalLM.forward 한 번이 한 스텝이며, 스텝 사이의 시간은 generate 루프의 Python 오버헤드
+           (마스크 생성, 토큰 bookkeeping, 호출하는 쪽의 처리)로 기록한다.
+           forward 없이 _hidden_states만 부르는 chunk prefill의 chunk (와 score / embed의 prefill)도 각각 한 스텝이다.
+           스텝의 FLOPs / bytes는 그 안에서 실행된 모듈 (Linear는 attention / MLP에 포함되므로 제외)의 합
+        4. 스텝마다 KV 캐시 점유 (쓰인 위치 수 / 캐시 길이, bytes)를 기록한다.
+        5. export_chrome_trace는 chrome://tracing 또는 Perfetto에서 여는 JSON, summary는 집계 dict
+        include_linear이면 q / k / v / o, gate / up / down projection도 각각 기록한다.
+        """
+        self.model          = model
+        self.include_linear = include_linear
+        self.events: List[Dict[str, Any]] = []
+        self.kv_samples: List[Dict[str, Any]] = []
+        self._handles = []
+        self._starts: Dict[int, List[float]] = collections.defaultdict(list)
+        self._phase   = "prefill"
+        self._origin  = 0.0
+        self._last_step_end: Optional[float] = None
+        # 진행 중인 스텝: 시작 시각과 지금까지 실행된 모듈의 FLOPs / bytes
+        self._step: Optional[Dict[str, float]] = None
+        self._tid     = threading.get_ident()
+
+    def _named_modules(self) -> List[Tuple[str, nn.Module]]:
+        modules = [("embedding", self.model.model.embed_tokens)]
+        for i, layer in enumerate(self.model.model.layers):
+            modules.append((f"layers.{i}", layer))
+            for child in ("input_layernorm", "self_attn", "post_attention_layernorm", "mlp"):
+                modules.append((f"layers.{i}.{child}", getattr(layer, child)))
+            if self.include_linear:
+                for name, linear in layer.named_modules():
+                    if isinstance(linear, Linear):
+                        modules.append((f"layers.{i}.{name}", linear))
+        modules.append(("norm", self.model.model.norm))
+        modules.append(("sampler", self.model.sampler))
+        return modules
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self._origin = time.perf_counter()
+        self._last_step_end = None
+        for name, module in self._named_modules():
+            self._handles.append(module.register_forward_pre_hook(self._pre_hook, with_kwargs=True))
+            self._handles.append(module.register_forward_hook(self._post_hook(name), with_kwargs=True))
+        self._handles.append(self.model.model.register_forward_pre_hook(self._model_pre_hook, with_kwargs=True))
+        self._handles.append(self.model.register_forward_pre_hook(self._step_pre_hook, with_kwargs=True))
+        self._handles.append(self.model.register_forward_hook(self._step_hook, with_kwargs=True))
+        # chunk prefill은 forward hook이 불리지 않으므로 _hidden_states를 감싸 forward 밖의 호출을 한 스텝으로 기록
+        hidden_states = self.model._hidden_states
+
+        def hidden_states_step(*args, **kwargs):
+            if self._step is not None:
+                return hidden_states(*args, **kwargs)
+            self._begin_step()
+            output = hidden_states(*args, **kwargs)
+            self._end_step()
+            return output
+        self.model._hidden_states = hidden_states_step
+        return self
+
+    def stop(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+        self.model.__dict__.pop("_hidden_states", None)
+        self._step = None
+
+    def _now_us(self) -> float:
+        return (time.perf_counter() - self._origin) * 1e6
+
+    def _pre_hook(self, module, args, kwargs):
+        self._starts[id(module)].append(self._now_us())
+
+    def _post_hook(self, name: str):
+        # layers.3.self_attn -> self_attn, layers.3 -> layer: 레이어 번호를 빼고 집계
+        parts = name.split(".")
+        kind  = name if parts[0] != "layers" else "layer" if len(parts) == 2 else ".".join(parts[2:])
+
+        def hook(module, args, kwargs, output):
+            start = self._starts[id(module)].pop()
+            flops, num_bytes = estimate_cost(module, args, kwargs, output)
+            if self._step is not None and not isinstance(module, Linear):
+                self._step["flops"] += flops
+                self._step["bytes"] += num_bytes
+            self.events.append({
+                "name": name, "kind": kind,
+                "phase": self._phase, "ts": start, "dur": self._now_us() - start,
+                "flops": flops, "bytes": num_bytes,
+                })
+        return hook
+
+    def _model_pre_hook(self, module, args, kwargs):
+        # GemmaModel의 입력으로 prefill / decode를 구분하고 KV 캐시 점유를 기록
+        hidden_states    = kwargs["hidden_states"] if "hidden_states" in kwargs else args[0]
+        kv_write_indices = kwargs["kv_write_indices"] if "kv_write_indices" in kwargs else args[2]
+        kv_caches        = kwargs["kv_caches"] if "kv_caches" in kwargs else args[3]
+        self._phase = "prefill" if hidden_states.shape[1] > 1 else "decode"
+        if kv_caches is None:
+            return
+        capacity  = kv_caches[0][0].shape[1]
+        used      = int(kv_write_indices.max()) + 1
+        cache_bytes = sum(_tensor_bytes(k) + _tensor_bytes(v) for k, v in kv_caches)
+        self.kv_samples.append({
+            "ts": self._now_us(), "used_positions": used, "capacity_positions": capacity,
+            "used_bytes": cache_bytes * used // capacity, "capacity_bytes": cache_bytes,
+            })
+
+    def _step_pre_hook(self, module, args, kwargs):
+        self._begin_step()
+
+    def _step_hook(self, module, args, kwargs, output):
+        self._end_step()
+
+    def _begin_step(self):
+        self._step = {"ts": self._now_us(), "flops": 0, "bytes": 0}
+
+    def _end_step(self):
+        step, self._step = self._step, None
+        end = self._now_us()
+        if self._last_step_end is not None:
+            self.events.append({
+                "name": "generate_loop", "kind": "generate_loop", "phase": self._phase,
+                "ts": self._last_step_end, "dur": step["ts"] - self._last_step_end, "flops": 0, "bytes": 0,
+                })
+        self.events.append({
+            "name": f"{self._phase}_step", "kind": "step", "phase": self._phase,
+            "ts": step["ts"], "dur": end - step["ts"], "flops": step["flops"], "bytes": step["bytes"],
+            })
+        self._last_step_end = end
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Aggregates events per (phase, kind): calls, total ms, GFLOPs, GB and the achieved rates.
+        layer는 하위 모듈을 포함한 시간이고, step은 한 번의 forward 전체 시간이다.
+        """
+        groups: Dict[Tuple[str, str], Dict[str, float]] = {}
+        for event in self.events:
+            group = groups.setdefault((event["phase"], event["kind"]), {"calls": 0, "ms": 0.0, "flops": 0, "bytes": 0})
+            group["calls"] += 1
+            group["ms"]    += event["dur"] / 1000
+            group["flops"] += event["flops"]
+            group["bytes"] += event["bytes"]
+        modules = []
+        for (phase, kind), group in groups.items():
+            seconds = group["ms"] / 1000
+            modules.append({
+                "phase": phase, "kind": kind, "calls": group["calls"], "total_ms": group["ms"],
+                "gflops": group["flops"] / 1e9, "gbytes": group["bytes"] / 1e9,
+                "gflops_per_sec": group["flops"] / 1e9 / seconds if seconds > 0 else 0.0,
+                "gbytes_per_sec": group["bytes"] / 1e9 / seconds if seconds > 0 else 0.0,
+                })
+        modules.sort(key=lambda m: (m["phase"], -m["total_ms"]))
+        kv_cache = {}
+        if self.kv_samples:
+            last = self.kv_samples[-1]
+            kv_cache = {
+                "used_positions": last["used_positions"], "capacity_positions": last["capacity_positions"],
+                "used_bytes": last["used_bytes"], "capacity_bytes": last["capacity_bytes"],
+                "occupancy": last["used_positions"] / last["capacity_positions"],
+                }
+        return {"modules": modules, "kv_cache": kv_cache}
+
+    def report(self) -> str:
+        summary = self.summary()
+        lines = [f"{'phase':<8} {'kind':<26} {'calls':>6} {'total ms':>10} {'GFLOP':>9} {'GB':>8} {'GFLOP/s':>9} {'GB/s':>7}"]
+        for m in summary["modules"]:
+            lines.append(f"{m['phase']:<8} {m['kind']:<26} {m['calls']:>6} {m['total_ms']:>10.2f} {m['gflops']:>9.3f} "
+                         f"{m['gbytes']:>8.3f} {m['gflops_per_sec']:>9.2f} {m['gbytes_per_sec']:>7.2f}")
+        kv_cache = summary["kv_cache"]
+        if kv_cache:
+            lines.append(f"kv cache: {kv_cache['used_positions']}/{kv_cache['capacity_positions']} positions "
+                         f"({kv_cache['occupancy']:.1%}), {kv_cache['used_bytes'] / 2**20:.1f}/{kv_cache['capacity_bytes'] / 2**20:.1f} MiB")
+        return "\n".join(lines)
+
+    def export_chrome_trace(self, path: str):
+        """Writes the events (complete events) and KV cache occupancy (counter events) in the Chrome trace format."""
+        trace = []
+        for event in self.events:
+            trace.append({
+                "name": event["name"], "cat": event["kind"], "ph": "X", "pid": 0, "tid": self._tid,
+                "ts": event["ts"], "dur": event["dur"],
+                "args": {"phase": event["phase"], "flops": event["flops"], "bytes": event["bytes"]},
+                })
+        for sample in self.kv_samples:
+            trace.append({
+                "name": "kv_cache", "ph": "C", "pid": 0, "ts": sample["ts"],
+                "args": {"used_bytes": sample["used_bytes"], "capacity_bytes": sample["capacity_bytes"]},
+                })
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+    def save_summary(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
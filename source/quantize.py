@@ -0,0 +1,180 @@
+# Weight-only int8 / int4 group quantization for Gemma.
+import re
+from typing import (
+    Dict,
+    Optional,
+    Sequence,
+    Tuple
+    )
+import torch
+import torch.nn.functional as F
+
+
+# 양자화 대상: Linear(*_proj)와 Embedding(embed_tokens)의 weight
+QUANT_WEIGHT_PATTERN = re.compile(r".*(_proj|embed_tokens)\.weight$")
+
+# Clip ratio 후보: 그룹마다 복원 오차(MSE)가 가장 작은 비율을 고른다.
+DEFAULT_CLIP_RATIOS = (1.0, 0.95, 0.9, 0.85, 0.8)
+
+
+def get_qrange(bits: int) -> Tuple[int, int]:
+    """Returns the (min, max) integer range of a symmetric signed quantizer."""
+    if bits not in (4, 8):
+        raise ValueError(f'Invalid quant bits {bits}. Supported bits are 4 and 8')
+    qmax = 2 ** (bits - 1) - 1
+    return -qmax - 1, qmax
+
+
+def get_num_groups(in_features: int, group_size: int) -> int:
+    """Returns the number of scale groups along the input dimension (0 means per-row)."""
+    if group_size == 0:
+        return 1
+    if in_features % group_size != 0:
+        raise ValueError(f'group_size {group_size} must divide in_features {in_features}')
+    return in_features // group_size
+
+
+def get_quant_shapes(out_features: int, in_features: int, bits: int, group_size: int):
+    """Returns (weight shape, weight dtype, weight_scaler shape) of a quantized [out, in] weight."""
+    num_groups = get_num_groups(in_features, group_size)
+    scaler_shape = (out_features,) if group_size == 0 else (out_features, num_groups)
+    if bits == 4:
+        assert in_features % 2 == 0, in_features
+        return (out_features, in_features // 2), torch.uint8, scaler_shape
+    return (out_features, in_features), torch.int8, scaler_shape
+
+
+def pack_int4(q: torch.Tensor) -> torch.Tensor:
+    # [out, in] 범위 [-8, 7]의 int8 -> [out, in // 2] uint8
+    # 짝수 열은 하위 4비트, 홀수 열은 상위 4비트에 담는다.
+    u = (q.to(torch.int16) + 8).to(torch.uint8)
+    return u[:, 0::2] | (u[:, 1::2] << 4)
+
+
+def unpack_int4(packed: torch.Tensor) -> torch.Tensor:
+    # [..., in // 2] uint8 -> [..., in] int8
+    low  = (packed & 0x0F).to(torch.int8) - 8
+    high = (packed >> 4).to(torch.int8) - 8
+    return torch.stack([low, high], dim=-1).flatten(-2)
+
+
+def _quantize_rows(
+    w: torch.Tensor,
+    bits: int,
+    group_size: int,
+    clip_ratios: Sequence[float],
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+    qmin, qmax = get_qrange(bits)
+    out_features, in_features = w.shape
+    num_groups = get_num_groups(in_features, group_size)
+    w = w.float().view(out_features, num_groups, -1)
+    absmax = w.abs().amax(dim=-1).clamp(min=1e-10) # [out, G]
+
+    best_q, best_scaler, best_err = None, None, None
+    for ratio in clip_ratios:
+        scaler = absmax * ratio / qmax
+        q = torch.clamp(torch.round(w / scaler.unsqueeze(-1)), qmin, qmax)
+        err = (q * scaler.unsqueeze(-1) - w).pow(2).sum(dim=-1) # [out, G]
+        if best_err is None:
+            best_q, best_scaler, best_err = q, scaler, err
+            continue
+        better      = err < best_err
+        best_q      = torch.where(better.unsqueeze(-1), q, best_q)
+        best_scaler = torch.where(better, scaler, best_scaler)
+        best_err    = torch.where(better, err, best_err)
+    return best_q.view(out_features, in_features).to(torch.int8), best_scaler
+
+
+@torch.no_grad()
+def quantize_weight(
+    weight: torch.Tensor,
+    bits: int = 8,
+    group_size: int = 0,
+    clip_ratios: Sequence[float] = DEFAULT_CLIP_RATIOS,
+    row_chunk_size: int = 4096,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Quantizes a float [out, in] weight into (weight, weight_scaler).
+    1. int8: weight는 [out, in] int8
+    2. int4: weight는 [out, in // 2] uint8 (두 값을 한 바이트에 packing)
+    3. weight_scaler는 group_size = 0이면 [out] (기존 per-row 포맷), 아니면 [out, in // group_size]
+    """
+    assert weight.dim() == 2, weight.shape
+    qs, scalers = [], []
+    # 256000 x 2048 임베딩도 float32 사본 전체를 만들지 않도록 행 단위로 나누어 양자화
+    for start in range(0, weight.shape[0], row_chunk_size):
+        q, scaler = _quantize_rows(weight[start:start + row_chunk_size], bits, group_size, clip_ratios)
+        qs.append(pack_int4(q) if bits == 4 else q)
+        scalers.append(scaler)
+    qweight = torch.cat(qs, dim=0)
+    scaler  = torch.cat(scalers, dim=0)
+    if group_size == 0:
+        scaler = scaler.squeeze(dim=-1)
+    return qweight, scaler.float()
+
+
+def dequantize_weight(
+    weight: torch.Tensor,
+    weight_scaler: torch.Tensor,
+    bits: int = 8,
+    group_size: int = 0,
+    dtype: Optional[torch.dtype] = None,
+    ) -> torch.Tensor:
+    """Dequantizes [..., in] (or packed [..., in // 2]) rows with their [...] / [..., G] scalers."""
+    dtype = dtype or weight_scaler.dtype
+    q = unpack_int4(weight) if bits == 4 else weight
+    if group_size == 0:
+        return q.to(dtype) * weight_scaler.to(dtype).unsqueeze(-1)
+    shape = q.shape
+    q = q.view(*shape[:-1], -1, group_size).to(dtype)
+    return (q * weight_scaler.to(dtype).unsqueeze(-1)).view(shape)
+
+
+def quantized_linear(
+    x: torch.Tensor,
+    weight: torch.Tensor,
+    weight_scaler: torch.Tensor,
+    bits: int = 8,
+    group_size: int = 0,
+    out_chunk_size: int = 4096,
+    ) -> torch.Tensor:
+    """
+    CPU kernel path: out_features를 타일 단위로 역양자화하여 F.linear를 수행한다.
+    전체 weight의 float 사본 대신 out_chunk_size 행만큼의 임시 텐서만 사용한다.
+    """
+    out_features = weight.shape[0]
+    if out_features <= out_chunk_size:
+        return F.linear(x, dequantize_weight(weight, weight_scaler, bits, group_size, x.dtype))
+    output = x.new_empty((*x.shape[:-1], out_features))
+    for start in range(0, out_features, out_chunk_size):
+        end = min(start + out_chunk_size, out_features)
+        w = dequantize_weight(weight[start:end], weight_scaler[start:end], bits, group_size, x.dtype)
+        output[..., start:end] = F.linear(x, w)
+    return output
+
+
+def quantize_tensor(
+    key: str,
+    tensor: torch.Tensor,
+    bits: int = 8,
+    group_size: int = 0,
+    clip_ratios: Sequence[float] = DEFAULT_CLIP_RATIOS,
+    ) -> Dict[str, torch.Tensor]:
+    """Quantizes one state dict entry: {key: weight, *.weight_scaler: scaler} if it is a Linear / Embedding weight."""
+    if QUANT_WEIGHT_PATTERN.match(key) is None:
+        return {key: tensor}
+    qweight, scaler = quantize_weight(tensor, bits, group_size, clip_ratios)
+    return {key: qweight, key[:-len(".weight")] + ".weight_scaler": scaler}
+
+
+def quantize_state_dict(
+    state_dict: Dict[str, torch.Tensor],
+    bits: int = 8,
+    group_size: int = 0,
+    clip_ratios: Sequence[float] = DEFAULT_CLIP_RATIOS,
+    ) -> Dict[str, torch.Tensor]:
+    """Quantizes every Linear / Embedding weight of a Gemma state dict for load_weights."""
+    quant_state_dict = {}
+    for key, tensor in state_dict.items():
+        quant_state_dict.update(quantize_tensor(key, tensor, bits, group_size, clip_ratios))
+    return quant_state_dict
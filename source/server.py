@@ -0,0 +1,412 @@
+# Local HTTP inference server with a bounded request queue and micro-batching.
+import json
+import math
+import time
+import queue
+import threading
+import dataclasses
+from http.server import (
+    BaseHTTPRequestHandler,
+    ThreadingHTTPServer
+    )
+from typing import (
+    Any,
+    Iterator,
+    List,
+    Optional,
+    Tuple
+    )
+from source.gemma_torch import GenerationSession
+
+
+@dataclasses.dataclass
+class GenerationRequest:
+    # 토크나이징된 프롬프트
+    prompt_tokens: List[int]
+    # 이 요청이 생성할 최대 토큰 수
+    max_tokens: int = 100
+    # 샘플링 파라미터 (temperature가 None 또는 0이면 greedy)
+    temperature: Optional[float] = 0.95
+    top_p: float = 1.0
+    top_k: int = 100
+    repetition_penalty: float = 1.0
+    frequency_penalty: float = 0.0
+    presence_penalty: float = 0.0
+    seed: Optional[int] = None
+    # load_adapter로 로드한 LoRA adapter 이름 (None이면 base 모델), 같은 배치의 요청마다 달라도 된다.
+    adapter: Optional[str] = None
+    # EOS 외에 생성을 멈출 토큰 (채팅이면 <end_of_turn>)
+    stop_token_ids: Tuple[int, ...] = ()
+    # 클라이언트 연결이 끊긴 요청 (cancel): 스케줄러가 다음 스텝에서 이 행을 버린다.
+    cancelled: bool = False
+    # 스케줄러 -> HTTP 핸들러: 생성된 토큰 아이디, 끝나면 None, 실패하면 Exception
+    tokens: queue.Queue = dataclasses.field(default_factory=queue.Queue)
+    arrival_time: float = dataclasses.field(default_factory=time.time)
+
+
+@dataclasses.dataclass
+class ActiveBatch:
+    # 스케줄러가 진행 중인 배치: 요청, generate_stream 제너레이터, 요청별 남은 토큰 수, 배치가 쓰는 GenerationSession
+    requests: List[GenerationRequest]
+    stream: Iterator[List[Optional[int]]]
+    remaining: List[int]
+    session: Any = None
+
+
+class BatchScheduler:
+    def __init__(self,
+        model: Any,
+        device: Any,
+        max_batch_size: int = 8,
+        max_queue_size: int = 64,
+        batch_wait_ms: float = 10.0,
+        max_active_batches: int = 1,
+        ):
+        """
+        1. 요청은 크기가 max_queue_size인 큐에 쌓이고, 큐가 가득 차면 submit이 False를 반환 (backpressure)
+        2. 스케줄러 스레드는 첫 요청이 온 뒤 batch_wait_ms 동안 최대 max_batch_size개의 요청을 모은다.
+           가장 긴 프롬프트 + 가장 큰 max_tokens가 max_position_embeddings를 넘게 하는 요청은 다음 배치로 미룬다.
+        3. 모은 요청은 generate_stream 한 번으로 같은 forward에서 배치 추론한다.
+        4. 최대 max_active_batches개의 배치를 동시에 진행하며 한 스텝씩 번갈아 실행한다.
+           config.prefill_chunk_size와 함께 쓰면 긴 프롬프트의 prefill chunk 사이에 다른 배치의 디코딩이 끼어든다.
+        """
+        self.model          = model
+        self.device         = device
+        self.max_batch_size = max_batch_size
+        self.batch_wait_ms  = batch_wait_ms
+        self.max_active_batches = max_active_batches
+        self.queue          = queue.Queue(maxsize=max_queue_size)
+        # 진행 중인 배치마다 하나씩, 끝난 배치의 GenerationSession은 다음 배치가 재사용한다.
+        self.sessions       = []
+        # 배치에 넣으면 max_position_embeddings를 넘어서 다음 배치로 미룬 요청 (도착 순서)
+        self.deferred: List[GenerationRequest] = []
+        self._thread        = threading.Thread(target=self._loop, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def submit(self, request: GenerationRequest) -> bool:
+        try:
+            self.queue.put_nowait(request)
+        except queue.Full:
+            return False
+        return True
+
+    def qsize(self) -> int:
+        return self.queue.qsize() + len(self.deferred)
+
+    def cancel(self, request: GenerationRequest):
+        """Stops generating for a request whose client went away (it gets no more tokens)."""
+        request.cancelled = True
+
+    def health(self) -> dict:
+        """The /health body: status is "down" once the scheduler thread has stopped."""
+        return {"status": "ok" if self._thread.is_alive() else "down"}
+
+    def _next_batch(self, block: bool = True) -> List[GenerationRequest]:
+        # block이 False이면 기다리지 않고 이미 대기 중인 요청만 모은다 (없으면 빈 리스트).
+        try:
+            batch = [self.queue.get(block=block)]
+        except queue.Empty:
+            return []
+        deadline = time.time() + (self.batch_wait_ms / 1000 if block else 0)
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            try:
+                batch.append(self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        active: List[ActiveBatch] = []
+        while True:
+            # 진행 중인 배치가 없으면 요청을 기다리고, 있으면 대기 중인 요청만 새 배치로 받는다.
+            if len(active) < self.max_active_batches:
+                pending = self.deferred
+                if len(pending) < self.max_batch_size:
+                    pending = pending + self._next_batch(block=not active and not pending)
+                batch = self._admit(pending)
+                if batch:
+                    active.append(self._start_batch(batch))
+            for state in list(active):
+                try:
+                    done = self._step_batch(state)
+                except Exception as e:
+                    done = True
+                    for request, remaining in zip(state.requests, state.remaining):
+                        if remaining > 0:
+                            request.tokens.put(e)
+                if done:
+                    active.remove(state)
+                    self.sessions.append(state.session)
+
+    def _admit(self, pending: List[GenerationRequest]) -> List[GenerationRequest]:
+        """
+        Takes requests in arrival order while the batch fits and defers the rest to the next batch.
+        generate_stream은 가장 긴 프롬프트 + 가장 큰 max_tokens만큼의 KV 캐시를 쓰므로, 요청마다는 맞아도
+        (긴 프롬프트 하나, 큰 max_tokens 하나) 합치면 max_position_embeddings를 넘을 수 있다.
+        """
+        max_seq_len = self.model.config.max_position_embeddings
+        batch, deferred = [], []
+        max_prompt_len, max_tokens = 0, 0
+        for request in pending:
+            if request.cancelled:
+                request.tokens.put(None)
+                continue
+            prompt_len = max(max_prompt_len, len(request.prompt_tokens))
+            tokens     = max(max_tokens, request.max_tokens)
+            # 첫 요청은 혼자서도 맞지 않더라도 받는다 (그 요청만 실패하고 큐가 막히지 않는다).
+            if len(batch) < self.max_batch_size and (not batch or prompt_len + tokens <= max_seq_len):
+                batch.append(request)
+                max_prompt_len, max_tokens = prompt_len, tokens
+            else:
+                deferred.append(request)
+        self.deferred = deferred
+        return batch
+
+    def _start_batch(self, batch: List[GenerationRequest]) -> ActiveBatch:
+        metrics = getattr(self.model, "metrics", None)
+        if metrics is not None:
+            now = time.time()
+            for request in batch:
+                metrics.queue_wait.observe(now - request.arrival_time)
+        remaining = [request.max_tokens for request in batch]
+        seeds     = [request.seed for request in batch]
+        adapters  = [request.adapter for request in batch]
+        session   = self.sessions.pop() if self.sessions else GenerationSession(self.model.config)
+        stream    = self.model.generate_stream(
+            [request.prompt_tokens for request in batch],
+            self.device,
+            output_len=max(remaining),
+            temperature=[request.temperature for request in batch],
+            top_p=[request.top_p for request in batch],
+            top_k=[request.top_k for request in batch],
+            repetition_penalty=[request.repetition_penalty for request in batch],
+            frequency_penalty=[request.frequency_penalty for request in batch],
+            presence_penalty=[request.presence_penalty for request in batch],
+            seed=None if all(seed is None for seed in seeds) else seeds,
+            session=session,
+            adapter=None if all(adapter is None for adapter in adapters) else adapters,
+            stop_token_ids=[request.stop_token_ids for request in batch],
+            max_tokens=list(remaining),
+            )
+        return ActiveBatch(requests=batch, stream=stream, remaining=remaining, session=session)
+
+    def _step_batch(self, state: ActiveBatch) -> bool:
+        # generate_stream의 한 스텝 (prefill chunk 또는 디코딩)을 실행하고, 배치가 끝났으면 True
+        eos_id, remaining = self.model.eos_id, state.remaining
+        step_tokens = next(state.stream, None)
+        if step_tokens is not None:
+            for i, (request, token) in enumerate(zip(state.requests, step_tokens)):
+                if request.cancelled and remaining[i] > 0:
+                    remaining[i] = 0
+                    request.tokens.put(None)
+                if token is None or remaining[i] == 0:
+                    continue
+                if token == eos_id or token in request.stop_token_ids:
+                    remaining[i] = 0
+                    request.tokens.put(None)
+                    continue
+                request.tokens.put(token)
+                remaining[i] -= 1
+                if remaining[i] == 0:
+                    request.tokens.put(None)
+        # 모든 요청이 끝나면 남은 스텝을 돌리지 않는다.
+        if step_tokens is not None and any(remaining):
+            return False
+        state.stream.close()
+        for i, request in enumerate(state.requests):
+            if remaining[i] > 0:
+                remaining[i] = 0
+                request.tokens.put(None)
+        return True
+
+
+def _number(body: dict, name: str, cast, valid, expected: str, default=None):
+    # body[name]을 cast (float / int)하고 범위를 확인한다. 실패하면 ValueError (400)
+    try:
+        value = cast(body.get(name, default))
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError(f"{name} must be {expected}") from None
+    if isinstance(body.get(name), bool) or (cast is float and not math.isfinite(value)) or not valid(value):
+        raise ValueError(f"{name} must be {expected}")
+    return value
+
+
+INT64_MIN, INT64_MAX = -2**63, 2**63 - 1
+
+
+def _integer(body: dict, name: str, valid, expected: str, default=None) -> int:
+    # body[name]이 int64 범위의 정수인지 확인한다 (2.0은 허용, 2.7과 bool은 거절). 실패하면 ValueError (400)
+    value = body.get(name, default)
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if not isinstance(value, int) or isinstance(value, bool) or not INT64_MIN <= value <= INT64_MAX or not valid(value):
+        raise ValueError(f"{name} must be {expected}")
+    return value
+
+
+class GemmaHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, scheduler: Any, verbose: bool = False):
+        # scheduler: BatchScheduler 또는 source.worker_pool.WorkerPool (submit, qsize, cancel, health, model)
+        super().__init__(address, GemmaRequestHandler)
+        self.scheduler = scheduler
+        self.verbose   = verbose
+
+
+class GemmaRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET  /health   -> scheduler.health() + {"queue_size": ...}, status가 "down"이면 503
+    GET  /metrics  -> model.metrics (GenerationMetrics)를 Prometheus text format으로
+    POST /generate -> {"prompt": str} 또는 {"messages": [{"role", "content"}, ...]}
+                      + max_tokens, temperature, top_p, top_k, repetition_penalty, frequency_penalty,
+                        presence_penalty, seed, adapter, stream
+    stream이 true이면 text/event-stream(SSE)으로 토큰마다 {"text": delta}를 보내고 [DONE]으로 끝난다.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status: int, body: dict):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self._metrics()
+            return
+        if self.path != "/health":
+            self._send_json(404, {"error": "not found"})
+            return
+        health = self.server.scheduler.health()
+        health["queue_size"] = self.server.scheduler.qsize()
+        self._send_json(503 if health["status"] == "down" else 200, health)
+
+    def _metrics(self):
+        metrics = getattr(self.server.scheduler.model, "metrics", None)
+        if metrics is None:
+            self._send_json(404, {"error": "metrics are disabled"})
+            return
+        metrics.queue_depth.set(self.server.scheduler.qsize())
+        data = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self.path != "/generate":
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            body    = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            request = self._parse_request(body)
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        if not self.server.scheduler.submit(request):
+            self._send_json(503, {"error": "request queue is full"})
+            return
+        if body.get("stream", False):
+            self._stream(request)
+        else:
+            self._complete(request)
+
+    def _parse_request(self, body: dict) -> GenerationRequest:
+        model = self.server.scheduler.model
+        stop_token_ids = ()
+        if "messages" in body:
+            prompt_tokens  = model.chat_template.encode(body["messages"])
+            stop_token_ids = (model.chat_template.end_of_turn_id,)
+        else:
+            prompt_tokens  = model.tokenizer.encode(str(body["prompt"]))
+        max_tokens = _integer(body, "max_tokens", lambda v: v >= 1, "an integer >= 1", 100)
+        if len(prompt_tokens) + max_tokens > model.config.max_position_embeddings:
+            raise ValueError(f"invalid max_tokens {max_tokens}")
+        adapter = body.get("adapter")
+        lora    = getattr(model, "lora", None)
+        if adapter is not None and (lora is None or adapter not in lora.ids):
+            raise ValueError(f"unknown adapter {adapter}")
+        # 배치의 요청들은 generate_stream 한 번을 공유하므로, 잘못된 값이 다른 요청까지 실패시키지 않도록 여기서 거른다.
+        temperature = body.get("temperature", 0.95)
+        if temperature is not None:
+            temperature = _number(body, "temperature", float, lambda v: v >= 0, "a number >= 0", 0.95)
+        seed = body.get("seed")
+        if seed is not None:
+            seed = _integer(body, "seed", lambda v: v >= 0, "an integer in [0, 2^63)")
+        # top_k는 vocab_size보다 클 필요가 없다 (int64 텐서에 들어가도록 자른다).
+        top_k = min(_integer(body, "top_k", lambda v: v >= 1, "an integer >= 1", 100), model.config.vocab_size)
+        return GenerationRequest(
+            prompt_tokens=prompt_tokens,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=_number(body, "top_p", float, lambda v: 0 < v <= 1, "a number in (0, 1]", 1.0),
+            top_k=top_k,
+            repetition_penalty=_number(body, "repetition_penalty", float, lambda v: v > 0, "a number > 0", 1.0),
+            frequency_penalty=_number(body, "frequency_penalty", float, lambda v: True, "a number", 0.0),
+            presence_penalty=_number(body, "presence_penalty", float, lambda v: True, "a number", 0.0),
+            seed=seed,
+            adapter=adapter,
+            stop_token_ids=stop_token_ids,
+            )
+
+    def _tokens(self, request: GenerationRequest):
+        while True:
+            token = request.tokens.get()
+            if token is None:
+                return
+            if isinstance(token, Exception):
+                raise token
+            yield token
+
+    def _complete(self, request: GenerationRequest):
+        try:
+            tokens = list(self._tokens(request))
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+            return
+        self._send_json(200, {
+            "text": self.server.scheduler.model.tokenizer.decode(tokens),
+            "num_tokens": len(tokens),
+            })
+
+    def _stream(self, request: GenerationRequest):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        # SentencePiece는 앞뒤 토큰에 따라 공백이 달라지므로 전체를 디코딩하여 새로 늘어난 부분만 보낸다.
+        tokenizer = self.server.scheduler.model.tokenizer
+        tokens, text = [], ""
+        try:
+            for token in self._tokens(request):
+                tokens.append(token)
+                new_text = tokenizer.decode(tokens)
+                self._send_event({"text": new_text[len(text):], "num_tokens": len(tokens)})
+                text = new_text
+            self._send_event("[DONE]")
+        except (BrokenPipeError, ConnectionResetError):
+            # 클라이언트가 연결을 끊었다: 닫힌 소켓에 다시 쓰지 않고, 스케줄러가 남은 토큰을 생성하지 않게 한다.
+            self.server.scheduler.cancel(request)
+        except Exception as e:
+            # 생성 실패 (스케줄러가 보낸 Exception)
+            self._send_event({"error": str(e)})
+
+    def _send_event(self, data):
+        payload = data if isinstance(data, str) else json.dumps(data)
+        self.wfile.write(f"data: {payload}\n\n".encode("utf-8"))
+        self.wfile.flush()
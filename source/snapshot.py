@@ -0,0 +1,112 @@
+# Pre-packed weight snapshot: 런타임 레이아웃 (config.dtype, 양자화 packing) 그대로의 텐서를 정렬된 하나의 파일에 쓰고,
+# mmap으로 파싱이나 복사 없이 로드한다.
+#   model.pack       텐서 데이터만, 각 텐서는 alignment byte 경계에서 시작
+#   model.pack.json  manifest: 이름마다 dtype, shape, offset, nbytes와 metadata
+import os
+import math
+import mmap
+import json
+from typing import (
+    Any,
+    Dict,
+    Optional,
+    Tuple
+    )
+
+import torch
+
+
+SNAPSHOT_VERSION   = 1
+SNAPSHOT_ALIGNMENT = 64
+
+
+def manifest_path(path: str) -> str:
+    return path + ".json"
+
+
+def is_snapshot(path: str) -> bool:
+    """Whether path is a snapshot data file written by write_snapshot (a manifest sits next to it)."""
+    return os.path.isfile(path) and os.path.isfile(manifest_path(path))
+
+
+def write_snapshot(
+    tensors: Dict[str, torch.Tensor],
+    path: str,
+    metadata: Optional[Dict[str, Any]] = None,
+    alignment: int = SNAPSHOT_ALIGNMENT,
+    ) -> int:
+    """
+    Writes the tensors as they are (no dtype conversion) and returns the data size in bytes.
+    1. 기존 snapshot을 덮어쓸 때는 먼저 manifest를 지우므로, 쓰는 도중에는 이전 manifest가 새 데이터를 가리키지 않는다.
+    2. 데이터와 manifest는 임시 파일에 쓴 뒤 os.replace (데이터 먼저)로 바꾸므로, 중간에 실패하면 snapshot이 없고
+       이전 파일을 mmap한 프로세스는 바뀌지 않은 (unlink된) 이전 데이터를 계속 읽는다.
+    """
+    if os.path.exists(manifest_path(path)):
+        os.remove(manifest_path(path))
+    data_tmp     = path + ".tmp"
+    manifest_tmp = manifest_path(path) + ".tmp"
+    entries = {}
+    offset  = 0
+    try:
+        with open(data_tmp, "wb") as f:
+            for name, tensor in tensors.items():
+                tensor  = tensor.detach().cpu().contiguous()
+                padding = -offset % alignment
+                f.write(b"\0" * padding)
+                offset += padding
+                nbytes  = tensor.numel() * tensor.element_size()
+                if nbytes:
+                    f.write(tensor.reshape(-1).view(torch.uint8).numpy())
+                entries[name] = {
+                    "dtype": str(tensor.dtype).replace("torch.", ""),
+                    "shape": list(tensor.shape),
+                    "offset": offset,
+                    "nbytes": nbytes,
+                    }
+                offset += nbytes
+        manifest = {
+            "version": SNAPSHOT_VERSION,
+            "alignment": alignment,
+            "metadata": metadata or {},
+            "tensors": entries,
+            }
+        with open(manifest_tmp, "w") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(data_tmp, path)
+        os.replace(manifest_tmp, manifest_path(path))
+    finally:
+        for tmp in (data_tmp, manifest_tmp):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    return offset
+
+
+def read_snapshot(path: str) -> Tuple[Dict[str, torch.Tensor], Dict[str, Any]]:
+    """
+    Maps a snapshot and returns (tensors, manifest); the tensors are views of the mapping.
+    1. MAP_PRIVATE (ACCESS_COPY): torch.frombuffer에 쓰기 가능한 버퍼를 주되, 텐서에 쓰더라도 파일은 바뀌지 않는다.
+    2. 페이지는 처음 접근할 때 page cache에서 읽히며, 같은 파일을 연 프로세스들은 page cache를 공유한다.
+    """
+    with open(manifest_path(path), "r") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(f"{path}: snapshot version {manifest.get('version')}, expected {SNAPSHOT_VERSION}")
+    entries = manifest["tensors"]
+    size    = max((entry["offset"] + entry["nbytes"] for entry in entries.values()), default=0)
+    if os.path.getsize(path) < size:
+        raise ValueError(f"{path}: truncated snapshot ({os.path.getsize(path)} < {size} bytes)")
+
+    tensors = {}
+    buffer  = None
+    if size:
+        with open(path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    for name, entry in entries.items():
+        dtype = getattr(torch, entry["dtype"])
+        numel = math.prod(entry["shape"])
+        if numel == 0:
+            tensors[name] = torch.empty(entry["shape"], dtype=dtype)
+            continue
+        # frombuffer는 mmap의 참조를 가지므로 텐서가 남아있는 동안 매핑이 유지된다.
+        tensors[name] = torch.frombuffer(buffer, dtype=dtype, count=numel, offset=entry["offset"]).view(entry["shape"])
+    return tensors, manifest
@@ -0,0 +1,180 @@
+# Tensor-parallel CPU inference across local processes (torch.distributed, gloo backend).
+import os
+import re
+import dataclasses
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Optional,
+    Tuple
+    )
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import safetensors
+from source.config import GemmaConfig, get_weight_paths
+from source.gemma_torch import GemmaForCausalLM
+
+
+# 레이어 weight 이름 -> (분할 축, 분할 범위 종류)
+# q / k / v, gate / up은 출력(행)을, o / down은 입력(열)을 나누고 all-reduce로 합친다.
+SHARD_RULES = {
+    "q_proj": (0, "heads"),
+    "k_proj": (0, "kv_heads"),
+    "v_proj": (0, "kv_heads"),
+    "o_proj": (1, "heads"),
+    "gate_proj": (0, "intermediate"),
+    "up_proj": (0, "intermediate"),
+    "down_proj": (1, "intermediate"),
+    }
+SHARD_WEIGHT_PATTERN = re.compile(r".*\.(" + "|".join(SHARD_RULES) + r")\.(weight|weight_scaler)$")
+
+
+def get_shard_ranges(config: GemmaConfig, rank: int, world_size: int) -> Dict[str, Tuple[int, int]]:
+    """
+    Returns the [start, end) feature ranges owned by this rank.
+    1. query head는 rank마다 num_attention_heads / world_size개
+    2. kv head는 rank의 query head가 참조하는 것만 가진다.
+       2b처럼 kv head가 rank 수보다 적으면 (MQA) 같은 kv head를 여러 rank가 복제해서 가진다.
+    3. MLP intermediate 차원은 intermediate_size / world_size씩
+    """
+    num_heads, num_kv_heads = config.num_attention_heads, config.num_key_value_heads
+    if num_heads % world_size != 0 or config.intermediate_size % world_size != 0:
+        raise ValueError(f'world_size {world_size} must divide num_attention_heads {num_heads} '
+                         f'and intermediate_size {config.intermediate_size}')
+    local_heads     = num_heads // world_size
+    queries_per_kv  = num_heads // num_kv_heads
+    if local_heads % queries_per_kv != 0 and queries_per_kv % local_heads != 0:
+        raise ValueError(f'world_size {world_size} splits query heads across kv head groups')
+    head_start      = rank * local_heads
+    kv_start        = head_start // queries_per_kv
+    kv_end          = (head_start + local_heads - 1) // queries_per_kv + 1
+    local_mlp       = config.intermediate_size // world_size
+    head_dim        = config.head_dim
+    return {
+        "heads": (head_start * head_dim, (head_start + local_heads) * head_dim),
+        "kv_heads": (kv_start * head_dim, kv_end * head_dim),
+        "intermediate": (rank * local_mlp, (rank + 1) * local_mlp),
+        }
+
+
+def get_local_config(config: GemmaConfig, rank: int, world_size: int) -> GemmaConfig:
+    """Returns a config copy with this rank's head and intermediate sizes (so KV caches are local too)."""
+    ranges = get_shard_ranges(config, rank, world_size)
+    return dataclasses.replace(
+        config,
+        num_attention_heads=config.num_attention_heads // world_size,
+        num_key_value_heads=(ranges["kv_heads"][1] - ranges["kv_heads"][0]) // config.head_dim,
+        intermediate_size=config.intermediate_size // world_size,
+        )
+
+
+def shard_tensor(key: str, tensor: Any, config: GemmaConfig, ranges: Dict[str, Tuple[int, int]]) -> torch.Tensor:
+    """
+    Slices one state-dict entry for this rank. tensor는 torch.Tensor 또는 safetensors의 get_slice 결과
+    1. 행 분할: weight와 weight_scaler의 행을 같이 자른다.
+    2. 열 분할: int4 packing이면 열 범위를 1/2로, 그룹 weight_scaler는 group_size로 나눈다.
+       per-row weight_scaler([out])는 열 분할에서 그대로 둔다.
+    """
+    match = SHARD_WEIGHT_PATTERN.match(key)
+    if match is None:
+        return tensor[:]
+    dim, kind  = SHARD_RULES[match.group(1)]
+    start, end = ranges[kind]
+    is_scaler  = match.group(2) == "weight_scaler"
+    if dim == 0:
+        return tensor[start:end]
+    if is_scaler:
+        if len(tensor.get_shape() if hasattr(tensor, "get_shape") else tensor.shape) == 1:
+            return tensor[:]
+        group_size = config.quant_group_size
+        if start % group_size != 0 or end % group_size != 0:
+            raise ValueError(f'quant_group_size {group_size} does not align with shard [{start}, {end})')
+        return tensor[:, start // group_size:end // group_size]
+    if config.quant and config.quant_bits == 4:
+        return tensor[:, start // 2:end // 2]
+    return tensor[:, start:end]
+
+
+def load_sharded_weights(model: GemmaForCausalLM, model_path: str, config: GemmaConfig, rank: int, world_size: int):
+    """
+    load_weights와 같은 파일을 읽되 safetensors의 get_slice로 이 rank의 조각만 읽는다.
+    rank마다 전체 weight를 메모리에 올리지 않는다.
+    """
+    ranges = get_shard_ranges(config, rank, world_size)
+    model_paths = get_weight_paths(model_path)
+    safe_tensors = {}
+    for path in model_paths:
+        with safetensors.safe_open(path, framework="pt") as model_file:
+            for key in model_file.keys():
+                if key in safe_tensors:
+                    continue
+                tensor = shard_tensor(key, model_file.get_slice(key), config, ranges)
+                if tensor.is_floating_point():
+                    tensor = tensor.type(config.get_dtype())
+                safe_tensors[key] = tensor
+    model.load_state_dict(safe_tensors, strict=False)
+
+
+def shard_state_dict(state_dict: Dict[str, torch.Tensor], config: GemmaConfig, rank: int, world_size: int):
+    """Slices an in-memory full state dict (e.g. GemmaForCausalLM.state_dict()) for this rank."""
+    ranges = get_shard_ranges(config, rank, world_size)
+    return {key: shard_tensor(key, tensor, config, ranges).clone() for key, tensor in state_dict.items()}
+
+
+def _all_reduce_hook(module, inputs, output):
+    # rank마다 입력 차원의 일부로 계산한 partial sum을 합친다.
+    dist.all_reduce(output)
+    return output
+
+
+def add_all_reduce_hooks(model: GemmaForCausalLM):
+    """Registers the only communication of a layer: all-reduce after o_proj and down_proj."""
+    handles = []
+    for layer in model.model.layers:
+        handles.append(layer.self_attn.o_proj.register_forward_hook(_all_reduce_hook))
+        handles.append(layer.mlp.down_proj.register_forward_hook(_all_reduce_hook))
+    return handles
+
+
+def build_tensor_parallel_model(
+    config: GemmaConfig,
+    rank: int,
+    world_size: int,
+    model_path: Optional[str] = None,
+    ) -> GemmaForCausalLM:
+    """
+    Builds this rank's shard of GemmaForCausalLM (init_process_group must be called first).
+    임베딩, RMSNorm, Sampler는 모든 rank에 복제되어 같은 토큰을 고른다.
+    샘플링하는 경우 모든 rank가 같은 seed를 사용해야 한다.
+    """
+    local_config = get_local_config(config, rank, world_size)
+    model = GemmaForCausalLM(local_config)
+    if model_path is not None:
+        load_sharded_weights(model, model_path, config, rank, world_size)
+    if world_size > 1:
+        add_all_reduce_hooks(model)
+    return model.eval()
+
+
+def _worker(rank: int, world_size: int, port: int, num_threads: Optional[int], fn: Callable, args: tuple):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    try:
+        fn(rank, world_size, *args)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(fn: Callable, world_size: int, args: tuple = (), port: int = 29500, num_threads: Optional[int] = None):
+    """
+    Spawns world_size local processes and runs fn(rank, world_size, *args) in each of them.
+    num_threads가 None이면 코어를 rank 수로 나누어 intra-op 스레드 수를 정한다.
+    """
+    if num_threads is None:
+        num_threads = max(1, len(os.sched_getaffinity(0)) // world_size)
+    mp.spawn(_worker, args=(world_size, port, num_threads, fn, args), nprocs=world_size, join=True)
@@ -12,18 +12,25 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import os
+import functools
 from typing import (
     List, 
-    Optional
+    Optional,
+    Sequence,
+    Tuple
     )
 from sentencepiece import SentencePieceProcessor
 
 
 class Tokenizer:
-    def __init__(self, model_path: Optional[str]):
+    def __init__(self, model_path: Optional[str], num_threads: int = -1, prefix_cache_size: int = 1024):
         # Reload tokenizer.
         assert os.path.isfile(model_path), model_path
         self.sp_model = SentencePieceProcessor(model_file=model_path)
+        # encode_batch / decode_batch의 SentencePiece 스레드 수 (-1이면 모든 코어)
+        self.num_threads = num_threads
+        # 시스템 프롬프트, 채팅 템플릿처럼 반복되는 prefix의 인코딩 결과를 LRU로 캐시
+        self._encode_prefix = functools.lru_cache(maxsize=prefix_cache_size)(self._encode_prefix_uncached)
 
         # BOS / EOS token IDs.
         self.n_words: int = self.sp_model.vocab_size()
@@ -44,4 +51,36 @@ class Tokenizer:
 
     def decode(self, t: List[int]) -> str:
         """Converts a list of tokens into a string."""
-        return self.sp_model.decode(t)
\ No newline at end of file
+        return self.sp_model.decode(t)
+
+    def encode_batch(self,
+        texts: Sequence[str],
+        bos: bool = True,
+        eos: bool = False,
+        prefix: Optional[str] = None,
+        ) -> List[List[int]]:
+        """
+        Converts a batch of strings into lists of tokens with SentencePiece's threaded encoder.
+        prefix가 주어지면 캐시된 prefix 토큰 뒤에 각 문자열의 토큰을 붙인다.
+        """
+        texts = list(texts)
+        if prefix is None:
+            return self.sp_model.encode(texts, add_bos=bos, add_eos=eos, num_threads=self.num_threads)
+        prefix_tokens = list(self.encode_prefix(prefix, bos=bos))
+        batch = self.sp_model.encode(texts, add_eos=eos, num_threads=self.num_threads)
+        return [prefix_tokens + t for t in batch]
+
+    def decode_batch(self, batch: Sequence[List[int]]) -> List[str]:
+        """Converts a batch of token lists into strings with SentencePiece's threaded decoder."""
+        return self.sp_model.decode([list(t) for t in batch], num_threads=self.num_threads)
+
+    def encode_prefix(self, prefix: str, bos: bool = True) -> Tuple[int, ...]:
+        """
+        Returns the cached tokens of a shared prefix (system prompt, chat template).
+        prefix와 뒤의 문자열을 따로 토크나이징하므로, prefix는 토큰 경계(줄바꿈, 제어 토큰 등)에서 끝나야
+        한 번에 토크나이징한 결과와 같다.
+        """
+        return self._encode_prefix(prefix, bos)
+
+    def _encode_prefix_uncached(self, prefix: str, bos: bool) -> Tuple[int, ...]:
+        return tuple(self.encode(prefix, bos=bos))
\ No newline at end of file
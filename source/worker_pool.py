@@ -0,0 +1,216 @@
+# Multi-process data-parallel serving over one shared copy of the weights.
+import os
+import queue
+import random
+import itertools
+import threading
+import dataclasses
+from typing import (
+    Any,
+    List,
+    Optional
+    )
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from source.server import (
+    BatchScheduler,
+    GenerationRequest
+    )
+
+
+# 라우터가 토큰을 기다리다가 워커가 살아있는지 확인하는 주기 (초)
+WORKER_CHECK_SECONDS = 0.5
+
+
+def split_cores(num_workers: int, cores: Optional[List[int]] = None) -> List[List[int]]:
+    """Splits the available cores into contiguous subsets, one per worker."""
+    cores = sorted(os.sched_getaffinity(0)) if cores is None else list(cores)
+    if num_workers >= len(cores):
+        return [[cores[i % len(cores)]] for i in range(num_workers)]
+    chunk = len(cores) // num_workers
+    return [cores[i * chunk:(i + 1) * chunk] for i in range(num_workers)]
+
+
+class _TokenSink:
+    # 워커의 GenerationRequest.tokens 대신 사용: 토큰을 (request_id, token)으로 부모 프로세스에 보낸다.
+    def __init__(self, outbox, request_id: int):
+        self.outbox     = outbox
+        self.request_id = request_id
+
+    def put(self, token):
+        self.outbox.put((self.request_id, token))
+
+
+class _WorkerScheduler(BatchScheduler):
+    def __init__(self, model, device, inbox, outbox, cancels, max_batch_size: int, batch_wait_ms: float,
+                 max_active_batches: int):
+        super().__init__(model, device, max_batch_size=max_batch_size, batch_wait_ms=batch_wait_ms,
+                         max_active_batches=max_active_batches)
+        self.queue   = inbox
+        self.outbox  = outbox
+        # 부모 프로세스가 보낸 취소된 request_id, 해당 요청을 만나면 cancelled로 표시하고 지운다.
+        self.cancels = cancels
+        self.cancelled_ids = set()
+
+    def _mark_cancelled(self, requests: List[GenerationRequest]):
+        while True:
+            try:
+                self.cancelled_ids.add(self.cancels.get_nowait())
+            except queue.Empty:
+                break
+        for request in requests:
+            if request.tokens.request_id in self.cancelled_ids:
+                self.cancelled_ids.discard(request.tokens.request_id)
+                request.cancelled = True
+
+    def _next_batch(self, block: bool = True) -> List[GenerationRequest]:
+        # inbox에는 (request_id, tokens가 없는 GenerationRequest)가 들어온다.
+        batch = []
+        for request_id, request in super()._next_batch(block):
+            request.tokens = _TokenSink(self.outbox, request_id)
+            batch.append(request)
+        self._mark_cancelled(batch)
+        return batch
+
+    def _step_batch(self, state) -> bool:
+        self._mark_cancelled(state.requests)
+        return super()._step_batch(state)
+
+
+def _worker_main(model, device, seed, cores, num_threads, inbox, outbox, cancels, max_batch_size, batch_wait_ms,
+                 max_active_batches):
+    # fork한 워커는 부모의 RNG 상태를 그대로 물려받으므로, seed가 없는 샘플링 요청이 워커마다 같은 결과를 내지 않게 다시 seed한다.
+    random.seed(seed)
+    np.random.seed(seed % 2**32)
+    torch.manual_seed(seed)
+    # 워커마다 코어 subset에 고정하고 intra-op 스레드 수를 맞춘다.
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(num_threads or len(cores))
+    _WorkerScheduler(model, device, inbox, outbox, cancels, max_batch_size, batch_wait_ms, max_active_batches)._loop()
+
+
+class WorkerPool:
+    def __init__(self,
+        model: Any,
+        device: Any,
+        num_workers: int,
+        threads_per_worker: Optional[int] = None,
+        cores: Optional[List[int]] = None,
+        max_batch_size: int = 8,
+        max_queue_size: int = 64,
+        batch_wait_ms: float = 10.0,
+        max_active_batches: int = 1,
+        seed: Optional[int] = None,
+        ):
+        """
+        1. 부모 프로세스에서 한 번 로드한 weight를 share_memory()로 공유 메모리에 올린다.
+        2. fork한 num_workers개의 워커가 같은 weight를 복사 없이 사용하고, 워커마다 코어 subset에 고정된다.
+        3. 라우터는 진행 중인 요청이 가장 적은 워커에 요청을 보내고, 워커가 보낸 토큰을 요청에 전달한다.
+           죽은 워커는 라우팅에서 빼고, 그 워커에 보낸 요청은 예외로 끝낸다 (다시 fork하지 않는다).
+        4. 워커 i의 RNG는 seed + i로 초기화한다 (seed가 None이면 OS 난수).
+        BatchScheduler와 같은 submit / qsize / cancel / model 인터페이스를 가지므로 GemmaHTTPServer에서 그대로 사용한다.
+        """
+        self.model          = model.share_memory()
+        self.max_queue_size = max_queue_size
+        context             = mp.get_context("fork")
+        self.outbox         = context.Queue()
+        self.inboxes        = [context.Queue() for _ in range(num_workers)]
+        self.cancels        = [context.Queue() for _ in range(num_workers)]
+        self.in_flight      = [0] * num_workers
+        self.dead           = set()
+        self.pending        = {}
+        self._ids           = itertools.count()
+        self._lock          = threading.Lock()
+        self.workers        = []
+        if seed is None:
+            seed = int.from_bytes(os.urandom(8), "little") >> 2
+        for i, (inbox, cancels, worker_cores) in enumerate(zip(self.inboxes, self.cancels, split_cores(num_workers, cores))):
+            worker = context.Process(
+                target=_worker_main,
+                args=(model, device, seed + i, worker_cores, threads_per_worker, inbox, self.outbox, cancels,
+                      max_batch_size, batch_wait_ms, max_active_batches),
+                daemon=True,
+                )
+            worker.start()
+            self.workers.append(worker)
+        self._router = threading.Thread(target=self._route, daemon=True)
+        self._router.start()
+
+    def submit(self, request: GenerationRequest) -> bool:
+        with self._lock:
+            if len(self.pending) >= self.max_queue_size:
+                return False
+            self._check_workers()
+            alive = [i for i in range(len(self.workers)) if i not in self.dead]
+            if not alive:
+                request.tokens.put(RuntimeError("no live workers"))
+                return True
+            request_id = next(self._ids)
+            worker     = min(alive, key=lambda i: self.in_flight[i])
+            self.in_flight[worker] += 1
+            self.pending[request_id] = (request, worker)
+        # queue.Queue인 tokens는 프로세스 사이로 보낼 수 없으므로 빼고 보낸다.
+        self.inboxes[worker].put((request_id, dataclasses.replace(request, tokens=None)))
+        return True
+
+    def qsize(self) -> int:
+        with self._lock:
+            return len(self.pending)
+
+    def cancel(self, request: GenerationRequest):
+        """Tells the request's worker to drop it; the worker then ends it with None as usual."""
+        with self._lock:
+            for request_id, (pending, worker) in self.pending.items():
+                if pending is request:
+                    break
+            else:
+                return
+        self.cancels[worker].put(request_id)
+
+    def health(self) -> dict:
+        """The /health body: "degraded" if some workers died, "down" if all of them did."""
+        with self._lock:
+            self._check_workers()
+            workers = [{"pid": worker.pid, "alive": i not in self.dead, "exitcode": worker.exitcode}
+                       for i, worker in enumerate(self.workers)]
+        num_dead = len(self.dead)
+        status   = "ok" if num_dead == 0 else "down" if num_dead == len(self.workers) else "degraded"
+        return {"status": status, "workers": workers}
+
+    def _check_workers(self):
+        # self._lock을 잡은 상태에서 호출: 새로 죽은 워커를 dead에 넣고, 그 워커의 요청을 예외로 끝낸다.
+        for i, worker in enumerate(self.workers):
+            if i in self.dead or worker.is_alive():
+                continue
+            self.dead.add(i)
+            error = RuntimeError(f"worker {i} (pid {worker.pid}) exited with code {worker.exitcode}")
+            for request_id, (request, owner) in list(self.pending.items()):
+                if owner == i:
+                    del self.pending[request_id]
+                    self.in_flight[i] -= 1
+                    request.tokens.put(error)
+
+    def _route(self):
+        while True:
+            try:
+                request_id, token = self.outbox.get(timeout=WORKER_CHECK_SECONDS)
+            except queue.Empty:
+                with self._lock:
+                    self._check_workers()
+                continue
+            with self._lock:
+                # 죽은 워커가 남긴 토큰은 요청이 이미 예외로 끝났으므로 버린다.
+                if request_id not in self.pending:
+                    continue
+                request, worker = self.pending[request_id]
+                if token is None or isinstance(token, Exception):
+                    del self.pending[request_id]
+                    self.in_flight[worker] -= 1
+            request.tokens.put(token)
+
+    def close(self):
+        for worker in self.workers:
+            worker.terminate()
+        for worker in self.workers:
+            worker.join()
@@ -0,0 +1,76 @@
+# Chunked LM head (Sampler(vocab_size, vocab_chunk_size)) vs. full logits.
+# python -m pytest -q test_lm_head.py
+import pytest
+import torch
+from source.gemma_torch import (
+    Sampler,
+    sampling_keys
+    )
+
+
+VOCAB_SIZE  = 1000
+HIDDEN_SIZE = 64
+BATCH_SIZE  = 4
+# vocab_size의 약수가 아닌 chunk (마지막 타일이 짧다)와 vocab_size보다 큰 chunk
+CHUNK_SIZES = [96, 333, 4096]
+
+
+@pytest.fixture
+def inputs():
+    generator     = torch.Generator().manual_seed(0)
+    embedding     = torch.randn(VOCAB_SIZE, HIDDEN_SIZE, generator=generator)
+    hidden_states = torch.randn(BATCH_SIZE, 1, HIDDEN_SIZE, generator=generator)
+    return embedding, hidden_states
+
+
+def sample(sampler, embedding, hidden_states, temperatures, top_p=1.0, top_k=VOCAB_SIZE, **kwargs):
+    return sampler(
+        embedding,
+        hidden_states,
+        torch.tensor([0]),
+        temperatures,
+        torch.full((BATCH_SIZE,), top_p),
+        torch.full((BATCH_SIZE,), top_k, dtype=torch.int64),
+        **kwargs,
+        )
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_greedy_argmax(inputs, chunk_size):
+    embedding, hidden_states = inputs
+    bias = torch.zeros(VOCAB_SIZE)
+    bias[-1] = 1e4  # 마지막 (짧은) 타일의 토큰을 고르게 한다.
+    for embedding_bias in (None, bias):
+        full    = sample(Sampler(VOCAB_SIZE), embedding, hidden_states, None, embedding_bias=embedding_bias)
+        chunked = sample(Sampler(VOCAB_SIZE, chunk_size), embedding, hidden_states, None, embedding_bias=embedding_bias)
+        assert torch.equal(full, chunked)
+    assert bool((chunked == VOCAB_SIZE - 1).all())
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_top_k_and_logsumexp(inputs, chunk_size):
+    embedding, hidden_states = inputs
+    hidden_states = hidden_states[:, 0]
+    temperatures  = torch.tensor([0.5, 0.95, 1.0, 2.0])
+    logits = torch.matmul(hidden_states, embedding.t()).float() / temperatures.unsqueeze(dim=1)
+    for k in (1, 50, VOCAB_SIZE):
+        ref_values, ref_ids = torch.topk(logits, k, dim=-1)
+        values, ids, lse = Sampler(VOCAB_SIZE, chunk_size).chunked_top_k(embedding, hidden_states, k, temperatures)
+        assert ids.shape == (BATCH_SIZE, k)
+        assert [set(row) for row in ids.tolist()] == [set(row) for row in ref_ids.tolist()]
+        torch.testing.assert_close(values, ref_values)
+        torch.testing.assert_close(lse, torch.logsumexp(logits, dim=-1))
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+@pytest.mark.parametrize("top_p, top_k", [(1.0, 50), (0.9, 100), (1.0, VOCAB_SIZE)])
+def test_seeded_sampling(inputs, chunk_size, top_p, top_k):
+    # 같은 seed이면 Gumbel-max 노이즈가 토큰 아이디로 정해지므로 전체 로짓 경로와 같은 토큰을 고른다.
+    embedding, hidden_states = inputs
+    temperatures = torch.tensor([0.0, 0.7, 0.95, 1.5])
+    for offset in range(8):
+        keys    = sampling_keys(torch.tensor([1, 2, 3, 12345]), torch.tensor(offset))
+        full    = sample(Sampler(VOCAB_SIZE), embedding, hidden_states, temperatures, top_p, top_k, sampling_keys=keys)
+        chunked = sample(Sampler(VOCAB_SIZE, chunk_size), embedding, hidden_states, temperatures, top_p, top_k,
+                         sampling_keys=keys)
+        assert torch.equal(full, chunked)
@@ -0,0 +1,128 @@
+# GenerationMetrics: generate_stream with a scripted sampler (known EOS / stop token / max_tokens steps).
+# python -m pytest -q test_metrics.py
+import types
+import pytest
+import torch
+import torch.nn as nn
+from source.config import *
+from source.gemma_torch import *
+from source.metrics import GenerationMetrics
+
+
+PAD_ID, EOS_ID, STOP_ID = 0, 1, 20
+PROMPTS    = [[2, 5, 6], [2, 7, 8], [2, 9, 10, 11]]
+OUTPUT_LEN = 6
+MAX_TOKENS = [OUTPUT_LEN, OUTPUT_LEN, 3]
+# 스텝 i에 각 행이 샘플링하는 토큰 (행 2의 스텝 0은 프롬프트 위치라 무시된다).
+# 행 0: 10, 11 다음 EOS / 행 1: 13 다음 stop 토큰 / 행 2: 15, 16, 17에서 max_tokens
+SCRIPT = [
+    [10, 13, 30],
+    [11, STOP_ID, 15],
+    [EOS_ID, 14, 16],
+    [12, 14, 17],
+    [12, 14, 18],
+    [12, 14, 19],
+    [12, 14, 21],
+    ]
+GENERATED = [[10, 11], [13], [15, 16, 17]]
+
+
+class ScriptedSampler(nn.Module):
+    def __init__(self, script):
+        super().__init__()
+        self.steps = iter(script)
+
+    def forward(self, **kwargs) -> torch.Tensor:
+        return torch.tensor(next(self.steps), dtype=torch.int64)
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    config = GemmaConfig(
+        vocab_size=32,
+        max_position_embeddings=64,
+        num_hidden_layers=1,
+        num_attention_heads=2,
+        num_key_value_heads=1,
+        hidden_size=32,
+        intermediate_size=64,
+        head_dim=16,
+        dtype='float32',
+        tokenizer=None,
+        )
+    model = GemmaForCausalLM(config).eval()
+    for param in model.parameters():
+        nn.init.normal_(param, std=0.02)
+    # generate_stream은 tokenizer의 pad_id / eos_id만 쓴다.
+    model.tokenizer = types.SimpleNamespace(pad_id=PAD_ID, eos_id=EOS_ID)
+    model.sampler   = ScriptedSampler(SCRIPT)
+    model.metrics   = GenerationMetrics()
+    return model
+
+
+def run(model):
+    outputs = [[] for _ in PROMPTS]
+    finished = [False] * len(PROMPTS)
+    occupancy = []
+    stream = model.generate_stream(
+        PROMPTS, None, output_len=OUTPUT_LEN, temperature=None,
+        stop_token_ids=[[], [STOP_ID], []], max_tokens=MAX_TOKENS,
+        )
+    for step_tokens in stream:
+        for i, token in enumerate(step_tokens):
+            if token is None or finished[i]:
+                continue
+            if token in (EOS_ID, STOP_ID):
+                finished[i] = True
+                continue
+            outputs[i].append(token)
+            finished[i] = len(outputs[i]) >= MAX_TOKENS[i]
+        occupancy.append(model.metrics.batch_occupancy.get())
+    return outputs, occupancy
+
+
+def test_counters_and_histograms(model):
+    outputs, occupancy = run(model)
+    metrics = model.metrics
+    assert outputs == GENERATED
+    assert metrics.requests.get() == len(PROMPTS)
+    assert metrics.prompt_tokens.get() == sum(len(p) for p in PROMPTS)
+    # stop 토큰과 EOS는 세지 않고, max_tokens 이후의 토큰도 세지 않는다.
+    assert metrics.generated_tokens.get() == sum(len(o) for o in GENERATED)
+    assert metrics.ttft.count() == len(PROMPTS)
+    assert metrics.inter_token.count() == sum(len(o) - 1 for o in GENERATED)
+    # min_prompt_len부터 max_seq_len까지 한 번의 prefill과 나머지 decode 스텝
+    assert metrics.step_seconds.count(phase="prefill") == 1
+    assert metrics.step_seconds.count(phase="decode") == len(SCRIPT) - 1
+    # 스텝 1에서 행 1이 stop 토큰으로, 스텝 2에서 행 0이 EOS로, 스텝 3에서 행 2가 max_tokens로 끝난다.
+    assert occupancy[:4] == [1.0, 2 / 3, 1 / 3, 0.0]
+    assert metrics.active_sequences.get() == 0
+    assert metrics.kv_cache_bytes.get() == 0
+    assert metrics.kv_cache_capacity.get() == 0
+    assert metrics.tokens_per_second.get() > 0
+    for histogram, labels in ((metrics.ttft, {}), (metrics.inter_token, {}), (metrics.step_seconds, {"phase": "decode"})):
+        counts, _, count = histogram.values[histogram._key(labels)]
+        assert sum(counts) == count
+
+
+def test_prometheus_text(model):
+    run(model)
+    text  = model.metrics.render()
+    lines = text.splitlines()
+    assert "# TYPE gemma_generated_tokens_total counter" in lines
+    assert "# TYPE gemma_time_to_first_token_seconds histogram" in lines
+    assert "# TYPE gemma_active_sequences gauge" in lines
+    assert "gemma_requests_total 3" in lines
+    assert "gemma_prompt_tokens_total 10" in lines
+    assert "gemma_generated_tokens_total 6" in lines
+    assert "gemma_active_sequences 0" in lines
+    assert 'gemma_time_to_first_token_seconds_bucket{le="+Inf"} 3' in lines
+    assert "gemma_time_to_first_token_seconds_count 3" in lines
+    assert 'gemma_inter_token_latency_seconds_bucket{le="+Inf"} 3' in lines
+    assert 'gemma_step_seconds_bucket{phase="decode",le="+Inf"} 6' in lines
+    assert 'gemma_step_seconds_count{phase="prefill"} 1' in lines
+    # 버킷 값은 누적이므로 le 순서대로 줄지 않는다.
+    buckets = [int(line.rsplit(" ", 1)[1]) for line in lines if line.startswith("gemma_inter_token_latency_seconds_bucket")]
+    assert buckets == sorted(buckets)
+    assert text.endswith("\n")
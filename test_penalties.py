@@ -0,0 +1,114 @@
+# Repetition / frequency / presence penalties and logit bias over a batch with mixed per-row values.
+# python -m pytest -q test_penalties.py
+import pytest
+import torch
+import torch.nn as nn
+from source.config import *
+from source.gemma_torch import *
+
+
+VOCAB_SIZE = 250
+OUTPUT_LEN = 8
+PROMPTS    = [[2, 9, 9, 40, 41], [2, 5, 6], [2, 70, 71, 70, 72, 73], [2, 5, 17, 17]]
+FORCED_ID  = 42
+# 행마다 다른 패널티와 logit bias (행 1은 패널티 없이 bias만)
+REPETITION = [1.5, 1.0, 1.0, 1.3]
+FREQUENCY  = [0.0, 0.0, 0.7, 0.2]
+PRESENCE   = [0.0, 0.0, 0.4, 0.0]
+LOGIT_BIAS = [None, {FORCED_ID: 100.0}, None, {5: -50.0, 17: 3.0}]
+
+
+class RecordingSampler(nn.Module):
+    # 스텝마다 Sampler가 배치 전체에 대해 계산한 (bias, 패널티가 적용된) 로짓과 hidden states를 기록한다.
+    def __init__(self, sampler: Sampler):
+        super().__init__()
+        self.sampler = sampler
+        self.steps   = []
+
+    def forward(self, **kwargs) -> torch.Tensor:
+        hidden_states = kwargs["hidden_states"].index_select(1, kwargs["output_positions"]).squeeze(dim=1)
+        tiles = self.sampler._logits_tiles(
+            kwargs["embedding"], hidden_states, kwargs.get("embedding_bias"), kwargs.get("penalties"))
+        logits = torch.cat([tile for _, tile in tiles], dim=1)
+        self.steps.append((hidden_states.clone(), logits))
+        return self.sampler(**kwargs)
+
+
+def build_model(vocab_chunk_size):
+    torch.manual_seed(0)
+    config = GemmaConfig(
+        vocab_size=VOCAB_SIZE,
+        max_position_embeddings=64,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        num_key_value_heads=1,
+        hidden_size=32,
+        intermediate_size=64,
+        head_dim=16,
+        dtype='float32',
+        vocab_chunk_size=vocab_chunk_size,
+        tokenizer=None,
+        )
+    model = GemmaForCausalLM(config).eval()
+    for param in model.parameters():
+        nn.init.normal_(param, std=0.5)
+    model.sampler = RecordingSampler(model.sampler)
+    return model
+
+
+def reference_logits(model, hidden_states, row: int, outputs) -> torch.Tensor:
+    # 한 행의 로짓을 프롬프트와 지금까지 생성한 토큰에서 직접 계산한다.
+    logits = torch.matmul(hidden_states, model.model.embed_tokens.weight.t()).float()
+    for token_id, bias in (LOGIT_BIAS[row] or {}).items():
+        logits[token_id] += bias
+    counts = torch.zeros(VOCAB_SIZE)
+    for token_id in outputs:
+        counts[token_id] += 1
+    seen = set(PROMPTS[row]) | set(outputs)
+    for token_id in seen:
+        value = logits[token_id]
+        # 반복 패널티: 양수 로짓은 나누고 음수 로짓은 곱한다 (등장한 토큰만).
+        logits[token_id] = value / REPETITION[row] if value > 0 else value * REPETITION[row]
+    logits -= FREQUENCY[row] * counts
+    logits -= PRESENCE[row] * (counts > 0).float()
+    return logits
+
+
+@pytest.mark.parametrize("vocab_chunk_size", [None, 7])
+def test_mixed_penalties_match_row_reference(vocab_chunk_size):
+    model   = build_model(vocab_chunk_size)
+    outputs = [[] for _ in PROMPTS]
+    stream  = model.generate_stream(
+        PROMPTS, None, output_len=OUTPUT_LEN, temperature=None,
+        repetition_penalty=REPETITION, frequency_penalty=FREQUENCY, presence_penalty=PRESENCE,
+        logit_bias=LOGIT_BIAS,
+        )
+    signs = set()
+    for step, step_tokens in enumerate(stream):
+        hidden_states, logits = model.sampler.steps[step]
+        for row, token in enumerate(step_tokens):
+            if token is None:
+                continue
+            expected = reference_logits(model, hidden_states[row], row, outputs[row])
+            torch.testing.assert_close(logits[row], expected, rtol=1e-5, atol=1e-4)
+            # greedy: 기준 로짓의 argmax를 고른다.
+            assert token == int(torch.argmax(expected))
+            if REPETITION[row] != 1.0:
+                raw = torch.matmul(hidden_states[row], model.model.embed_tokens.weight.t())
+                signs |= {bool(raw[t] > 0) for t in set(PROMPTS[row]) | set(outputs[row])}
+            outputs[row].append(token)
+
+    # +100 bias는 토큰을 강제한다.
+    assert outputs[1] == [FORCED_ID] * len(outputs[1])
+    # 반복 패널티가 양수 / 음수 로짓 모두에 적용된 경우를 확인했는지
+    assert signs == {True, False}
+
+
+def test_neutral_rows_are_unchanged():
+    # 패널티와 bias가 없는 행은 다른 행의 패널티와 관계없이 패널티 없이 생성한 결과와 같다.
+    model = build_model(None)
+    plain = model.generate(PROMPTS, None, output_len=OUTPUT_LEN, temperature=None)
+    mixed = model.generate(PROMPTS, None, output_len=OUTPUT_LEN, temperature=None,
+                           repetition_penalty=[1.0, 2.0, 1.0, 1.0], presence_penalty=[0.0, 0.0, 1.0, 0.0])
+    assert mixed[0] == plain[0] and mixed[3] == plain[3]
+    assert mixed[1] != plain[1] or mixed[2] != plain[2]
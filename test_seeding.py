@@ -0,0 +1,73 @@
+# Seeded sampling is independent of batch composition (generate_stream with per-row seeds).
+# python -m pytest -q test_seeding.py
+import pytest
+import torch
+import torch.nn as nn
+from source.config import *
+from source.gemma_torch import *
+
+
+# 7의 배수가 아닌 vocab: chunked LM head의 마지막 타일이 짧다.
+VOCAB_SIZE = 250
+OUTPUT_LEN = 12
+PROMPT     = [2, 17, 45, 101, 9]
+SEED       = 1234
+
+
+def build_model(vocab_chunk_size):
+    torch.manual_seed(0)
+    config = GemmaConfig(
+        vocab_size=VOCAB_SIZE,
+        max_position_embeddings=64,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        num_key_value_heads=1,
+        hidden_size=32,
+        intermediate_size=64,
+        head_dim=16,
+        dtype='float32',
+        vocab_chunk_size=vocab_chunk_size,
+        tokenizer=None,
+        )
+    model = GemmaForCausalLM(config).eval()
+    for param in model.parameters():
+        # 로짓이 고르게 퍼지도록 큰 weight: 샘플링이 seed에 따라 달라진다.
+        nn.init.normal_(param, std=0.5)
+    return model
+
+
+def generate_tokens(model, prompts, temperature, seed):
+    outputs = [[] for _ in prompts]
+    for step_tokens in model.generate_stream(prompts, None, output_len=OUTPUT_LEN, temperature=temperature,
+                                             top_p=0.95, top_k=50, seed=seed):
+        for i, token in enumerate(step_tokens):
+            if token is not None:
+                outputs[i].append(token)
+    return outputs
+
+
+@pytest.mark.parametrize("vocab_chunk_size", [None, 7])
+def test_seeded_row_ignores_batch(vocab_chunk_size):
+    model = build_model(vocab_chunk_size)
+    alone = generate_tokens(model, [PROMPT], 0.9, SEED)[0]
+    assert len(alone) == OUTPUT_LEN
+
+    # 프롬프트 길이가 다른 행들 (seed가 다른 행, seed 없는 행, greedy 행) 사이의 여러 위치에서 같은 토큰
+    others = [[2, 5], [2, 8, 9, 10, 11, 12, 13], [2, 30, 31]]
+    for position in range(len(others) + 1):
+        prompts      = others[:position] + [PROMPT] + others[position:]
+        temperatures = [1.2, None, 0.7][:position] + [0.9] + [1.2, None, 0.7][position:]
+        seeds        = [99, None, None][:position] + [SEED] + [99, None, None][position:]
+        batch = generate_tokens(model, prompts, temperatures, seeds)
+        # generate_stream은 가장 긴 프롬프트 + OUTPUT_LEN까지 진행하므로 짧은 행은 토큰이 더 나온다.
+        assert batch[position][:OUTPUT_LEN] == alone
+
+    # 다른 seed는 (거의 항상) 다른 토큰을 고른다: seed가 실제로 샘플링에 쓰이는지 확인
+    assert generate_tokens(model, [PROMPT], 0.9, SEED + 1)[0] != alone
+
+
+def test_seed_matches_across_lm_heads():
+    # chunked LM head와 전체 로짓 경로가 같은 seed에서 같은 토큰을 고른다.
+    full    = generate_tokens(build_model(None), [PROMPT, [2, 5]], 0.9, [SEED, 7])
+    chunked = generate_tokens(build_model(7), [PROMPT, [2, 5]], 0.9, [SEED, 7])
+    assert full == chunked